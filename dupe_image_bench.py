@@ -0,0 +1,409 @@
+import argparse
+import collections
+import itertools
+import json
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import multiprocessing as mp
+from pathlib import Path
+
+import imagehash
+import numpy as np
+from PIL import Image, ImageDraw, ImageEnhance
+
+import dupe_image_lib as dil
+
+try:
+    import resource  # unix only, for the peak RSS of the hashing processes.
+except ImportError:
+    resource = None
+
+
+def make_base_image(rng: np.random.Generator, size: tuple) -> Image.Image:
+    """
+    Makes a random "photo": a smooth colour gradient from upscaled noise, with a few random shapes on top.
+    """
+
+    image = Image.fromarray(rng.integers(0, 256, (6, 8, 3), dtype=np.uint8)).resize(size, Image.BICUBIC)
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.integers(3, 8)):
+        x0, y0 = rng.integers(0, size[0]), rng.integers(0, size[1])
+        x1, y1 = x0 + rng.integers(10, size[0] // 2), y0 + rng.integers(10, size[1] // 2)
+        colour = tuple(int(c) for c in rng.integers(0, 256, 3))
+        (draw.ellipse if rng.random() < 0.5 else draw.rectangle)((x0, y0, x1, y1), fill=colour)
+    return image
+
+
+def make_near_duplicate(image: Image.Image, rng: np.random.Generator, directory: Path, name: str) -> str:
+    """
+    Saves an edited copy of an image: resized, cropped, re-encoded as a low quality JPEG, or brightness shifted.
+
+    :return: Returns the filename of the copy.
+    """
+
+    edit = rng.choice(["resize", "crop", "jpeg", "brightness"])
+    if edit == "resize":
+        scale = rng.uniform(0.5, 0.9)
+        image = image.resize((int(image.width * scale), int(image.height * scale)), Image.LANCZOS)
+    elif edit == "crop":
+        dx, dy = int(image.width * rng.uniform(0.02, 0.06)), int(image.height * rng.uniform(0.02, 0.06))
+        image = image.crop((dx, dy, image.width - dx, image.height - dy))
+    elif edit == "brightness":
+        image = ImageEnhance.Brightness(image).enhance(rng.uniform(0.85, 1.15))
+    filename = f"{name}_{edit}.jpg"
+    image.save(Path(directory, filename), quality=int(rng.integers(40, 80)) if edit == "jpeg" else 90)
+    return filename
+
+
+def make_corpus(directory: Path, count: int, duplicate_ratio=0.2, near_ratio=0.2, size=(320, 240), seed=0) -> dict:
+    """
+    Generates a reproducible image corpus with a controlled share of exact copies and near duplicates.
+
+    :param directory: Folder the images are written to.
+    :param count: Total number of images.
+    :param duplicate_ratio: Share of images that are byte for byte copies of another image.
+    :param near_ratio: Share of images that are edited copies (resize, crop, JPEG re-encode, brightness) of another.
+    :param size: Size of the original images.
+    :param seed: Random seed.
+    :return: Returns the ground truth, a dict of filename: (family, copy of), where family is the original image every
+             copy and edit of it shares, and copy of is the file it is a byte for byte copy of (or None).
+    """
+
+    rng = np.random.default_rng(seed)
+    num_copies, num_near = int(count * duplicate_ratio), int(count * near_ratio)
+    num_originals = max(1, count - num_copies - num_near)
+    truth, originals = dict(), []
+
+    for num in range(num_originals):
+        filename = f"img{num:07d}.png"
+        make_base_image(rng, size).save(Path(directory, filename))
+        truth[filename] = (num, None)
+        originals.append(filename)
+    for num in range(num_near):
+        family = int(rng.integers(num_originals))
+        with Image.open(Path(directory, originals[family])) as image:
+            truth[make_near_duplicate(image, rng, directory, f"near{num:07d}")] = (family, None)
+    for num in range(num_copies):
+        source = list(truth)[int(rng.integers(len(truth)))]
+        filename = f"copy{num:07d}{Path(source).suffix}"
+        shutil.copyfile(Path(directory, source), Path(directory, filename))
+        truth[filename] = (truth[source][0], truth[source][1] or source)
+    return truth
+
+
+def make_hash_corpus(count: int, grid_density=10, near_ratio=0.4, flip=1 / 16, seed=0) -> tuple:
+    """
+    Generates image_data with synthetic hashes instead of images, for sizes too large to write to disk. Near duplicates
+    are copies of an original's hashes with about a share (flip, rounded to a power of 2) of the bits flipped.
+
+    :return: Returns a tuple of (image_data dict, ground truth dict as in make_corpus).
+    """
+
+    rng = np.random.default_rng(seed)
+    tiles = grid_density ** 2
+    num_originals = max(1, count - int(count * near_ratio))
+    families = np.concatenate([np.arange(num_originals), rng.integers(0, num_originals, count - num_originals)])
+    originals = rng.integers(0, 2 ** 64, (num_originals, 1 + tiles), dtype=np.uint64, endpoint=False)
+    flips = np.zeros((count, 1 + tiles), dtype=np.uint64)
+    flips[num_originals:] = ~np.uint64(0)
+    for _ in range(max(1, round(-np.log2(flip)))):  # each AND of random bits halves the chance of a bit being set.
+        flips &= rng.integers(0, 2 ** 64, (count, 1 + tiles), dtype=np.uint64, endpoint=False)
+    hashes = originals[families] ^ flips
+
+    image_data, truth = dict(), dict()
+    for num in range(count):
+        filename = f"img{num:07d}.png"
+        image_data[filename] = {"filename": filename, "size": (320, 240), "average_hash": f"{int(hashes[num, 0]):016x}",
+                                "hash_list": dil.HashRow(hashes[num, 1:])}
+        truth[filename] = (int(families[num]), None)
+    return image_data, truth
+
+
+def pair_scores(groups: list, truth: dict, exact=False) -> dict:
+    """
+    Pairwise precision and recall of groups against the ground truth. Two images belong together if they share a
+    family, or with exact, if they are byte for byte copies of the same file.
+    """
+
+    def key(filename):
+        return (truth[filename][1] or filename) if exact else truth[filename][0]
+
+    predicted = {frozenset(pair) for group in groups for pair in itertools.combinations(group, 2)}
+    members = dict()
+    for filename in truth:
+        members.setdefault(key(filename), []).append(filename)
+    expected = {frozenset(pair) for group in members.values() for pair in itertools.combinations(group, 2)}
+    correct = len(predicted & expected)
+    return {"precision": correct / len(predicted) if predicted else 1.0,
+            "recall": correct / len(expected) if expected else 1.0,
+            "predicted_pairs": len(predicted), "expected_pairs": len(expected)}
+
+
+class MemoryTrace:
+    """
+    Traces the memory allocated by python and numpy (tracemalloc) over one corpus size, and over each step within it.
+    Each step resets the traced peak, so the peak of the whole size is kept here across the steps. Does nothing when
+    not enabled, as tracing slows everything down.
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.base, self.peak = 0, 0
+        if enabled:
+            tracemalloc.start()
+            tracemalloc.reset_peak()
+            self.base = self.peak = tracemalloc.get_traced_memory()[0]
+
+    def step(self) -> int:
+        """
+        Starts a step.
+
+        :return: Returns the traced bytes at the start of the step, for step_peak().
+        """
+
+        if not self.enabled:
+            return 0
+        current, peak = tracemalloc.get_traced_memory()
+        self.peak = max(self.peak, peak)
+        tracemalloc.reset_peak()
+        return current
+
+    def step_peak(self, start: int):
+        """
+        :return: Returns the peak bytes allocated since the step started, or None when not enabled.
+        """
+
+        if not self.enabled:
+            return None
+        peak = tracemalloc.get_traced_memory()[1]
+        self.peak = max(self.peak, peak)
+        return peak - start
+
+    def stop(self):
+        """
+        Stops tracing.
+
+        :return: Returns the peak bytes allocated over the whole size, or None when not enabled.
+        """
+
+        if not self.enabled:
+            return None
+        self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        return self.peak - self.base
+
+
+def timed(func, *args, trace: MemoryTrace = None, **kwargs):
+    """
+    Times a function call, and with a trace, the peak memory allocated by python and numpy during the call
+    (tracing slows the call down, so the time isn't representative then).
+
+    :return: Returns a tuple of (return value, seconds, peak traced bytes or None).
+    """
+
+    start_bytes = trace.step() if trace is not None else 0
+    start = time.perf_counter()
+    value = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    return value, seconds, trace.step_peak(start_bytes) if trace is not None else None
+
+
+def bench_size(count: int, args) -> dict:
+    """
+    Runs every benchmark on a corpus of count images.
+
+    :return: Returns a dict of results.
+    """
+
+    report = {"images": count}
+    work_dir = Path(tempfile.mkdtemp(prefix="dil_bench_"))
+    image_struct = dil.ImageStruct(directory=work_dir, allowed_cpu_cores=args.cores)
+    trace = MemoryTrace(args.trace_memory)
+    try:
+        if count <= args.max_images:
+            truth, seconds, _ = timed(make_corpus, work_dir, count, args.duplicate_ratio, args.near_ratio,
+                                      args.image_size, seed=args.seed)
+            report["corpus_seconds"] = seconds
+            file_list = dil.list_images(work_dir)
+            _, seconds, peak = timed(image_struct.generate_data, file_list, args.grid_density, args.fast_decode,
+                                     trace=trace)
+            report["hashing"] = {"seconds": seconds, "images_per_second": count / seconds, "peak_traced_bytes": peak}
+            report["grid_hashes"] = bench_grid_hashes(work_dir, file_list[:args.grid_sample], args.grid_density)
+        else:
+            image_data, truth = make_hash_corpus(count, args.grid_density, args.near_ratio, seed=args.seed)
+            image_struct.image_data = image_data
+            image_struct.metadata = {"directory": str(work_dir), "grid_density": args.grid_density}
+            report["hashing"] = "skipped, synthetic hashes (above --max-images)"
+
+        for file_format in ("binary", "json") if count <= args.max_json else ("binary",):
+            _, save_seconds, _ = timed(image_struct.save_data, file_format)
+            loaded = dil.ImageStruct(directory=work_dir, allowed_cpu_cores=1)
+            _, load_seconds, peak = timed(loaded.load_data, file_format, trace=trace)
+            report[f"store_{file_format}"] = {"save_seconds": save_seconds, "load_seconds": load_seconds,
+                                              "load_peak_traced_bytes": peak}
+
+        identical, seconds, _ = timed(dil.group_identical, image_struct)
+        report["identical"] = {"seconds": seconds, **pair_scores(identical[1], truth, exact=True)}
+
+        if count <= args.max_compare:
+            pairs = count * (count - 1) // 2
+            similar, seconds, peak = timed(dil.cross_compare_matrix, image_struct, cutoff=args.cutoff,
+                                           success_ratio=args.success_ratio, trace=trace)
+            report["similar"] = {"seconds": seconds, "pairs_per_second": pairs / seconds if seconds else None,
+                                 "peak_traced_bytes": peak, **pair_scores(similar[1], truth)}
+            image_struct.instruments, instruments = dil.Instruments(), image_struct.instruments  # for the stage counts.
+            cascade, seconds, _ = timed(dil.cross_compare_matrix, image_struct, cutoff=args.cutoff,
+                                        success_ratio=args.success_ratio, cascade={})
+            image_struct.instruments, counters = instruments, image_struct.instruments.counters
+            report["similar_cascade_matrix"] = {
+                "seconds": seconds, "pairs_per_second": pairs / seconds if seconds else None,
+                **{stage: counters[stage] for stage in dil.CASCADE_STAGES + ("tiles_compared",)},
+                "pruning_rate": 1 - counters["tiles_compared"] / (pairs * args.grid_density ** 2) if pairs else 0.0,
+                **pair_scores(cascade[1], truth)}
+
+            if count <= args.max_legacy:
+                legacy, seconds, _ = timed(dil.cross_compare_list, image_struct, dil.compare_hashes,
+                                           cutoff=args.cutoff, success_ratio=args.success_ratio, mode="similar")
+                report["similar_legacy"] = {"seconds": seconds, "pairs_per_second": pairs / seconds,
+                                            "same_groups": legacy == similar}
+                stats = collections.Counter()
+                cascade, seconds, _ = timed(dil.cross_compare_list, image_struct, dil.compare_hashes,
+                                            cutoff=args.cutoff, success_ratio=args.success_ratio, mode="cascade",
+                                            stats=stats)
+                report["similar_cascade"] = {"seconds": seconds, "pairs_per_second": pairs / seconds,
+                                             **dil.cascade_report(stats, args.grid_density ** 2),
+                                             **pair_scores(cascade[1], truth)}
+        else:
+            report["similar"] = "skipped, above --max-compare"
+
+        if count <= args.max_index:
+            report["index"] = bench_index(image_struct, truth, count <= args.max_compare, args, trace)
+    finally:
+        report["peak_traced_bytes"] = trace.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
+
+
+def bench_grid_hashes(directory: Path, file_list: list, grid_density: int) -> dict:
+    """
+    Times grid_hashes() against the per square Image.crop() and imagehash.average_hash() path it replaced, on images
+    that are already decoded, so only the hashing is timed.
+
+    :return: Returns a dict of the milliseconds per image of each, the speedup and whether the hashes are the same.
+    """
+
+    images = []
+    for filename in file_list:
+        with Image.open(Path(directory, filename)) as image:
+            images.append(image.convert("RGB"))
+    if not images:
+        return {"images": 0}
+    grid, grid_seconds, _ = timed(lambda: [dil.grid_hashes(image, grid_density) for image in images])
+    legacy, legacy_seconds, _ = timed(lambda: [dil._grid_hashes_legacy(image, grid_density) for image in images])
+    return {"images": len(images), "ms_per_image": 1000 * grid_seconds / len(images),
+            "legacy_ms_per_image": 1000 * legacy_seconds / len(images), "speedup": legacy_seconds / grid_seconds,
+            "same_hashes": grid == legacy}
+
+
+def bench_index(image_struct: dil.ImageStruct, truth: dict, scan: bool, args, trace=None) -> dict:
+    """
+    Benchmarks the HashIndex against the scans it replaces: candidate_pairs() against similarity_edges() (only with
+    scan, otherwise estimated from the lookups), and the lookup of --lookups images against a match_rows() scan each.
+    Recall is the share of the pairs the scans find that the index has as candidates, family_recall only counts the
+    pairs of the same family (the scan also matches unrelated images with enough flat or plain grid squares).
+
+    :return: Returns a dict of results.
+    """
+
+    count, tiles = len(image_struct.image_data), args.grid_density ** 2
+    pairs = count * (count - 1) // 2
+    names, matrix = dil.pack_hashes(image_struct.image_data)
+    index = dil.HashIndex(tiles, args.cutoff, args.success_ratio)
+    _, build_seconds, _ = timed(index.add, image_struct.image_data)
+    candidates, seconds, peak = timed(index.candidate_pairs, trace=trace)
+    candidates = {frozenset(pair) for pair in candidates}
+    report = {"build_seconds": build_seconds, "seconds": seconds, "peak_traced_bytes": peak,
+              "candidate_pairs": len(candidates), "pruning_rate": 1 - len(candidates) / pairs if pairs else 0.0}
+
+    queries = names[-args.lookups:]
+    found, lookup_seconds, _ = timed(index.candidates, {name: image_struct.image_data[name] for name in queries})
+    required = round(tiles * args.success_ratio)
+    start = time.perf_counter()
+    matches = {name: {names[row] for row in dil.match_rows(matrix, matrix[num], args.cutoff, required)} - {name}
+               for num, name in enumerate(queries, start=len(names) - len(queries))}
+    scan_lookup_seconds = time.perf_counter() - start
+    expected = sum(map(len, matches.values()))
+    report.update({"lookups": len(queries), "lookup_seconds": lookup_seconds,
+                   "scan_lookup_seconds": scan_lookup_seconds,
+                   "lookup_recall": sum(len(matches[name] & set(found[name])) for name in queries) / expected
+                   if expected else 1.0})
+
+    if scan:
+        edges, scan_seconds, _ = timed(dil.similarity_edges, matrix, args.cutoff, args.success_ratio)
+        edges = {frozenset((names[i], names[j])) for i, j in edges.tolist()}
+        family = {pair for pair in edges if len({truth[filename][0] for filename in pair}) == 1}
+        report.update({"scan_seconds": scan_seconds,
+                       "recall": len(edges & candidates) / len(edges) if edges else 1.0,
+                       "family_recall": len(family & candidates) / len(family) if family else 1.0})
+    else:  # the pairs of the lookups, at the same rate.
+        report["scan_seconds_estimated"] = scan_lookup_seconds * pairs / (len(queries) * count) if queries else None
+    scan_seconds = report["scan_seconds" if scan else "scan_seconds_estimated"]
+    report["speedup"] = scan_seconds / (build_seconds + seconds) if scan_seconds and build_seconds + seconds else None
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="dupe_image_bench",
+                                     description="Benchmarks hashing, comparing and storing on synthetic corpora.")
+    parser.add_argument("--sizes", default="1000,10000",
+                        help="comma separated corpus sizes, e.g. 1000,10000,100000,1000000")
+    parser.add_argument("--max-images", type=int, default=10000,
+                        help="larger corpora use synthetic hashes instead of images")
+    parser.add_argument("--max-compare", type=int, default=100000, help="larger corpora skip the similar comparison")
+    parser.add_argument("--max-legacy", type=int, default=1000, help="larger corpora skip cross_compare_list")
+    parser.add_argument("--max-json", type=int, default=100000, help="larger corpora skip the json store")
+    parser.add_argument("--grid-sample", type=int, default=200,
+                        help="images grid_hashes() is timed on against the per square imagehash path")
+    parser.add_argument("--max-index", type=int, default=1000000, help="larger corpora skip the HashIndex")
+    parser.add_argument("--lookups", type=int, default=1000, help="images looked up in the HashIndex")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.2)
+    parser.add_argument("--near-ratio", type=float, default=0.2)
+    parser.add_argument("--grid-density", type=int, default=10)
+    parser.add_argument("--image-size", type=lambda size: tuple(map(int, size.split("x"))), default=(320, 240),
+                        metavar="WIDTHxHEIGHT", help="size of the corpus images (default: 320x240)")
+    parser.add_argument("--cutoff", type=int, default=12)
+    parser.add_argument("--success-ratio", type=float, default=0.3)
+    parser.add_argument("--fast-decode", action="store_true")
+    parser.add_argument("--cores", type=int, default=mp.cpu_count())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="report the peak python/numpy memory of each corpus size and step (slows the steps down)")
+    parser.add_argument("--output", default=None, help="json file the report is written to (default: stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    reports = []
+    for count in [int(size) for size in args.sizes.split(",")]:
+        print(f"Benchmarking {count} images...", file=sys.stderr)
+        reports.append(bench_size(count, args))
+        print(json.dumps(reports[-1], indent=4), file=sys.stderr)
+
+    peak_rss = None
+    if resource is not None:  # kilobytes on linux, bytes on macOS.
+        peak_rss = {"self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                    "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}
+    output = json.dumps({"imagehash": imagehash.__version__, "numpy": np.__version__, "args": vars(args),
+                         "peak_rss": peak_rss, "results": reports}, indent=4)
+    if args.output is None:
+        print(output)
+    else:
+        Path(args.output).write_text(output)
+
+
+if __name__ == "__main__":
+    main()
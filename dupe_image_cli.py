@@ -0,0 +1,285 @@
+import argparse
+import csv
+import json
+import sys
+import multiprocessing as mp
+from pathlib import Path
+
+import dupe_image_lib as dil
+
+
+def open_struct(directory: Path, allowed_cpu_cores=None, progress=False, verbose=False, storage_format="binary",
+                instruments=None, frame_sampling=None):
+    """
+    Makes an ImageStruct object for a folder, with its progress and log printed to stderr (if enabled).
+
+    :param directory: pathlib Path object.
+    :param allowed_cpu_cores: Max processes used for hashing and comparing, defaults to every core.
+    :param progress: Prints the progress percentage.
+    :param verbose: Prints the log messages.
+    :param storage_format: The format the hashes are saved in, "binary" or "json".
+    :param instruments: Optional dil.Instruments object, that times the stages of the run.
+    :param frame_sampling: Optional dict of the frames hashed from animations and videos, see dil.frame_indices().
+    :return: Returns an ImageStruct object.
+    """
+
+    signals = dil.make_signals(
+        progress=(lambda percentage: print(f"\r{percentage:3d}%", end="", file=sys.stderr)) if progress else None,
+        log=(lambda text: print(text, file=sys.stderr)) if verbose else None)
+    return dil.ImageStruct(directory=Path(directory), allowed_cpu_cores=allowed_cpu_cores or mp.cpu_count(),
+                           pyqt_signals=signals, storage_format=storage_format, instruments=instruments,
+                           frame_sampling=frame_sampling)
+
+
+def hash_folder(image_struct: dil.ImageStruct, grid_density=None, fast_decode=None, rehash=False, digest=False,
+                image_types=None, recursive=False):
+    """
+    Hashes the images of a folder (only the new and changed ones, unless rehash is set) and saves the hashes.
+
+    :param image_struct: An ImageStruct object.
+    :param grid_density: The grid density, defaults to the one of the saved hashes (or 10).
+    :param fast_decode: Decodes images at a reduced resolution, defaults to the mode of the saved hashes.
+    :param rehash: Ignores the saved hashes and hashes every image again.
+    :param digest: Also keeps a content digest of each file, see ImageStruct.update_data().
+    :param image_types: List of image file extensions, defaults to dil.IMAGE_TYPES.
+    :param recursive: Hashes the whole tree into one library store, keyed by relative path, see
+                      ImageStruct.update_library().
+    :return: Returns the ImageStruct object.
+    """
+
+    if rehash:
+        file_list = (dil.scan_tree if recursive else dil.list_images)(image_struct.directory, image_types)
+        image_struct.generate_data(file_list, grid_density or 10, bool(fast_decode))
+    elif recursive:
+        image_struct.update_library(grid_density, digest, fast_decode, image_types)
+    else:
+        image_struct.update_data(dil.list_images(image_struct.directory, image_types), grid_density, digest,
+                                 fast_decode)
+    image_struct.save_data()
+    return image_struct
+
+
+def find_groups(image_struct: dil.ImageStruct, mode="similar", cutoff=12, success_ratio=0.3, by_digest=False,
+                grouping="greedy", cascade=False) -> list:
+    """
+    Finds the groups of identical or similar images of a hashed ImageStruct object, or with mode "sequences", of
+    animations and videos with matching frames (the cutoff is per frame, the success ratio is the sequence ratio).
+    Similar images are grouped with grouping, and with cascade prefiltered coarse to fine, see cross_compare_matrix().
+
+    :return: Returns a list of groups (lists of filenames).
+    """
+
+    if mode == "identical":
+        return dil.group_identical(image_struct, by_digest=by_digest)[1]
+    if mode == "sequences":
+        return dil.cross_compare_sequences(image_struct, cutoff, success_ratio, grouping=grouping)[1]
+    return dil.cross_compare_matrix(image_struct, cutoff=cutoff, success_ratio=success_ratio, grouping=grouping,
+                                    cascade={} if cascade else None)[1]
+
+
+def write_groups(groups: list, image_struct: dil.ImageStruct, output="-", output_format="json"):
+    """
+    Writes groups of images as json, or as csv rows of group, filename, width, height.
+
+    :param groups: List of groups (lists of filenames).
+    :param image_struct: The ImageStruct object the groups come from.
+    :param output: Path of the output file, "-" for stdout.
+    :param output_format: "json" or "csv".
+    :return: No return value
+    """
+
+    output_file = sys.stdout if output == "-" else open(output, "w", newline="")
+    try:
+        if output_format == "csv":
+            writer = csv.writer(output_file)
+            writer.writerow(["group", "filename", "width", "height"])
+            for num, group in enumerate(groups):
+                for filename in group:
+                    writer.writerow([num, filename, *image_struct.image_data[filename]["size"]])
+        else:
+            json.dump({"directory": str(image_struct.directory), "groups": groups}, output_file, indent=4)
+            output_file.write("\n")
+    finally:
+        if output_file is not sys.stdout:
+            output_file.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="dupe_image_cli",
+                                     description="Finds identical and similar images, without the GUI.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("directories", nargs="+", type=Path, help="image folders, processed one after another")
+    common.add_argument("--cores", type=int, default=None,
+                        help="max processes used for hashing and comparing (default: all)")
+    common.add_argument("--progress", action="store_true", help="print the progress to stderr")
+    common.add_argument("--verbose", action="store_true", help="print the log to stderr")
+    common.add_argument("--store-format", choices=["binary", "json"], default="binary",
+                        help="format the hashes are saved in (default: binary)")
+    common.add_argument("--report", default=None, help="json file a report of the time taken by each stage is saved to")
+    common.add_argument("--profile-dir", default=None,
+                        help="folder each hashing process saves its cProfile stats to (worker-<pid>.pstats)")
+
+    hashing = argparse.ArgumentParser(add_help=False)
+    hashing.add_argument("--grid-density", type=int, default=None,
+                         help="grid density (default: the saved one, or 10)")
+    hashing.add_argument("--fast-decode", action="store_true", default=None,
+                         help="decode images at a reduced resolution")
+    hashing.add_argument("--rehash", action="store_true", help="ignore the saved hashes")
+    hashing.add_argument("--digest", action="store_true", help="keep a content digest of each file")
+    hashing.add_argument("--recursive", action="store_true",
+                         help="treat each directory as a library: hash every subfolder into one store, and find "
+                              "duplicates across folders (saved hashes of subfolders are reused)")
+    hashing.add_argument("--video", action="store_true",
+                         help="also hash videos, by their keyframes (needs PyAV: pip install av)")
+    hashing.add_argument("--max-frames", type=int, default=dil.FRAME_SAMPLING["max_frames"],
+                         help="max frames hashed per animation or video (default: %(default)s)")
+    hashing.add_argument("--frame-policy", choices=dil.FRAME_POLICIES, default=dil.FRAME_SAMPLING["policy"],
+                         help="frames hashed: spread over the whole animation, the first ones, or every "
+                              "--frame-stride-th (stride finds clips of animations)")
+    hashing.add_argument("--frame-stride", type=int, default=dil.FRAME_SAMPLING["stride"])
+
+    output = argparse.ArgumentParser(add_help=False)
+    output.add_argument("--output", default="-", help="file the groups are written to (default: stdout)")
+    output.add_argument("--output-format", choices=["json", "csv"], default="json")
+    output.add_argument("--on-collision", choices=["suffix", "skip", "error"], default="suffix",
+                        help="when a moved/renamed file's new name is taken: add _1, _2..., leave it, or stop")
+
+    subparsers.add_parser("hash", parents=[common, hashing], help="hash (or incrementally rehash) folders")
+
+    dedupe = subparsers.add_parser("dedupe", parents=[common, hashing, output], help="find identical images")
+    dedupe.add_argument("--by-digest", action="store_true", help="only group byte for byte identical files")
+    dedupe.add_argument("--move-to", default=None,
+                        help="subfolder the duplicates are moved to, keeping the highest resolution image")
+
+    group = subparsers.add_parser("group", parents=[common, hashing, output], help="find similar images")
+    group.add_argument("--cutoff", type=int, default=None, help="(default: 12, or 10 with --sequences)")
+    group.add_argument("--success-ratio", type=float, default=None, help="(default: 0.3, or 0.6 with --sequences)")
+    group.add_argument("--grouping", choices=dil.GROUPINGS, default="greedy",
+                       help="greedy (as the GUI), single linkage (transitive) or complete linkage (strict) groups")
+    group.add_argument("--cascade", action="store_true",
+                       help="skip pairs whose average hashes or a sample of grid squares are too far apart, faster but "
+                            "can miss a few matches")
+    group.add_argument("--sequences", action="store_true",
+                       help="group animations and videos whose frames match in order (copies and clips), the cutoff is "
+                            "per frame and the success ratio the share of frames that match (default: 10 and 0.6)")
+    group.add_argument("--regroup", default=None, metavar="EXPRESSION",
+                       help="rename the grouped images with a strfex expression, e.g. %%grp%%-%%grp_num%%")
+
+    query = subparsers.add_parser("query", parents=[common],
+                                  help="find the hashed images that new images match, as json lines")
+    query.add_argument("--images", nargs="+", type=Path, required=True, help="incoming images, in any folder")
+    query.add_argument("--cutoff", type=int, default=12)
+    query.add_argument("--success-ratio", type=float, default=0.3)
+    query.add_argument("--index", action="store_true",
+                       help="look the images up in an index saved next to the hashes (built or brought up to date "
+                            "first), faster on large folders but can miss a few matches that only just pass")
+
+    watch = subparsers.add_parser("watch", parents=[common, hashing],
+                                  help="keep hashing the images added to a folder, and print their matches as json "
+                                       "lines")
+    watch.add_argument("--cutoff", type=int, default=12)
+    watch.add_argument("--success-ratio", type=float, default=0.3)
+    watch.add_argument("--interval", type=float, default=dil.WATCH_INTERVAL,
+                       help="max seconds between listings of the folder (default: %(default)s)")
+    watch.add_argument("--settle", type=float, default=dil.WATCH_SETTLE,
+                       help="seconds a file has to be left unmodified before it is hashed (default: %(default)s)")
+    watch.add_argument("--flush-interval", type=float, default=dil.WATCH_FLUSH_INTERVAL,
+                       help="min seconds between saves of the hashes (default: %(default)s)")
+    watch.add_argument("--no-inotify", action="store_true", help="only list the folder every --interval seconds")
+
+    recover = subparsers.add_parser("recover", parents=[common],
+                                    help="finish (or roll back) file moves/renames that were interrupted")
+    recover.add_argument("--rollback", action="store_true", help="put the files back where they were instead")
+
+    export = subparsers.add_parser("export", parents=[common], help="convert the saved hashes to another format")
+    export.add_argument("--format", choices=["json", "binary"], default="json")
+
+    args = parser.parse_args(argv)
+    if getattr(args, "output", "-") != "-" and len(args.directories) > 1:
+        parser.error("--output can only be used with one directory.")
+    if args.command == "watch" and len(args.directories) > 1:
+        parser.error("watch can only be used with one directory.")
+    if getattr(args, "video", False) and dil.video_decoder() is None:
+        parser.error("--video needs PyAV, pip install av.")
+    if args.command == "group" and args.regroup is not None and args.recursive:
+        parser.error("--regroup can't be used with --recursive, groups span folders.")
+    if args.command == "group":
+        sequences = args.sequences
+        args.cutoff = (dil.FRAME_CUTOFF if sequences else 12) if args.cutoff is None else args.cutoff
+        args.success_ratio = (dil.SEQUENCE_RATIO if sequences else 0.3) if args.success_ratio is None \
+            else args.success_ratio
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    instruments = None
+    if args.report is not None or args.profile_dir is not None:
+        instruments = dil.Instruments(profile_dir=args.profile_dir)
+
+    frame_sampling = None
+    if hasattr(args, "max_frames"):
+        frame_sampling = {"max_frames": args.max_frames, "policy": args.frame_policy, "stride": args.frame_stride}
+
+    for directory in args.directories:
+        image_struct = open_struct(directory, args.cores, args.progress, args.verbose, args.store_format, instruments,
+                                   frame_sampling)
+
+        if args.command == "recover":
+            if not dil.recover_file_ops(image_struct, rollback=args.rollback):
+                print(f"Nothing to recover in {directory}.", file=sys.stderr)
+            continue
+
+        if args.command == "export":
+            image_struct.load_data()
+            if image_struct.image_data is None:
+                print(f"No saved hashes in {directory}.", file=sys.stderr)
+                continue
+            image_struct.save_data(args.format)
+            continue
+
+        if args.command == "query":
+            image_struct.load_data()
+            if image_struct.image_data is None:
+                print(f"No saved hashes in {directory}.", file=sys.stderr)
+                continue
+            index = dil.open_index(image_struct, args.cutoff, args.success_ratio) if args.index else None
+            for path, _, matches in image_struct.query(args.images, args.cutoff, args.success_ratio, index):
+                print(json.dumps({"directory": str(directory), "image": str(path), "matches": matches}), flush=True)
+            continue
+
+        if args.command == "watch":
+            watcher = dil.FolderWatcher(image_struct, args.cutoff, args.success_ratio, args.grid_density,
+                                        args.fast_decode, args.recursive, dil.media_types(args.video), args.interval,
+                                        args.settle, args.flush_interval, notify=not args.no_inotify)
+            try:
+                for filename, matches in watcher.run():  # saves the hashes on the way out, ctrl+c included.
+                    print(json.dumps({"directory": str(directory), "image": filename, "matches": matches}),
+                          flush=True)
+            except KeyboardInterrupt:
+                pass
+            continue
+
+        hash_folder(image_struct, args.grid_density, args.fast_decode, args.rehash, args.digest,
+                    dil.media_types(args.video), args.recursive)
+        if args.command == "dedupe":
+            groups = find_groups(image_struct, "identical", by_digest=args.by_digest)
+            write_groups(groups, image_struct, args.output, args.output_format)
+            if args.move_to is not None:
+                dil.move_files(args.move_to, groups, image_struct, args.on_collision)
+        elif args.command == "group":
+            groups = find_groups(image_struct, "sequences" if args.sequences else "similar", args.cutoff,
+                                 args.success_ratio, grouping=args.grouping, cascade=args.cascade)
+            write_groups(groups, image_struct, args.output, args.output_format)
+            if args.regroup is not None:
+                dil.regroup_files(groups, image_struct, dil.media_types(args.video), expression=args.regroup,
+                                  on_collision=args.on_collision)
+
+    if args.report is not None:
+        instruments.save(args.report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,62 +1,260 @@
 import collections
-import copy
+import collections.abc
+import concurrent.futures
+import contextlib
 import datetime
+import functools
+import hashlib
 import imagehash
+import itertools
 import json
+import math
+import os
+import struct
+import threading
+import time
 import traceback
 import multiprocessing as mp
+import numpy as np
 from pathlib import Path
-from PIL import Image
+from PIL import Image, ImageSequence
+
+
+IMAGE_TYPES = [".png", ".jpeg", ".jpg", ".gif", ".webp", ".apng"]  # animated ones also get frame hashes.
+VIDEO_TYPES = [".mp4", ".mov", ".mkv", ".webm", ".avi"]  # only hashed if the video decoder is installed.
+
+
+class NullSignal:
+    __slots__ = ()
+
+    def emit(self, *args):  # does nothing, for running without a GUI.
+        pass
+
+
+class CallbackSignal:
+    __slots__ = ("callback",)
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def emit(self, *args):
+        self.callback(*args)
+
+
+def make_signals(progress=None, log=None) -> dict:
+    """
+    Makes a pyqt_signals dict out of plain callbacks, so the library can be used without PyQt5.
+
+    :param progress: Optional function that takes a percentage (int).
+    :param log: Optional function that takes a log message (str).
+    :return: Returns a dict of "progress_bar" and "text_log" signals, the ones left as None do nothing.
+    """
+
+    return {"progress_bar": NullSignal() if progress is None else CallbackSignal(progress),
+            "text_log": NullSignal() if log is None else CallbackSignal(log)}
+
+
+class NullInstruments:
+    __slots__ = ()
+    enabled = False
+
+    def stage(self, name: str):  # the same no-op context manager every time, nothing is timed.
+        return _NULL_CONTEXT
+
+    def count(self, name: str, value=1):
+        pass
+
+    def merge(self, report: dict):
+        pass
+
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class Instruments:
+    enabled = True
+
+    def __init__(self, profile_dir=None):
+
+        """
+        Collects per-stage timers and counters of a run (decoding, hashing, pool transfers, saving, comparing...),
+        including the ones of the hashing processes. ImageStruct objects use NullInstruments unless given one of these,
+        so switched off instrumentation costs a no-op call per stage.
+
+        :param profile_dir: Optional folder that each hashing process dumps its cProfile stats into, as
+                            worker-<pid>.pstats.
+        """
+
+        self.profile_dir = profile_dir
+        self.timers = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+        self.counters = collections.defaultdict(int)
+        self.workers = dict()  # pid: {"busy_seconds", "batches", "idle_seconds"}
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[name] += time.perf_counter() - start
+            self.calls[name] += 1
+
+    def count(self, name: str, value=1):
+        self.counters[name] += value
+
+    def merge(self, report: dict):
+        """
+        Adds the timers and counters of a report (e.g. from a hashing process) to these ones.
+        """
+
+        for name, seconds in report.get("timers", {}).items():
+            self.timers[name] += seconds
+        for name, calls in report.get("calls", {}).items():
+            self.calls[name] += calls
+        for name, value in report.get("counters", {}).items():
+            self.counters[name] += value
+        if "pid" in report:
+            worker = self.workers.setdefault(report["pid"], {"busy_seconds": 0.0, "batches": 0})
+            worker["busy_seconds"] += report["busy_seconds"]
+            worker["batches"] += 1
+
+    def report(self) -> dict:
+        return {"timers": dict(self.timers), "calls": dict(self.calls), "counters": dict(self.counters),
+                "workers": {str(pid): worker for pid, worker in self.workers.items()}}
+
+    def save(self, path: Path):
+        """
+        Saves the report as a json file.
+        """
+
+        with open(path, "w") as json_file:
+            json.dump(self.report(), json_file, indent=4)
+
+
+def list_images(directory: Path, image_types=None) -> list:
+    """
+    Returns the sorted filenames of the images (by file extension) in a directory, without subdirectories.
+    """
+
+    image_types = IMAGE_TYPES if image_types is None else image_types
+    return sorted(entry.name for entry in os.scandir(directory)
+                  if entry.is_file() and f_type_return(entry.name, image_types) in image_types)
+
+
+LIBRARY_EXCLUDE = ("hash_data", "moved_images")  # folders scan_tree() doesn't go into, the caches and moved duplicates.
+# hidden (dot) folders, e.g. .git or .thumbnails, are never gone into either.
+
+
+def _scan_folder(root: Path, folder: str, image_types: list, exclude: tuple, root_files: bool):
+    files, subfolders = [], []
+    for entry in os.scandir(Path(root, folder)):
+        relative = f"{folder}/{entry.name}" if folder else entry.name  # "/" on every platform, the key of the image.
+        if entry.is_dir(follow_symlinks=False):
+            if entry.name not in exclude and not entry.name.startswith("."):
+                subfolders.append(relative)
+        elif entry.is_file() and (folder or root_files) and f_type_return(entry.name, image_types) in image_types:
+            files.append(relative)
+    return files, subfolders
+
+
+def scan_tree(root: Path, image_types=None, exclude=LIBRARY_EXCLUDE, max_workers=None, root_files=True) -> list:
+    """
+    Lists the images in a directory and all of its subdirectories. Every folder is listed with os.scandir on a thread
+    pool, so subtrees are scanned in parallel, which mostly helps on network drives.
+
+    :param root: The library folder.
+    :param image_types: List of image file extensions, defaults to IMAGE_TYPES.
+    :param exclude: Names of folders that are skipped, wherever they are. Symlinked and hidden (dot) folders are always
+                    skipped.
+    :param max_workers: Number of scanning threads, defaults to the ThreadPoolExecutor default.
+    :param root_files: Also lists the images directly in root, not only the ones in its subfolders.
+    :return: Returns the sorted paths of the images relative to root, with "/" separators.
+    """
+
+    image_types = IMAGE_TYPES if image_types is None else image_types
+    file_list = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(_scan_folder, root, "", image_types, exclude, root_files)}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                files, subfolders = future.result()
+                file_list.extend(files)
+                pending.update(executor.submit(_scan_folder, root, folder, image_types, exclude, root_files)
+                               for folder in subfolders)
+    return sorted(file_list)
 
 
 class ImageStruct:
-    def __init__(self, directory: Path, allowed_cpu_cores: int, pyqt_signals: dict):
+    def __init__(self, directory: Path, allowed_cpu_cores: int, pyqt_signals=None, storage_format="binary",
+                 instruments=None, frame_sampling=None):
 
         """
         An ImageStruct object, manages all image data and metadata.
 
         :param directory: pathlib Path object.
-        :param pyqt_signals: Dictionary that contains PyQt pyqtSignal signallers.
+        :param pyqt_signals: Dictionary that contains PyQt pyqtSignal signallers, see make_signals() for plain
+                             callbacks. Defaults to no signals.
+        :param storage_format: The default format of save_data(), "binary" or "json".
+        :param instruments: Optional Instruments object that times the stages of a run, see Instruments.
+        :param frame_sampling: Dict of the max_frames, policy and stride of the frames hashed from animations and
+                               videos, see frame_indices(). Defaults to FRAME_SAMPLING.
         """
 
         self.directory = directory
         self.metadata, self.image_data = None, None
         self.allowed_cpu_cores = allowed_cpu_cores
-        self.pyqt_signal_dict = pyqt_signals
-
-    def load_data(self):
+        self.pyqt_signal_dict = make_signals() if pyqt_signals is None else pyqt_signals
+        self.storage_format = storage_format
+        self.instruments = NullInstruments() if instruments is None else instruments
+        self.identical_sets = []  # sets of byte for byte identical files found by the last hash_files() call.
+        self.frame_sampling = dict(FRAME_SAMPLING, **(frame_sampling or {}))
+        self.executor = None  # optional running ProcessPoolExecutor, kept warm across calls, see FolderWatcher.
+
+    def load_data(self, file_format=None):
         """
-        Loads a json file from disk and stores the data in a ImageStruct object.
+        Loads the hash data from disk and stores the data in a ImageStruct object, either from the json file or from the
+        binary hash store (memory mapped, see load_hash_store). By default, loads whichever of the two was saved last.
 
+        :param file_format: "json", "binary" or None.
         :return: No return value
         """
 
-        if Path(self.directory, "hash_data").is_dir() and \
-                Path(self.directory, "hash_data", "fp_hash_data.json").is_file():
+        json_path = Path(self.directory, "hash_data", "fp_hash_data.json")
+        binary_path = Path(self.directory, "hash_data", "fp_hash_data.bin")
+        if file_format is None:
+            file_format = "binary" if binary_path.is_file() and \
+                (not json_path.is_file() or binary_path.stat().st_mtime_ns >= json_path.stat().st_mtime_ns) else "json"
 
-            try:
-                with open(Path(self.directory, "hash_data", "fp_hash_data.json"), "r") as json_file:
+        try:
+            if file_format == "binary" and binary_path.is_file():
+                with self.instruments.stage("load_binary"):
+                    self.metadata, self.image_data = load_hash_store(binary_path)
+
+            elif file_format == "json" and json_path.is_file():
+                with self.instruments.stage("load_json"), open(json_path, "r") as json_file:
                     json_data = json.load(json_file)
                     json_file.close()
 
-                for image_data_dict in json_data["image_data"]:
-                    json_data["image_data"][image_data_dict]["hash_list"] = \
-                        list(map(lambda x: imagehash.hex_to_hash(x),
-                                 json_data["image_data"][image_data_dict]["hash_list"]))
-                    # using imagehash.hex_to_hash to reverse the encoding.
+                with self.instruments.stage("load_json_decode_hashes"):
+                    self.image_data = ImageRecords.from_dict(json_data["image_data"])
+                    # the hex strings are packed straight into the hash columns, see int_to_hash() to reverse it.
 
                 self.metadata = json_data["metadata"]
-                self.image_data = copy.deepcopy(json_data["image_data"])
 
-                if Path(self.metadata["directory"]) != self.directory:
-                    self.pyqt_signal_dict["text_log"].emit(
-                        "Warning: the given directory and the loaded directory are not the same!")
+            else:
+                return
+
+            if Path(self.metadata["directory"]) != self.directory:
+                self.pyqt_signal_dict["text_log"].emit(
+                    "Warning: the given directory and the loaded directory are not the same!")
 
-            except WindowsError as e:
-                print(f"Error loading hashes: {e}")
-                traceback.print_exc()
+        except OSError as e:  # WindowsError is an alias of OSError, and doesn't exist on other platforms.
+            print(f"Error loading hashes: {e}")
+            traceback.print_exc()
 
-    def generate_data(self, file_list: list, grid_density=10):
+    def generate_data(self, file_list: list, grid_density=10, fast_decode=False):
 
         """
         Generates a dict that contains a list of hashes, and creates new metadata in the ImageStruct object.
@@ -64,65 +262,325 @@ class ImageStruct:
 
         :param file_list: takes a list of files.
         :param grid_density: takes an integer value as the density of grid squares of hashes generated.
+        :param fast_decode: Decodes images at a reduced resolution, see open_reduced().
         :return: No return value
         """
 
         self.pyqt_signal_dict["text_log"].emit("Loading image hashes...")
+        self.image_data = ImageRecords.from_dict(self.hash_files(file_list, grid_density, fast_decode))
+        self.metadata = {"directory": str(self.directory),
+                         "time_of_creation": f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')}",
+                         # dd/mm/yyyy hh:mm:ss
+                         "last_time_modified": f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')}",
+                         "grid_density": grid_density,
+                         "fast_decode": fast_decode}
 
-        if mp.cpu_count() > 2:
-            proc_manager = ProcessManager(self.pyqt_signal_dict)
-            num_proc = self.allowed_cpu_cores
-            workload = split_list(file_list, num_proc)
+    def hash_files(self, file_list: list, grid_density: int, fast_decode=False, skip_identical=True) -> dict:
 
-            self.pyqt_signal_dict["text_log"].emit(f"""{"-" * 30}
-CPU COUNT: {mp.cpu_count()}, PROCESS COUNT: {num_proc}""")
+        """
+        Hashes a list of files in the ImageStruct's directory, without changing the ImageStruct object.
+        Multithreading processing of images!
+
+        :param file_list: takes a list of files.
+        :param grid_density: takes an integer value as the density of grid squares of hashes generated.
+        :param fast_decode: Decodes images at a reduced resolution, see open_reduced().
+        :param skip_identical: Finds the byte for byte identical files first (see identical_files()), and only decodes
+                               one of each set, the others get copies of its hashes. The sets are kept in
+                               identical_sets, and the digests of the files that were read in their file_stat.
+        :return: Returns an image_data dict of the files.
+        """
 
-            for pid, work_list in enumerate(workload):
-                self.pyqt_signal_dict["text_log"].emit(f"Starting process {pid}...")
-                proc_manager.run(pid, self.generate_data_func, self.directory, work_list, grid_density)
+        if len(file_list) == 0:
+            return dict()
+
+        copies, digests = dict(), dict()
+        if skip_identical and len(file_list) > 1:
+            with self.instruments.stage("identical_files"):
+                self.identical_sets, digests = identical_files(self.directory, file_list)
+            copies = {filename: group[0] for group in self.identical_sets for filename in group[1:]}
+            self.instruments.count("images_copied", len(copies))
+            if copies:
+                self.pyqt_signal_dict["text_log"].emit(
+                    f"{len(copies)} files are byte for byte copies, only hashing {len(file_list) - len(copies)}.")
+        all_files, file_list = file_list, [filename for filename in file_list if filename not in copies]
+
+        if self.allowed_cpu_cores > 1 and len(file_list) > 1:
+            num_proc = min(self.allowed_cpu_cores, len(file_list))
+            batch_size = max(1, min(HASH_BATCH_SIZE, len(file_list) // (num_proc * 4)))
+            batches = [(self.directory, file_list[num:num + batch_size], grid_density, fast_decode)
+                       for num in range(0, len(file_list), batch_size)]
 
-            self.pyqt_signal_dict["text_log"].emit(f"""Returning from processes...
+            self.pyqt_signal_dict["text_log"].emit(f"""{"-" * 30}
+CPU COUNT: {mp.cpu_count()}, PROCESS COUNT: {num_proc}, BATCHES: {len(batches)}""")
+
+            img_data = dict()
+            proc_manager = ProcessManager(self.pyqt_signal_dict, self.instruments)
+            instrument_args = (self.instruments.enabled, getattr(self.instruments, "profile_dir", None))
+            start = time.perf_counter()
+            for batch_data, report in proc_manager.imap(
+                    hash_batch, [args + instrument_args + (self.frame_sampling,) for args in batches], num_proc,
+                    executor=self.executor):
+                img_data.update(batch_data)
+                self.instruments.merge(report)
+                self.pyqt_signal_dict["progress_bar"].emit(round(100 * len(img_data) / len(file_list)))
+            for worker in getattr(self.instruments, "workers", {}).values():
+                worker["idle_seconds"] = max(0.0, time.perf_counter() - start - worker["busy_seconds"])
+
+            self.pyqt_signal_dict["text_log"].emit(f"""Returned from processes.
 {"-"*30}""")
-            return_dicts = proc_manager.wait()
-            img_data = merge_dicts(return_dicts)
 
         else:
-            img_data = self.generate_data_func(self.directory, file_list,
-                                               grid_density, pyqt_signals=self.pyqt_signal_dict)
+            img_data = self.generate_data_func(self.directory, file_list, grid_density,
+                                               pyqt_signals=self.pyqt_signal_dict, fast_decode=fast_decode,
+                                               instruments=self.instruments, frame_sampling=self.frame_sampling)
 
-        self.image_data = img_data
-        self.metadata = {"directory": str(self.directory),
-                         "time_of_creation": f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')}",
-                         # dd/mm/yyyy hh:mm:ss
-                         "last_time_modified": f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')}",
-                         "grid_density": grid_density}
+        for filename, source in copies.items():
+            img_data[filename] = dict(img_data[source], filename=filename,
+                                      file_stat=file_fingerprint(Path(self.directory, filename)))
+        for filename, digest in digests.items():
+            img_data[filename]["file_stat"]["digest"] = digest
+        return {image: img_data[image] for image in all_files}  # file list order, whichever batch finished first.
+
+    def update_data(self, file_list: list, grid_density=None, digest=False, fast_decode=None):
+
+        """
+        Incrementally updates the image data of the ImageStruct object, only hashing files that are new or changed since
+        they were last hashed, and dropping the files that are gone. A file is unchanged if its size, mtime and inode
+        (and content digest, if enabled) match the fingerprint stored with its hashes.
+        Loads the saved data first if nothing is loaded, and rehashes everything if the grid density or decode mode is
+        different.
+
+        :param file_list: takes a list of all the files in the folder.
+        :param grid_density: the grid density, defaults to the grid density of the loaded data (or 10).
+        :param digest: Also compares a content digest of the files whose size/mtime/inode changed, so files that are
+                       only touched or copied back aren't rehashed.
+        :param fast_decode: Decodes images at a reduced resolution, defaults to the mode of the loaded data.
+        :return: No return value
+        """
+
+        if self.image_data is None:
+            self.load_data()
+        if grid_density is None:
+            grid_density = self.metadata["grid_density"] if self.metadata is not None else 10
+        if fast_decode is None:
+            fast_decode = self.metadata.get("fast_decode", False) if self.metadata is not None else False
+        if self.image_data is None or self.metadata["grid_density"] != grid_density or \
+                self.metadata.get("fast_decode", False) != fast_decode:
+            self.generate_data(file_list, grid_density, fast_decode)
+            if digest:
+                for filename in self.image_data:
+                    self.image_data[filename]["file_stat"]["digest"] = file_digest(Path(self.directory, filename))
+            return
+
+        file_set = set(file_list)
+        removed = [filename for filename in self.image_data if filename not in file_set]
+        for filename in removed:
+            del self.image_data[filename]
+
+        new, changed = [], []
+        for filename in file_list:
+            fingerprint = file_fingerprint(Path(self.directory, filename))
+            if filename not in self.image_data:
+                new.append(filename)
+                continue
+            old_fingerprint = self.image_data[filename].get("file_stat")
+            if old_fingerprint is None:  # hashed before fingerprints were stored.
+                if modified_before_saved(self.metadata, fingerprint["mtime_ns"]):
+                    self.image_data[filename]["file_stat"] = fingerprint  # adopting the loaded hashes.
+                else:
+                    changed.append(filename)
+            elif any(old_fingerprint[key] != fingerprint[key] for key in ("st_size", "mtime_ns", "inode")):
+                if digest and old_fingerprint.get("digest") == file_digest(Path(self.directory, filename)):
+                    fingerprint["digest"] = old_fingerprint["digest"]
+                    self.image_data[filename]["file_stat"] = fingerprint  # same contents, only the stat changed.
+                else:
+                    changed.append(filename)
+
+        self.pyqt_signal_dict["text_log"].emit(
+            f"Updating hashes: {len(new)} new, {len(changed)} changed, {len(removed)} removed.")
+        self.image_data.update(self.hash_files(new + changed, grid_density, fast_decode))
+        if digest:
+            for filename in self.image_data:
+                if "digest" not in self.image_data[filename]["file_stat"]:
+                    self.image_data[filename]["file_stat"]["digest"] = file_digest(Path(self.directory, filename))
+        self.metadata["last_time_modified"] = f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')}"
+
+    def seed_data(self, file_list: list, grid_density: int, fast_decode=False) -> int:
+
+        """
+        Fills in the image data of library files (relative paths, see scan_tree()) from the saved hashes of the folders
+        they are in, so a library made of already hashed folders doesn't have to be rehashed. Only the hashes of files
+        that aren't in the image data yet, and that were made with the same grid density and decode mode, are taken.
+        Their fingerprints are kept, so update_data() still rehashes the ones that changed since (hashes stored without
+        a fingerprint are only taken if the file is older than them).
+
+        :param file_list: takes a list of all the files in the library, relative to the ImageStruct's directory.
+        :param grid_density: The grid density of the library.
+        :param fast_decode: The decode mode of the library.
+        :return: Returns the number of images seeded.
+        """
+
+        if self.image_data is None:
+            self.image_data = ImageRecords()
+            self.metadata = {"directory": str(self.directory),
+                             "time_of_creation": f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')}",
+                             "last_time_modified": f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')}",
+                             "grid_density": grid_density,
+                             "fast_decode": fast_decode}
+
+        folders = collections.defaultdict(list)
+        for relative in file_list:
+            if relative not in self.image_data:
+                folder, _, filename = relative.rpartition("/")
+                folders[folder].append(filename)
+
+        seeded = 0
+        for folder, filenames in folders.items():
+            if folder == "" or not check_data_exists(Path(self.directory, folder)):
+                continue  # the library's own cache is the one loaded into the ImageStruct.
+            folder_struct = ImageStruct(Path(self.directory, folder), 1, instruments=self.instruments)
+            folder_struct.load_data()
+            if folder_struct.image_data is None or folder_struct.metadata["grid_density"] != grid_density or \
+                    folder_struct.metadata.get("fast_decode", False) != fast_decode:
+                continue
+            for filename in filenames:
+                if filename in folder_struct.image_data:
+                    entry = dict(folder_struct.image_data[filename], filename=f"{folder}/{filename}")
+                    if "file_stat" not in entry:  # hashed before fingerprints were stored, see update_data().
+                        entry["file_stat"] = file_fingerprint(Path(self.directory, folder, filename))
+                        if not modified_before_saved(folder_struct.metadata, entry["file_stat"]["mtime_ns"]):
+                            continue
+                    self.image_data[f"{folder}/{filename}"] = entry
+                    seeded += 1
+        self.instruments.count("images_seeded", seeded)
+        return seeded
+
+    def update_library(self, grid_density=None, digest=False, fast_decode=None, image_types=None, root_files=True):
+
+        """
+        Incrementally updates the image data of every image in the ImageStruct's directory and all of its
+        subdirectories, keyed by their paths relative to the directory, in one store saved in the directory. Images in
+        folders with saved hashes of their own are seeded from them (see seed_data()), the rest are hashed.
+
+        :param grid_density: the grid density, defaults to the grid density of the loaded data (or 10).
+        :param digest: see update_data().
+        :param fast_decode: see update_data().
+        :param image_types: List of image file extensions, defaults to IMAGE_TYPES.
+        :param root_files: Also takes the images directly in the directory, not only the ones in its folders.
+        :return: Returns the list of images in the library.
+        """
+
+        self.pyqt_signal_dict["text_log"].emit("Scanning the library...")
+        with self.instruments.stage("scan_tree"):
+            file_list = scan_tree(self.directory, image_types, root_files=root_files)
+        if self.image_data is None:
+            self.load_data()
+        if grid_density is None:
+            grid_density = self.metadata["grid_density"] if self.metadata is not None else 10
+        if fast_decode is None:
+            fast_decode = self.metadata.get("fast_decode", False) if self.metadata is not None else False
+        if self.metadata is not None and (self.metadata["grid_density"] != grid_density or
+                                          self.metadata.get("fast_decode", False) != fast_decode):
+            self.metadata, self.image_data = None, None  # made with other settings, starting over from the folders.
+
+        with self.instruments.stage("seed_data"):
+            seeded = self.seed_data(file_list, grid_density, fast_decode)
+        self.pyqt_signal_dict["text_log"].emit(f"{len(file_list)} images in the library, {seeded} seeded from folders.")
+        self.update_data(file_list, grid_density, digest, fast_decode)
+        self.metadata["library"] = True
+        return file_list
+
+    def query(self, paths: list, cutoff=0, success_ratio=0.3, index=None):
+
+        """
+        Finds the stored images that each of a batch of incoming images matches (compare_hashes() similar mode),
+        without adding them to the ImageStruct. Only the incoming images are hashed, with the grid density and decode
+        mode of the metadata, and each one is compared with a vectorized scan of the stored hashes. With an index, it's
+        only compared with its candidates in the index, which is faster on large libraries but can miss the images that
+        only just match, see HashIndex.
+
+        :param paths: List of paths of the incoming images, in any folder.
+        :param cutoff: A grid square matches if its hamming distance is below the cutoff.
+        :param success_ratio: Ratio of grid squares that must match for the images to match.
+        :param index: Optional HashIndex of the ImageStruct's image_data, built with the same cutoff and success_ratio,
+                      e.g. from open_index().
+        :return: Yields a tuple of (path, image_data dict entry of the incoming image, list of matching filenames) as
+                 each image is hashed and compared, in the order of paths.
+        """
+
+        if self.image_data is None:
+            self.load_data()
+        if self.image_data is None:
+            raise ValueError(f"No hash data in {self.directory}, hash the folder first.")
+
+        grid_density = self.metadata["grid_density"]
+        fast_decode = self.metadata.get("fast_decode", False)
+        with self.instruments.stage("pack_hashes"):
+            names, matrix = pack_hashes(self.image_data)
+        rows = {name: num for num, name in enumerate(names)}
+        required = round(matrix.shape[1] * success_ratio)
+
+        paths = {str(Path(path).absolute()): Path(path) for path in paths}  # keyed by absolute path, never a filename.
+        batches = [(Path(), [key], grid_density, fast_decode) for key in paths]
+        if self.allowed_cpu_cores > 1 and len(paths) > 1:
+            proc_manager = ProcessManager(self.pyqt_signal_dict, self.instruments)
+            instrument_args = (self.instruments.enabled, getattr(self.instruments, "profile_dir", None))
+            results = (batch_data for batch_data, report in
+                       proc_manager.imap(hash_batch,
+                                         [args + instrument_args + (self.frame_sampling,) for args in batches],
+                                         min(self.allowed_cpu_cores, len(paths)), executor=self.executor,
+                                         ordered=True))
+        else:
+            results = (self.generate_data_func(directory, file_list, grid_density, fast_decode=fast_decode,
+                                               instruments=self.instruments, frame_sampling=self.frame_sampling)
+                       for directory, file_list, grid_density, fast_decode in batches)
+
+        for num, batch_data in enumerate(results, start=1):
+            (key, data), = batch_data.items()
+            candidates = None
+            if index is not None:  # the key isn't a stored filename, so a copy with the same name isn't left out.
+                candidates = [rows[name] for name in index.candidates({key: data})[key] if name in rows]
+            with self.instruments.stage("compare"):
+                matches = match_rows(matrix, pack_hashes({key: data})[1][0], cutoff, required, candidates)
+            self.instruments.count("pairs_compared", len(names) if candidates is None else len(candidates))
+            self.pyqt_signal_dict["progress_bar"].emit(round(100 * num / len(paths)))
+            yield paths[key], data, [names[row] for row in matches]
 
     @staticmethod
-    def generate_data_func(directory: Path, file_list: list, grid_density: int, queue=None, pid=None, pyqt_signals=None):
+    def generate_data_func(directory: Path, file_list: list, grid_density: int, queue=None, pid=None, pyqt_signals=None,
+                           fast_decode=False, instruments=None, frame_sampling=None):
 
+        instruments = NullInstruments() if instruments is None else instruments
+        frame_sampling = dict(FRAME_SAMPLING, **(frame_sampling or {}))
         output_hashes = dict()
         for num, image in enumerate(file_list, start=1):
-            _ = Image.open(Path(directory, image))
-            x, y = _.size
-            hash_list = list()
-            for x_grid in range(grid_density):  # -1 since we're going by intersections of the grid, not the grid itself
-                for y_grid in range(grid_density):
-                    hash_list.append(imagehash.average_hash(_.crop(
-                        ((x_grid * (x / grid_density)), (y_grid * (y / grid_density)),
-                         ((x_grid + 1) * (x / grid_density)), ((y_grid + 1) * (y / grid_density)))
-                    )))
-
-            # [left, upper, right, lower] for the PIL Image.crop() method. OLD
-            # Now it generates a grid, where each part of the grid is averaged. NEW
-            # looking at small sections of the image vs. the whole image
-            # since the bg shouldn't change that much
-
-            output_hashes[image] = {"filename": image, "size": _.size, "average_hash": str(imagehash.average_hash(_)),
-                                    "hash_list": hash_list}
-            _.close()
+            if f_type_return(image, VIDEO_TYPES) in VIDEO_TYPES:
+                output_hashes[image] = hash_video(Path(directory, image), grid_density, frame_sampling, instruments)
+                output_hashes[image]["filename"] = image
+            else:
+                with instruments.stage("decode"):
+                    _ = Image.open(Path(directory, image))
+                    size = _.size  # the size before any reduced decoding.
+                    decoded = open_reduced(_, grid_density) if fast_decode else _
+                    decoded.load()
+                with instruments.stage("hash_tiles"):
+                    average_hash, hash_list = grid_hashes(decoded, grid_density)
+                    # the image is decoded and grayscaled once, then every grid square is averaged in a single pass.
+                    # looking at small sections of the image vs. the whole image
+                    # since the bg shouldn't change that much
+
+                output_hashes[image] = {"filename": image, "size": size, "average_hash": str(average_hash),
+                                        "hash_list": hash_list, "file_stat": file_fingerprint(Path(directory, image))}
+                if getattr(_, "is_animated", False) and frame_sampling["max_frames"] > 0:  # GIF, APNG, WebP.
+                    with instruments.stage("hash_frames"):
+                        output_hashes[image]["frame_hashes"] = animation_frame_hashes(_, **frame_sampling)
+                    instruments.count("frames_hashed", len(output_hashes[image]["frame_hashes"]))
+                _.close()
+            instruments.count("images_decoded")
+            instruments.count("bytes_read", output_hashes[image]["file_stat"]["st_size"])
             if queue is not None:
                 queue.put(Msg("pyqt_signal", ["progress_bar", round(100 * num / len(file_list))]))
-            else:
+            elif pyqt_signals is not None:
                 pyqt_signals["progress_bar"].emit(round(100 * num / len(file_list)))
         if queue is not None:
             queue.put(Msg("return_data", output_hashes))
@@ -130,26 +588,18 @@ CPU COUNT: {mp.cpu_count()}, PROCESS COUNT: {num_proc}""")
 
         return output_hashes
 
-    def save_data(self):
+    def save_data(self, file_format=None):
 
         """
-        Saves the ImageStruct's member data into a json file, and saves it onto disk.
+        Saves the ImageStruct's member data onto disk, into a json file or a binary hash store. Either way the old file
+        is only replaced once the new one is completely written.
 
+        :param file_format: "json", "binary" or None for the ImageStruct's storage_format.
         :return: No return value
         """
 
+        file_format = file_format or self.storage_format
         self.metadata["last_time_modified"] = f"{datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')}"
-        output_dict = {"metadata": self.metadata,
-                       "image_data": self.image_data}
-
-        temp_dict = copy.deepcopy(self.image_data)
-
-        for image_data_dict in self.image_data:
-            temp_dict[image_data_dict]["hash_list"] = list(map(lambda x: str(x),
-                                                               self.image_data[image_data_dict]["hash_list"]))
-            # converting binary arrays to hex for better readability in .json (with str())
-
-        output_dict["image_data"] = copy.deepcopy(temp_dict)
 
         if not Path(self.directory, "hash_data").is_dir():
             try:
@@ -157,13 +607,29 @@ CPU COUNT: {mp.cpu_count()}, PROCESS COUNT: {num_proc}""")
             except OSError:
                 print(f"Creation of the directory 'hash_data' failed.")
         try:
-            self.pyqt_signal_dict["text_log"].emit("Saving json file...")
-            with open(Path(self.directory, "hash_data", "fp_hash_data.json"), "w") as json_file:
-                json.dump(output_dict, json_file, indent=4)
-                json_file.close()
+            if file_format == "binary":
+                self.pyqt_signal_dict["text_log"].emit("Saving hash store...")
+                with self.instruments.stage("save_binary"):
+                    save_hash_store(Path(self.directory, "hash_data", "fp_hash_data.bin"), self.metadata,
+                                    self.image_data)
+            else:
+                self.pyqt_signal_dict["text_log"].emit("Saving json file...")
+                with self.instruments.stage("save_json_encode_hashes"):
+                    output_dict = {"metadata": self.metadata,
+                                   "image_data": {filename: dict(self.image_data[filename],
+                                                                 hash_list=hash_list_hex(
+                                                                     self.image_data[filename]["hash_list"]))
+                                                  for filename in self.image_data}}
+                    # converting binary arrays to hex for better readability in .json (same as str(ImageHash))
+
+                temp_path = Path(self.directory, "hash_data", "fp_hash_data.json.tmp")
+                with self.instruments.stage("save_json"), open(temp_path, "w") as json_file:
+                    json.dump(output_dict, json_file, indent=4)
+                    json_file.close()
+                os.replace(temp_path, Path(self.directory, "hash_data", "fp_hash_data.json"))
             self.pyqt_signal_dict["text_log"].emit("Saved!")
         except:
-            self.pyqt_signal_dict["text_log"].emit("Could not save json file.")
+            self.pyqt_signal_dict["text_log"].emit(f"Could not save the {file_format} file.")
             traceback.print_exc()
 
 
@@ -171,11 +637,12 @@ Msg = collections.namedtuple('Msg', ['event', 'data'])
 
 
 class ProcessManager:
-    def __init__(self, pyqt_signal: dict):
+    def __init__(self, pyqt_signal: dict, instruments=None):
 
         self.processes = {}
         self.queue = mp.Queue()
         self.pyqt_signal = pyqt_signal
+        self.instruments = NullInstruments() if instruments is None else instruments
 
     @staticmethod
     def _wrapper(func, pid, queue, args, kwargs):
@@ -193,7 +660,8 @@ class ProcessManager:
         while not terminated:
             for _ in self.processes:
 
-                event, data = self.queue.get()
+                with self.instruments.stage("queue_get"):
+                    event, data = self.queue.get()
 
                 if event == "return_data":  # event conditionals
                     return_list.append(data)
@@ -209,6 +677,76 @@ class ProcessManager:
 
         return return_list
 
+    def imap(self, func, batches, num_proc: int, window=None, executor=None, ordered=False):
+        """
+        Runs func(*args) for every tuple of args in batches on a pool of worker processes, and yields the results as
+        they complete. Idle workers take the next batch, so one slow batch doesn't hold the others up, and at most
+        window batches are queued or running at once, so memory stays flat however many batches there are.
+
+        :param func: A picklable function.
+        :param batches: An iterable of argument tuples.
+        :param num_proc: Number of worker processes.
+        :param window: Max batches in flight, defaults to twice the number of processes.
+        :param executor: Optional running ProcessPoolExecutor to use (and leave running), instead of starting a new one
+                         and shutting it down afterwards.
+        :param ordered: Yields the results in the order of batches instead, the window still runs ahead of a slow batch.
+        :return: Yields the return values of func, in the order they complete.
+        """
+
+        batches = iter(batches)
+        with contextlib.nullcontext(executor) if executor is not None else \
+                concurrent.futures.ProcessPoolExecutor(max_workers=num_proc) as executor:
+            submitted = [executor.submit(func, *args) for args in itertools.islice(batches, window or 2 * num_proc)]
+            pending = collections.deque(submitted) if ordered else set(submitted)
+            while pending:
+                with self.instruments.stage("pool_wait"):
+                    if ordered:  # only the oldest batch is waited for, the others keep their place.
+                        concurrent.futures.wait([pending[0]])
+                        done = [pending.popleft()]
+                    else:
+                        done, pending = concurrent.futures.wait(pending,
+                                                                return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    args = next(batches, None)
+                    if args is not None:
+                        (pending.append if ordered else pending.add)(executor.submit(func, *args))
+                    with self.instruments.stage("pool_result"):
+                        result = future.result()
+                    yield result
+
+
+_WORKER_PROFILER = None  # cProfile.Profile of a hashing process, kept across its batches.
+
+
+def hash_batch(directory: Path, file_list: list, grid_density: int, fast_decode=False, instrument=False,
+               profile_dir=None, frame_sampling=None):
+    """
+    Hashes a batch of images in a hashing process, see ProcessManager.imap().
+
+    :param instrument: Times the stages of the batch.
+    :param profile_dir: Optional folder the process dumps its cumulative cProfile stats into, as worker-<pid>.pstats.
+    :param frame_sampling: see ImageStruct.
+    :return: Returns a tuple of (image_data dict, Instruments report dict, with the pid and busy time of the process).
+    """
+
+    global _WORKER_PROFILER
+    instruments = Instruments() if instrument else None
+    if profile_dir is not None:
+        import cProfile  # only imported when profiling.
+        _WORKER_PROFILER = _WORKER_PROFILER or cProfile.Profile()
+        _WORKER_PROFILER.enable()
+
+    start = time.perf_counter()
+    output_hashes = ImageStruct.generate_data_func(directory, file_list, grid_density, fast_decode=fast_decode,
+                                                   instruments=instruments, frame_sampling=frame_sampling)
+    if profile_dir is not None:
+        _WORKER_PROFILER.disable()
+        _WORKER_PROFILER.dump_stats(Path(profile_dir, f"worker-{os.getpid()}.pstats"))
+
+    if instruments is None:
+        return output_hashes, dict()
+    return output_hashes, dict(instruments.report(), pid=os.getpid(), busy_seconds=time.perf_counter() - start)
+
 
 def split_list(item_list: list, divisor: int):
     """
@@ -235,6 +773,329 @@ def merge_dicts(dict_args):
     return result
 
 
+HASH_BATCH_SIZE = 8  # max images per batch handed to a hashing process.
+RESAMPLE_PRECISION_BITS = 22  # fixed point precision of PIL's 8-bit resampler, 32 - 8 - 2.
+RESAMPLE_ROW_CHUNK = 512  # rows converted to float64 at once, keeps the memory overhead per image small.
+
+
+def _lanczos_filter(x: float) -> float:  # PIL's truncated sinc filter, with a support of 3.
+    if -3.0 <= x < 3.0:
+        a = 1.0 if x == 0.0 else math.sin(x * math.pi) / (x * math.pi)
+        x /= 3
+        b = 1.0 if x == 0.0 else math.sin(x * math.pi) / (x * math.pi)
+        return a * b
+    return 0.0
+
+
+@functools.lru_cache(maxsize=4096)
+def _resample_coeffs(in_size: int, out_size: int):
+    """
+    Builds the fixed point LANCZOS coefficients PIL uses to resize one axis from in_size to out_size pixels,
+    as a dense (out_size, in_size) matrix.
+
+    :param in_size: Number of pixels along the axis of the source.
+    :param out_size: Number of pixels along the axis of the output.
+    :return: A read-only float64 numpy array of integer coefficients.
+    """
+
+    scale = filterscale = in_size / out_size
+    if filterscale < 1.0:
+        filterscale = 1.0
+    support = 3.0 * filterscale
+    inv_scale = 1.0 / filterscale
+
+    coeffs = np.zeros((out_size, in_size))
+    for out_px in range(out_size):
+        center = (out_px + 0.5) * scale
+        x_min = max(int(center - support + 0.5), 0)
+        x_max = min(int(center + support + 0.5), in_size)
+        weights = [_lanczos_filter((x - center + 0.5) * inv_scale) for x in range(x_min, x_max)]
+        total = sum(weights)
+        for x, weight in zip(range(x_min, x_max), weights):
+            if total != 0.0:
+                weight /= total
+            # same rounding as PIL's normalize_coeffs_8bpc, truncating towards zero.
+            coeffs[out_px, x] = math.trunc((-0.5 if weight < 0 else 0.5) + weight * (1 << RESAMPLE_PRECISION_BITS))
+    coeffs.setflags(write=False)
+    return coeffs
+
+
+def _resample_pass(pixels, out_size: int, axis: int):
+    """
+    Resizes one axis of an array of 8-bit pixel values the same way PIL does, rounding and clipping to 8 bits.
+
+    :param pixels: A float64 numpy array of pixel values.
+    :param out_size: The new size of the axis.
+    :param axis: The axis to be resized, 0 for rows and 1 for columns.
+    :return: A float64 numpy array with the resized axis.
+    """
+
+    in_size = pixels.shape[axis]
+    if in_size == out_size:  # PIL skips the pass entirely if the axis isn't resized.
+        return pixels
+    if axis == 0:
+        output = np.tensordot(_resample_coeffs(in_size, out_size), pixels, axes=(1, 0))
+    else:
+        output = pixels @ _resample_coeffs(in_size, out_size).T
+    output += 1 << (RESAMPLE_PRECISION_BITS - 1)
+    # the integer sums are exact in float64, so this is bit for bit the same as PIL's clip8.
+    return np.clip(np.floor(output / (1 << RESAMPLE_PRECISION_BITS)), 0, 255)
+
+
+def _grid_edges(length: int, grid_density: int) -> list:  # same rounding as the PIL Image.crop() method.
+    return [int(round(num * (length / grid_density))) for num in range(grid_density + 1)]
+
+
+def _grid_hashes_legacy(image: Image.Image, grid_density: int):
+    x, y = image.size
+    hash_list = list()
+    for x_grid in range(grid_density):
+        for y_grid in range(grid_density):
+            hash_list.append(imagehash.average_hash(image.crop(
+                ((x_grid * (x / grid_density)), (y_grid * (y / grid_density)),
+                 ((x_grid + 1) * (x / grid_density)), ((y_grid + 1) * (y / grid_density)))
+            )))
+            # [left, upper, right, lower] for the PIL Image.crop() method.
+
+    return imagehash.average_hash(image), hash_list
+
+
+def grid_hashes(image: Image.Image, grid_density: int, hash_size=8):
+    """
+    Generates the average hash of a whole image, and the average hash of every square of a grid over the image.
+
+    The image is only decoded and grayscaled once, every grid square is resized with a fixed point LANCZOS filter that
+    reproduces PIL's resampler, so the hashes are bit for bit the same as imagehash.average_hash() on each
+    Image.crop() of the grid. Grids with empty squares (images smaller than the grid) use the old per square path.
+
+    :param image: A PIL Image object.
+    :param grid_density: takes an integer value as the density of grid squares of hashes generated.
+    :param hash_size: The width and height of each hash.
+    :return: Returns a tuple of (average hash of the whole image, list of grid square hashes).
+    """
+
+    gray = np.asarray(image.convert("L"))
+    height, width = gray.shape
+    x_edges, y_edges = _grid_edges(width, grid_density), _grid_edges(height, grid_density)
+
+    if min(np.diff(x_edges)) == 0 or min(np.diff(y_edges)) == 0:
+        return _grid_hashes_legacy(image, grid_density)
+
+    # horizontal pass over every column of grid squares, plus the whole image as the last column.
+    columns = np.empty((height, grid_density + 1, hash_size))
+    for start in range(0, height, RESAMPLE_ROW_CHUNK):
+        chunk = gray[start:start + RESAMPLE_ROW_CHUNK].astype(np.float64)
+        for x_grid in range(grid_density):
+            columns[start:start + RESAMPLE_ROW_CHUNK, x_grid] = \
+                _resample_pass(chunk[:, x_edges[x_grid]:x_edges[x_grid + 1]], hash_size, axis=1)
+        columns[start:start + RESAMPLE_ROW_CHUNK, grid_density] = _resample_pass(chunk, hash_size, axis=1)
+
+    # vertical pass over every row of grid squares, tiles[x_grid, y_grid] is an 8x8 array of pixels.
+    tiles = np.empty((grid_density, grid_density, hash_size, hash_size))
+    for y_grid in range(grid_density):
+        rows = _resample_pass(columns[y_edges[y_grid]:y_edges[y_grid + 1], :grid_density], hash_size, axis=0)
+        tiles[:, y_grid] = rows.transpose(1, 0, 2)
+    whole = _resample_pass(columns[:, grid_density], hash_size, axis=0)
+
+    tile_bits = tiles > tiles.mean(axis=(2, 3), keepdims=True)
+    hash_list = [imagehash.ImageHash(bits) for bits in tile_bits.reshape(-1, hash_size, hash_size)]
+    return imagehash.ImageHash(whole > whole.mean()), hash_list
+
+
+FAST_DECODE_TILE_PIXELS = 32  # min width and height of a grid square when decoding at a reduced resolution.
+REDUCE_MODES = ("L", "LA", "RGB", "RGBA", "RGBX", "CMYK", "YCbCr", "I", "F")  # modes Image.reduce() can average.
+
+
+def open_reduced(image: Image.Image, grid_density: int, tile_pixels=FAST_DECODE_TILE_PIXELS) -> Image.Image:
+    """
+    Decodes an image at the smallest resolution where every grid square is still at least tile_pixels wide and high.
+    JPEGs are scaled down by the decoder itself (DCT scaling by 1/2, 1/4 or 1/8, straight to grayscale) with
+    Image.draft(), so the full resolution image is never in memory. Other formats are decoded in full, then shrunk
+    with Image.reduce() before hashing, palette, bilevel and 16 bit images are grayscaled first (reduce() either can't
+    average them or would average palette indices). The hashes are close to, but not the same as, the full resolution
+    hashes, see compare_fast_decode().
+
+    :param image: A PIL Image object that hasn't been loaded yet (straight from Image.open()).
+    :param grid_density: takes an integer value as the density of grid squares of hashes generated.
+    :param tile_pixels: Min width and height of a grid square.
+    :return: Returns a PIL Image object.
+    """
+
+    min_size = grid_density * tile_pixels
+    if image.format == "JPEG":
+        image.draft("L", (min_size, min_size))  # picks the largest scale that keeps the image at least min_size.
+        return image
+
+    factor = min(image.size) // min_size
+    if factor <= 1:
+        return image
+    if image.mode not in REDUCE_MODES:
+        image = image.convert("L")  # grid_hashes() grayscales anyway.
+    return image.reduce(factor)
+
+
+def compare_fast_decode(directory: Path, file_list: list, grid_density=10) -> dict:
+    """
+    Reports how far the hashes of reduced resolution decoding (open_reduced) are from the full resolution hashes.
+
+    :param directory: pathlib Path object.
+    :param file_list: takes a list of files.
+    :param grid_density: takes an integer value as the density of grid squares of hashes generated.
+    :return: Returns a dict of the mean and max hamming distance of the average hashes and grid square hashes, the
+             fraction of grid square hashes that differ at all, and the time taken by both decodes.
+    """
+
+    average_distances, tile_distances, times = [], [], {"full": 0.0, "fast": 0.0}
+    for image in file_list:
+        hashes = dict()
+        for mode in ("full", "fast"):
+            start = time.perf_counter()
+            with Image.open(Path(directory, image)) as _:
+                hashes[mode] = grid_hashes(open_reduced(_, grid_density) if mode == "fast" else _, grid_density)
+            times[mode] += time.perf_counter() - start
+        average_distances.append(hashes["full"][0] - hashes["fast"][0])
+        tile_distances.extend(full - fast for full, fast in zip(hashes["full"][1], hashes["fast"][1]))
+
+    return {"images": len(file_list),
+            "average_hash_mean_distance": float(np.mean(average_distances)) if file_list else 0.0,
+            "average_hash_max_distance": int(max(average_distances, default=0)),
+            "tile_mean_distance": float(np.mean(tile_distances)) if file_list else 0.0,
+            "tile_max_distance": int(max(tile_distances, default=0)),
+            "tile_changed_ratio": float(np.mean(np.array(tile_distances) > 0)) if file_list else 0.0,
+            "full_decode_seconds": times["full"], "fast_decode_seconds": times["fast"]}
+
+
+FRAME_SAMPLING = {"max_frames": 16, "policy": "uniform", "stride": 1}  # frames hashed per animation or video.
+FRAME_POLICIES = ("uniform", "first", "stride")
+
+
+def frame_indices(frame_count: int, max_frames=16, policy="uniform", stride=1) -> list:
+    """
+    Picks the frames of an animation that are hashed, at most max_frames of them however long it is.
+
+    :param frame_count: Number of frames of the animation.
+    :param max_frames: Max number of frames picked.
+    :param policy: "uniform" spreads them evenly from the first to the last frame (the same number of frames for any
+                   length, so speed ups and slow downs still line up), "first" takes the first ones, and "stride" takes
+                   every stride-th frame from the start (the same frame spacing for any length, so a clip of an
+                   animation still lines up with it).
+    :param stride: Frame spacing of the stride policy.
+    :return: Returns a sorted list of frame indices.
+    """
+
+    if policy not in FRAME_POLICIES:
+        raise ValueError(f"Unknown frame sampling policy: {policy}")
+    count = min(max_frames, frame_count)
+    if policy == "first" or count <= 1:
+        return list(range(count))
+    if policy == "uniform":
+        return sorted({round(num * (frame_count - 1) / (count - 1)) for num in range(count)})
+    return list(range(0, frame_count, max(1, stride)))[:max_frames]
+
+
+def frame_hash(frame: Image.Image) -> str:  # 64 bit average hash of a whole frame, the same hex as an average_hash.
+    return str(imagehash.average_hash(frame))
+
+
+def animation_frame_hashes(image: Image.Image, max_frames=16, policy="uniform", stride=1) -> list:
+    """
+    Hashes a sample of the frames of an animated GIF, APNG or WebP (see frame_indices()). The frames are read lazily
+    through ImageSequence, which seeks the one Image object from frame to frame, and each sampled frame is hashed as
+    soon as it is decoded, so only one frame is ever held in memory however long the animation is.
+
+    :param image: A PIL Image object of an animated image.
+    :return: Returns the list of frame hashes (hex strings), in frame order. The image is left on its first frame.
+    """
+
+    frames = ImageSequence.Iterator(image)
+    hashes = [frame_hash(frames[index]) for index in
+              frame_indices(getattr(image, "n_frames", 1), max_frames, policy, stride)]
+    image.seek(0)
+    return hashes
+
+
+def video_decoder():  # PyAV (pip install av), the optional video decoder, or None if it isn't installed.
+    try:
+        import av
+    except ImportError:
+        return None
+    return av
+
+
+def media_types(video=None) -> list:
+    """
+    :param video: Also includes VIDEO_TYPES, defaults to whether the video decoder is installed.
+    :return: Returns the list of file extensions that can be hashed.
+    """
+
+    if video is None:
+        video = video_decoder() is not None
+    return IMAGE_TYPES + VIDEO_TYPES if video else list(IMAGE_TYPES)
+
+
+def video_frames(path: Path, max_frames=16, policy="uniform", stride=1):
+    """
+    Decodes a sample of the keyframes of a video with the optional video decoder (see video_decoder()), one at a time.
+    Only keyframes are decoded (the decoder skips every other frame), and at most max_frames of them.
+
+    uniform seeks to max_frames evenly spaced timestamps and takes the keyframe at or before each one (or the first
+    keyframes, if the length of the video isn't known), first takes the first keyframes and stride every stride-th
+    keyframe.
+
+    :param path: Path of the video file.
+    :return: Yields PIL Image objects of the sampled frames, in order.
+    """
+
+    if policy not in FRAME_POLICIES:
+        raise ValueError(f"Unknown frame sampling policy: {policy}")
+    av = video_decoder()
+    if av is None:
+        raise ImportError(f"Hashing {path} needs the video decoder PyAV (pip install av).")
+
+    with av.open(str(path)) as container:
+        stream = container.streams.video[0]
+        stream.codec_context.skip_frame = "NONKEY"
+        if policy == "uniform" and stream.duration:
+            last_pts = None
+            for num in range(max_frames):
+                container.seek((stream.start_time or 0) + stream.duration * num // max_frames, stream=stream)
+                frame = next(container.decode(stream), None)
+                if frame is None:
+                    break
+                if frame.pts != last_pts:  # timestamps between the same two keyframes seek to the same one.
+                    yield frame.to_image()
+                last_pts = frame.pts
+        else:
+            step = max(1, stride) if policy == "stride" else 1
+            keyframes = (frame for num, frame in enumerate(container.decode(stream)) if num % step == 0)
+            for frame in itertools.islice(keyframes, max_frames):
+                yield frame.to_image()
+
+
+def hash_video(path: Path, grid_density: int, frame_sampling=None, instruments=None) -> dict:
+    """
+    Hashes a video like an animation: the first sampled keyframe gets the grid hashes of an image, and every sampled
+    keyframe (see video_frames()) a frame hash.
+
+    :return: Returns an image_data dict entry, with frame_hashes.
+    """
+
+    instruments = NullInstruments() if instruments is None else instruments
+    frame_sampling = dict(FRAME_SAMPLING, **(frame_sampling or {}))
+    frames = video_frames(path, **dict(frame_sampling, max_frames=max(1, frame_sampling["max_frames"])))
+    with instruments.stage("decode_video"):
+        first = next(frames, None)
+    if first is None:
+        raise OSError(f"No frames could be decoded from {path}.")
+    with instruments.stage("hash_tiles"):
+        average_hash, hash_list = grid_hashes(first, grid_density)
+    with instruments.stage("hash_frames"):
+        frame_hashes = [frame_hash(first)] + [frame_hash(frame) for frame in frames]
+    instruments.count("frames_hashed", len(frame_hashes))
+    return {"filename": Path(path).name, "size": first.size, "average_hash": str(average_hash),
+            "hash_list": hash_list, "file_stat": file_fingerprint(path), "frame_hashes": frame_hashes}
+
+
 def f_num0(value: int,
            n: int):  # formats the int value to have n zeros before it. (method name = fNum zero, but integer)
     try:
@@ -329,7 +1190,7 @@ def rename_to_num(directory: Path, file_list: list, format_string: str, file_typ
         try:
             Path(directory, file).rename(
                 Path(directory, format_string + str(num) + f_type_return(file, file_type_list)))
-        except WindowsError:
+        except OSError:  # WindowsError, e.g. the new name is taken.
             try:
                 Path(directory, file).rename(Path(directory, "_temp_" + str(num) + f_type_return(file, file_type_list)))
             except Exception as e:
@@ -386,11 +1247,17 @@ def compare_hashes(hash_input_1: dict, hash_input_2: dict, kwargs):
     Compares two dicts of hashes, and returns a true value if the number of successful matches exceed the success ratio.
 
     The threshold for matching depends on the cutoff.
-    There is two modes: similar and identical.
+    There is three modes: similar, identical and cascade.
+
+    cascade is similar mode done coarse to fine: pairs whose average hashes are further apart than average_radius are
+    rejected outright, then a sample of sample_size evenly spread grid squares is checked and pairs where less than
+    sample_ratio of them match are rejected, then the remaining grid squares are checked, stopping as soon as the
+    success ratio is met or can no longer be met. With average_radius 64 and sample_ratio 0 it gives the same result as
+    similar mode. A collections.Counter passed as stats counts the stage each pair was decided at.
 
     :param hash_input_1: Hash dict 1
     :param hash_input_2: Hash dict 2
-    :param kwargs: success ratio, cutoff, mode
+    :param kwargs: success ratio, cutoff, mode, and for cascade mode: average_radius, sample_size, sample_ratio, stats
     :return: True or False
     """
     score = 0
@@ -414,14 +1281,95 @@ def compare_hashes(hash_input_1: dict, hash_input_2: dict, kwargs):
         # reinstate this.
 
     elif mode == "similar":
+        if isinstance(hash_input_1["hash_list"], HashRow) and isinstance(hash_input_2["hash_list"], HashRow):
+            # packed hashes, e.g. ImageRecords views: every grid square at once, with no ImageHash objects made.
+            score = int((_popcount64(hash_input_1["hash_list"].row ^ hash_input_2["hash_list"].row) < cutoff).sum())
+            return score >= round(len(hash_input_1["hash_list"]) * success_ratio)
+
         for index in range(len(hash_input_1["hash_list"])):
             if abs(hash_input_1["hash_list"][index] - hash_input_2["hash_list"][index]) < cutoff:
                 score += 1
 
         return score >= round(len(hash_input_1["hash_list"]) * success_ratio)
 
+    elif mode == "cascade":
+        return _compare_cascade(hash_input_1, hash_input_2, cutoff,
+                                round(len(hash_input_1["hash_list"]) * success_ratio),
+                                kwargs.get("average_radius", CASCADE_AVERAGE_RADIUS),
+                                kwargs.get("sample_size", CASCADE_SAMPLE_SIZE),
+                                kwargs.get("sample_ratio", CASCADE_SAMPLE_RATIO), kwargs.get("stats"))
+
+
+CASCADE_AVERAGE_RADIUS = 24  # max hamming distance of the average hashes of a pair that is looked at further.
+CASCADE_SAMPLE_SIZE = 10  # grid squares checked before the rest.
+CASCADE_SAMPLE_RATIO = 0.1  # min ratio of the sampled grid squares that have to match.
+CASCADE_STAGES = ("rejected_average", "rejected_sample", "rejected_early", "accepted_early", "rejected_full",
+                  "accepted_full")
+
+
+@functools.lru_cache(maxsize=None)
+def _cascade_order(tiles: int, sample_size: int) -> tuple:  # (number of sampled grid squares, order they're checked in)
+    # a stride one more than tiles / sample_size spreads the sample diagonally over the grid, not down one column.
+    sample = list(range(0, tiles, tiles // sample_size + 1))[:sample_size] if sample_size > 0 else []
+    return len(sample), tuple(sample + [index for index in range(tiles) if index not in set(sample)])
+
+
+def _compare_cascade(hash_input_1: dict, hash_input_2: dict, cutoff: int, required: int, average_radius: int,
+                     sample_size: int, sample_ratio: float, stats=None) -> bool:
+    stats = collections.Counter() if stats is None else stats
+    stats["pairs"] += 1
+    if bin(hash_to_int(hash_input_1["average_hash"]) ^ hash_to_int(hash_input_2["average_hash"])).count("1") \
+            > average_radius:
+        stats["rejected_average"] += 1
+        return False
+    if required <= 0:
+        stats["accepted_early"] += 1
+        return True
+
+    hash_list_1, hash_list_2 = hash_input_1["hash_list"], hash_input_2["hash_list"]
+    if isinstance(hash_list_1, HashRow) and isinstance(hash_list_2, HashRow):  # plain ints, no ImageHash objects.
+        hash_list_1, hash_list_2 = hash_list_1.row.tolist(), hash_list_2.row.tolist()
+
+        def distance(index):
+            return bin(hash_list_1[index] ^ hash_list_2[index]).count("1")
+    else:
+        def distance(index):
+            return abs(hash_list_1[index] - hash_list_2[index])
+    tiles = len(hash_list_1)
+    num_sampled, order = _cascade_order(tiles, sample_size)
+    score = 0
+    for checked, index in enumerate(order, start=1):
+        if distance(index) < cutoff:
+            score += 1
+        stats["tiles_compared"] += 1
+        if score >= required:
+            stats["accepted_early" if checked < tiles else "accepted_full"] += 1
+            return True
+        if score + tiles - checked < required:
+            stats["rejected_early" if checked < tiles else "rejected_full"] += 1
+            return False
+        if checked == num_sampled and score < sample_ratio * num_sampled:
+            stats["rejected_sample"] += 1
+            return False
+    return False
+
+
+def cascade_report(stats: collections.Counter, tiles: int) -> dict:
+    """
+    Summarises the stats of compare_hashes() cascade mode.
+
+    :param stats: The stats Counter passed to compare_hashes().
+    :param tiles: Number of grid squares per image.
+    :return: Returns a dict of the pairs decided at each stage, and the ratio of grid square comparisons skipped.
+    """
+
+    report = {stage: stats[stage] for stage in ("pairs",) + CASCADE_STAGES}
+    report["tiles_compared"] = stats["tiles_compared"]
+    report["pruning_rate"] = 1 - stats["tiles_compared"] / (stats["pairs"] * tiles) if stats["pairs"] * tiles else 0.0
+    return report
 
-def cross_compare_list(image_struct: ImageStruct, comparison_function, **kwargs) -> list:
+
+def cross_compare_list(image_struct: ImageStruct, comparison_function, index=None, **kwargs) -> list:
     # cutoff 0, a 12 to 10 density is ideal, crosschecking a nested list of hashes.
     # Potential improvements could be to rework this so it can take a function as the comparing function so it can
     # compare with different data sets. Input the file list.
@@ -432,6 +1380,7 @@ def cross_compare_list(image_struct: ImageStruct, comparison_function, **kwargs)
 
     :param image_struct: Takes an ImageStruct object in
     :param comparison_function: Takes a comparison function that compares the inputs
+    :param index: Optional HashIndex, only its candidate pairs are compared (similar mode).
     :param kwargs: Arguments that pass off into the comparison function.
     :return: Returns a 2 element list of [duplicate items, grouped duplicate items]
     """
@@ -440,12 +1389,31 @@ def cross_compare_list(image_struct: ImageStruct, comparison_function, **kwargs)
     g_dupe_items = []
     item_list = image_struct.image_data
     image_struct.pyqt_signal_dict["text_log"].emit(f"Cross checking for {kwargs['mode']} duplicates...")
+    if kwargs["mode"] == "cascade" and "stats" not in kwargs:
+        kwargs["stats"] = collections.Counter()
+
+    candidates = None
+    if index is not None:
+        order = {name: num for num, name in enumerate(item_list)}
+        candidates = collections.defaultdict(list)
+        for item_1, item_2 in index.candidate_pairs():
+            if item_1 in order and item_2 in order:
+                candidates[item_1].append(item_2)
+                candidates[item_2].append(item_1)
+        for item_1 in candidates:
+            candidates[item_1].sort(key=order.__getitem__)  # same order as a full scan.
+
+    if candidates is not None:
+        image_struct.instruments.count("pairs_pruned", len(item_list) * (len(item_list) - 1) // 2 -
+                                       sum(map(len, candidates.values())) // 2)
+
     for num, item_1 in enumerate(item_list, start=1):
         group = []
         if item_1 not in dupe_items:
-            for item_2 in item_list:
+            for item_2 in (item_list if candidates is None else candidates[item_1]):
                 if item_1 != item_2 and item_2 not in dupe_items:
 
+                    image_struct.instruments.count("pairs_compared")
                     if (comparison_function(item_list[item_1],
                                             item_list[item_2], kwargs)):
                         if item_1 not in dupe_items:
@@ -457,86 +1425,1853 @@ def cross_compare_list(image_struct: ImageStruct, comparison_function, **kwargs)
             if len(group) != 0:
                 g_dupe_items.append(group)
         image_struct.pyqt_signal_dict["progress_bar"].emit(round(100 * num / len(item_list)))
+    if kwargs["mode"] == "cascade" and len(item_list) != 0:
+        report = cascade_report(kwargs["stats"], len(next(iter(item_list.values()))["hash_list"]))
+        for stage in CASCADE_STAGES + ("tiles_compared",):
+            image_struct.instruments.count(stage, report[stage])
+        image_struct.pyqt_signal_dict["text_log"].emit(f"Skipped {report['pruning_rate']:.1%} of grid square checks.")
     image_struct.pyqt_signal_dict["text_log"].emit("Done!")
     return [dupe_items, g_dupe_items]
 
 
-def regroup_files(file_list: list, image_struct: ImageStruct,
-                  type_list: list, expression="%grp%-%grp_num%"):
+COMPARE_BLOCK_BYTES = 1 << 22  # size of the XOR'd hashes of one block of pairs, roughly the size of an L2/L3 cache.
+INDEX_BANDS = 3  # bands of a HashIndex, 22, 21 and 21 bits, looked up exactly.
+INDEX_HIT_RATIO = 0.25  # share of the grid squares required to match that must share a band, for a candidate.
+INDEX_MAX_BUCKET = 64  # band values shared by more images are skipped, like stop words.
+INDEX_MERGE_SIZE = 1 << 21  # hits gathered before they are summed by pair.
+_POPCOUNT_TABLE = np.array([bin(num).count("1") for num in range(256)], dtype=np.uint8)
+
+
+def _popcount64(array):  # number of set bits in each element of a uint64 array.
+    if hasattr(np, "bitwise_count"):  # numpy 2.0+
+        return np.bitwise_count(array)
+    return _POPCOUNT_TABLE[array.view(np.uint8)].reshape(*array.shape, 8).sum(axis=-1, dtype=np.uint8)
+
+
+def hash_to_int(image_hash) -> int:
+    """
+    Converts an ImageHash (or the hex string of one) into an integer, with the same bit order as str(ImageHash).
     """
 
-    :param file_list: Takes a list of files.
-    :param image_struct: Takes an ImageStruct object.
-    :param type_list: Takes a list of file types.
-    :param expression: A string formatted expression, or strfex. Check the strfex function for more info.
-    :return: No return value
+    if isinstance(image_hash, str):
+        return int(image_hash, 16)
+    return int.from_bytes(np.packbits(image_hash.hash.flatten()).tobytes(), "big")
+
+
+def int_to_hash(value: int, hash_size=8):
+    """
+    Converts an integer back into an ImageHash, the reverse of hash_to_int().
     """
 
-    for i, file_list_2 in enumerate(file_list):
-        for i2, filename in enumerate(file_list_2):
-            try:
-                if f_type_return(filename, type_list) in type_list:
-                    Path(image_struct.directory, filename).rename(Path(image_struct.directory,
-                                                                       strfex(expression, grp=i,
-                                                                              grp_num=i2) + f_type_return(filename,
-                                                                                                          type_list)))
-                    image_struct.image_data[
-                        strfex(expression, grp=i, grp_num=i2) + f_type_return(filename, type_list)] = \
-                        image_struct.image_data[filename]  # renaming the key associated with the filename.
-                    del image_struct.image_data[filename]  # deleting old reference
-            except Exception as e:
-                image_struct.pyqt_signal_dict["text_log"].emit("regroup_files error: " + str(e))
-        image_struct.pyqt_signal_dict["progress_bar"].emit(round(100 * (i + 1) / len(file_list)))
-    image_struct.save_data()
+    bits = np.unpackbits(np.frombuffer(int(value).to_bytes(hash_size * hash_size // 8, "big"), dtype=np.uint8))
+    return imagehash.ImageHash(bits.astype(bool).reshape(hash_size, hash_size))
 
 
-def product(x): return x[0] * x[1]  # can be tuple/list
+class HashRow(collections.abc.Sequence):
+    __slots__ = ("row",)
 
+    def __init__(self, row):
 
-def move_files(new_folder: str, file_list: list, image_struct: ImageStruct):
-    """
+        """
+        A hash_list backed by a row of packed uint64 hashes, e.g. a row of a memory mapped hash store. ImageHash objects
+        are only made when an item is accessed.
 
-    Moves a list of files to a subdirectory in the current working directory, then returns the altered ImageStruct
-    object, without the moved files in the concerned image_data dict.
+        :param row: A 1-D uint64 numpy array.
+        """
 
-    :param new_folder: Name of the to-be-created subdirectory in the current working directory.
-    :param file_list: Takes a list of files to be moved.
-    :param image_struct: An ImageStruct object.
-    :return: Returns an ImageStruct object.
-    """
+        self.row = row
 
-    try:
-        Path(image_struct.directory, new_folder).mkdir(exist_ok=True)
-    except OSError:
-        image_struct.pyqt_signal_dict["text_log"].emit(f"Creation of the directory '{new_folder}' failed.")
-    else:
-        image_struct.pyqt_signal_dict["text_log"].emit("Successfully created the directory.")
+    def __len__(self):
+        return len(self.row)
 
-    image_struct.pyqt_signal_dict["text_log"].emit("Moving duplicates...")
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [int_to_hash(value) for value in self.row[index]]
+        return int_to_hash(self.row[index])
 
-    try:
-        if Path(image_struct.directory, new_folder).is_dir():
-            for num, grouped_files in enumerate(file_list, start=1):
-                HQ_image = grouped_files[0]  # setting HQ image as first
-                for file in grouped_files:
-                    if product(image_struct.image_data[file]["size"]) > product(
-                            image_struct.image_data[HQ_image]["size"]):
-                        HQ_image = file  # higher quality, set new HQ file
-
-                for file in grouped_files:
-                    if file != HQ_image:  # If the file isn't the HQ one, it moves all exact dupes to another folder.
-                        Path(image_struct.directory, file).rename(Path(image_struct.directory, new_folder, file))
-                        for filename in image_struct.image_data:  # deleting moved files' hashes
-                            if filename == file:
-                                del image_struct.image_data[filename]
-                                break
-
-                image_struct.pyqt_signal_dict["progress_bar"].emit(round(100 * num / len(file_list)))
-            image_struct.pyqt_signal_dict["text_log"].emit("Done!")
-    except Exception as e:
-        print(e)
+    def __iter__(self):
+        return (int_to_hash(value) for value in self.row)
 
-    return image_struct
+
+def hash_list_hex(hash_list) -> list:  # the hex strings of a hash_list, as str(ImageHash) gives them.
+    if isinstance(hash_list, HashRow):
+        return [f"{int(value):016x}" for value in hash_list.row]
+    return [str(image_hash) for image_hash in hash_list]
+
+
+def pack_hash_list(hash_list):
+    """
+    Packs one hash_list (ImageHash objects, their hex strings, or a HashRow) into a 1-D uint64 array.
+    """
+
+    if isinstance(hash_list, HashRow):  # already packed, e.g. loaded from a hash store.
+        return hash_list.row
+    if len(hash_list) != 0 and isinstance(hash_list[0], str):
+        return np.array([int(value, 16) for value in hash_list], dtype=np.uint64)
+    if len(hash_list) == 0:
+        return np.empty(0, dtype=np.uint64)
+    bits = np.stack([image_hash.hash.flatten() for image_hash in hash_list])
+    return np.packbits(bits, axis=1).view(">u8").ravel().astype(np.uint64)  # 64 bits per hash, first bit is the MSB.
+
+
+def pack_hashes(image_data: dict):
+    """
+    Packs the hash_list of every image into a contiguous uint64 matrix, one row per image and one column per grid
+    square, in the same order as the image_data dict.
+
+    :param image_data: An image_data dict (or ImageRecords) of an ImageStruct object.
+    :return: Returns a tuple of (list of filenames, uint64 numpy array of shape (images, grid squares)).
+    """
+
+    if isinstance(image_data, ImageRecords):
+        return image_data.packed()
+    names = list(image_data)
+    tiles = len(image_data[names[0]]["hash_list"]) if names else 0
+    matrix = np.empty((len(names), tiles), dtype=np.uint64)
+    for row, name in enumerate(names):
+        matrix[row] = pack_hash_list(image_data[name]["hash_list"])
+    return names, matrix
+
+
+def pack_averages(image_data: dict):
+    """
+    :param image_data: An image_data dict (or ImageRecords) of an ImageStruct object.
+    :return: Returns a uint64 numpy array of the average hash of every image, in the same order as pack_hashes().
+    """
+
+    if isinstance(image_data, ImageRecords):
+        return image_data.hashes[image_data.live_rows(), 0]
+    return np.array([hash_to_int(image_data[name]["average_hash"]) for name in image_data], dtype=np.uint64)
+
+
+class ImageRecord(collections.abc.Mapping):
+    __slots__ = ("records", "row")
+
+    def __init__(self, records, row: int):
+
+        """
+        A read/write view of one image of an ImageRecords store, with the same keys as an image_data dict entry:
+        filename, size, average_hash, hash_list (a HashRow) and, if there are, file_stat and frame_hashes. Values are
+        made from the columns when they are accessed, except file_stat and frame_hashes, which are the stored objects.
+
+        :param records: The ImageRecords object.
+        :param row: The row of the image.
+        """
+
+        self.records, self.row = records, row
+
+    def __getitem__(self, key):
+        records, row = self.records, self.row
+        if key == "filename":
+            return records.names[row]
+        if key == "size":
+            return int(records.sizes[row, 0]), int(records.sizes[row, 1])
+        if key == "average_hash":
+            return f"{int(records.hashes[row, 0]):016x}"
+        if key == "hash_list":
+            return HashRow(records.hashes[row, 1:])
+        if key == "file_stat" and records.file_stats[row] is not None:
+            return records.file_stats[row]
+        if key == "frame_hashes" and records.frames[row] is not None:
+            return records.frames[row]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self.records.set_field(self.row, key, value)
+
+    def __iter__(self):
+        yield from ("filename", "size", "average_hash", "hash_list")
+        if self.records.file_stats[self.row] is not None:
+            yield "file_stat"
+        if self.records.frames[self.row] is not None:
+            yield "frame_hashes"
+
+    def __len__(self):
+        return 4 + (self.records.file_stats[self.row] is not None) + (self.records.frames[self.row] is not None)
+
+
+class ImageRecords(collections.abc.MutableMapping):
+    def __init__(self, tiles=None):
+
+        """
+        A columnar image_data store: a list of filenames, an (images, 2) int64 array of sizes, an (images, 1 + grid
+        squares) uint64 array of the average hash and grid square hashes, a list of file fingerprints and a list of the
+        frame hashes of animations and videos (None for still images). It is used
+        like an image_data dict of filename: entry, where each entry is an ImageRecord view of its row, and costs about
+        a kilobyte per image instead of a dict of 100 ImageHash objects.
+
+        Rows of deleted images are only dropped by compact() (and when saving), renamed images keep their row.
+
+        :param tiles: Number of grid squares per image, defaults to the length of the first hash_list stored.
+        """
+
+        self.names, self.rows, self.file_stats = [], {}, []  # rows is filename: row, in image_data order.
+        self.frames = []
+        width = 1 + (tiles or 0)
+        self.hashes = np.empty((0, width), dtype=np.uint64)
+        self.sizes = np.empty((0, 2), dtype=np.int64)
+        self.tiles = tiles or None  # an empty store takes the grid squares of the first image stored.
+
+    @classmethod
+    def from_arrays(cls, names: list, hashes, sizes, file_stats: list, frames=None):
+        """
+        Makes an ImageRecords object out of columns, e.g. the memory mapped arrays of a hash store, without copying them
+        (they are only copied once something is written).
+        """
+
+        records = cls(hashes.shape[1] - 1)
+        records.names, records.file_stats = list(names), list(file_stats)
+        records.frames = [None] * len(records.names) if frames is None else list(frames)
+        records.rows = {name: row for row, name in enumerate(records.names)}
+        records.hashes, records.sizes = hashes, sizes
+        return records
+
+    @classmethod
+    def from_dict(cls, image_data: dict):
+        """
+        Converts an image_data dict (hash lists of ImageHash objects, hex strings or HashRows) into an ImageRecords
+        object, in the same order.
+        """
+
+        names, matrix = pack_hashes(image_data)
+        hashes = np.empty((len(names), 1 + matrix.shape[1]), dtype=np.uint64)
+        hashes[:, 0] = [hash_to_int(image_data[name]["average_hash"]) for name in names]
+        hashes[:, 1:] = matrix
+        sizes = np.array([image_data[name]["size"] for name in names], dtype=np.int64).reshape(len(names), 2)
+        return cls.from_arrays(names, hashes, sizes, [image_data[name].get("file_stat") for name in names],
+                               [image_data[name].get("frame_hashes") for name in names])
+
+    def __getitem__(self, name):
+        return ImageRecord(self, self.rows[name])
+
+    def __setitem__(self, name, entry):
+        hash_list = pack_hash_list(entry["hash_list"])
+        if self.tiles is None:
+            self.tiles = len(hash_list)
+            self.hashes = np.empty((0, 1 + self.tiles), dtype=np.uint64)
+        if len(hash_list) != self.tiles:
+            raise ValueError(f"{name} has {len(hash_list)} grid squares, the other images have {self.tiles}.")
+        if name not in self.rows:  # a new image goes on the end, like a new key of a dict.
+            self._reserve(len(self.names) + 1)
+            self.rows[name] = len(self.names)
+            self.names.append(name)
+            self.file_stats.append(None)
+            self.frames.append(None)
+        row = self.rows[name]
+        self._writable()
+        self.hashes[row, 0] = hash_to_int(entry["average_hash"])
+        self.hashes[row, 1:] = hash_list
+        self.sizes[row] = entry["size"]
+        self.file_stats[row] = entry.get("file_stat")
+        self.frames[row] = entry.get("frame_hashes")
+
+    def __delitem__(self, name):
+        row = self.rows.pop(name)
+        self.names[row], self.file_stats[row], self.frames[row] = None, None, None
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def _reserve(self, count: int):  # grows the arrays geometrically, so adding images is amortised O(1).
+        if count > len(self.hashes):
+            capacity = max(count, 2 * len(self.hashes), 16)
+            hashes = np.zeros((capacity, self.hashes.shape[1]), dtype=np.uint64)
+            sizes = np.zeros((capacity, 2), dtype=np.int64)
+            hashes[:len(self.names)] = self.hashes[:len(self.names)]
+            sizes[:len(self.names)] = self.sizes[:len(self.names)]
+            self.hashes, self.sizes = hashes, sizes
+
+    def _writable(self):  # copies memory mapped (read only) columns before they are written to.
+        if not self.hashes.flags.writeable or not self.sizes.flags.writeable:
+            self.hashes, self.sizes = np.array(self.hashes), np.array(self.sizes)
+
+    def set_field(self, row: int, key: str, value):
+        if key == "file_stat":
+            self.file_stats[row] = value
+            return
+        if key == "frame_hashes":
+            self.frames[row] = value
+            return
+        self._writable()
+        if key == "size":
+            self.sizes[row] = value
+        elif key == "average_hash":
+            self.hashes[row, 0] = hash_to_int(value)
+        elif key == "hash_list":
+            self.hashes[row, 1:] = pack_hash_list(value)
+        else:
+            raise KeyError(key)  # filenames are changed with rename().
+
+    def rename(self, old_name, new_name):
+        """
+        Renames an image in O(1), without copying its row. Like setting the new key and deleting the old one of a dict,
+        the image moves to the end of the order.
+        """
+
+        row = self.rows.pop(old_name)
+        self.rows[new_name] = row
+        self.names[row] = new_name
+
+    def live_rows(self):
+        return np.fromiter(self.rows.values(), dtype=np.int64, count=len(self.rows))
+
+    def packed(self):
+        """
+        :return: Returns a tuple of (list of filenames, uint64 array of the grid square hashes), like pack_hashes().
+        """
+
+        return list(self.rows), self.hashes[self.live_rows(), 1:]
+
+    def compact(self):
+        """
+        Drops the rows of deleted images and the spare capacity, and puts the rows in image_data order.
+        """
+
+        rows = self.live_rows()
+        names, file_stats = list(self.rows), [self.file_stats[row] for row in rows]
+        self.frames = [self.frames[row] for row in rows]
+        self.hashes, self.sizes = self.hashes[rows], self.sizes[rows]
+        self.names, self.file_stats = names, file_stats
+        self.rows = {name: row for row, name in enumerate(names)}
+
+
+def similarity_edges(matrix, cutoff=0, success_ratio=0.3, block_size=None, pyqt_signals=None, cascade=None,
+                     averages=None, stats=None):
+    """
+    Finds every pair of rows of a packed hash matrix that compare_hashes() would match in similar mode, or with
+    cascade, in cascade mode.
+
+    Hamming distances of every grid square are computed with XOR and popcount over blocks of pairs, and the
+    cutoff/success_ratio rule is applied to the whole block at once. With cascade, each block is filtered coarse to fine
+    instead: by the average hashes, then by a sample of grid squares, and only the pairs left are compared in full.
+
+    :param matrix: uint64 matrix from pack_hashes().
+    :param cutoff: A grid square matches if its hamming distance is below the cutoff.
+    :param success_ratio: Ratio of grid squares that must match for the images to match.
+    :param block_size: Number of rows (and columns) per block, defaults to fitting COMPARE_BLOCK_BYTES.
+    :param pyqt_signals: Optional dictionary of PyQt signals, for the progress bar.
+    :param cascade: Optional dict of average_radius, sample_size and sample_ratio (see compare_hashes()), an empty dict
+                    takes the defaults.
+    :param averages: uint64 array of the average hashes of the rows from pack_averages(), needed by the average_radius
+                     stage of the cascade (which is skipped without it).
+    :param stats: Optional collections.Counter of the stage each pair was decided at with cascade, see cascade_report().
+    :return: Returns a (matches, 2) int64 numpy array of row pairs (i, j), i < j, sorted by i then j.
+    """
+
+    num_rows, tiles = matrix.shape
+    required = round(tiles * success_ratio)  # same rounding as compare_hashes.
+    block_size = block_size or _compare_block_size(tiles)
+    cascade = _cascade_args(cascade)
+
+    edges = []
+    for row_start in range(0, num_rows, block_size):
+        for col_start in range(row_start, num_rows, block_size):
+            edges.append(_block_edges(matrix, row_start, col_start, block_size, cutoff, required, cascade, averages,
+                                      stats))
+        if pyqt_signals is not None:
+            pyqt_signals["progress_bar"].emit(round(100 * min(row_start + block_size, num_rows) / num_rows))
+    return _sorted_edges(edges)
+
+
+def match_rows(matrix, query_row, cutoff=0, required=0, rows=None):
+    """
+    Finds the rows of a packed hash matrix that a single packed row matches, in blocks of COMPARE_BLOCK_BYTES.
+
+    :param matrix: uint64 matrix from pack_hashes().
+    :param query_row: 1-D uint64 array of the grid square hashes of the query.
+    :param cutoff: A grid square matches if its hamming distance is below the cutoff.
+    :param required: Number of grid squares that must match, round(grid squares * success_ratio).
+    :param rows: Optional list of the only rows to compare, e.g. HashIndex candidates.
+    :return: Returns a sorted int64 numpy array of the matching rows.
+    """
+
+    rows = np.arange(len(matrix)) if rows is None else np.unique(np.asarray(rows, dtype=np.int64))
+    block_size = max(1, COMPARE_BLOCK_BYTES // (8 * max(matrix.shape[1], 1)))
+    matches = [np.empty(0, dtype=np.int64)]
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        scores = (_popcount64(matrix[block] ^ query_row) < cutoff).sum(axis=1, dtype=np.int64)
+        matches.append(block[scores >= required])
+    return np.concatenate(matches)
+
+
+def _compare_block_size(tiles: int) -> int:  # rows per block so the XOR'd hashes of a block fit COMPARE_BLOCK_BYTES.
+    return max(1, int(math.sqrt(COMPARE_BLOCK_BYTES / (8 * max(tiles, 1)))))
+
+
+def _cascade_args(cascade):  # (average_radius, sample_size, sample_ratio) of a cascade dict, or None.
+    if cascade is None:
+        return None
+    return (cascade.get("average_radius", CASCADE_AVERAGE_RADIUS), cascade.get("sample_size", CASCADE_SAMPLE_SIZE),
+            cascade.get("sample_ratio", CASCADE_SAMPLE_RATIO))
+
+
+def _block_edges(matrix, row_start: int, col_start: int, block_size: int, cutoff: int, required: int, cascade=None,
+                 averages=None, stats=None):
+    if cascade is not None:
+        return _block_edges_cascade(matrix, row_start, col_start, block_size, cutoff, required, cascade, averages,
+                                    stats)
+    rows = matrix[row_start:row_start + block_size]
+    cols = matrix[col_start:col_start + block_size]
+    distances = _popcount64(rows[:, None, :] ^ cols[None, :, :])
+    scores = (distances < cutoff).sum(axis=2, dtype=np.int64)
+    i, j = np.nonzero(scores >= required)
+    i, j = i + row_start, j + col_start
+    upper = i < j  # every pair once, and never an image with itself.
+    return np.stack([i[upper], j[upper]], axis=1)
+
+
+def _block_edges_cascade(matrix, row_start: int, col_start: int, block_size: int, cutoff: int, required: int,
+                         cascade: tuple, averages=None, stats=None):
+    # _compare_cascade() over a block of pairs, each stage only gathers the pairs the stage before kept.
+    average_radius, sample_size, sample_ratio = cascade
+    stats = collections.Counter() if stats is None else stats
+    num_rows, tiles = matrix.shape
+    i, j = np.nonzero(np.arange(row_start, min(row_start + block_size, num_rows))[:, None]
+                      < np.arange(col_start, min(col_start + block_size, num_rows))[None, :])
+    i, j = i + row_start, j + col_start
+    stats["pairs"] += len(i)
+    if averages is not None:
+        near = _popcount64(averages[i] ^ averages[j]) <= average_radius
+        stats["rejected_average"] += int(len(i) - near.sum())
+        i, j = i[near], j[near]
+    if required <= 0:
+        stats["accepted_early"] += len(i)
+        return np.stack([i, j], axis=1)
+
+    num_sampled, order = _cascade_order(tiles, sample_size)
+    sample, rest = np.array(order[:num_sampled], dtype=np.int64), np.array(order[num_sampled:], dtype=np.int64)
+    sampled = (_popcount64(matrix[i[:, None], sample] ^ matrix[j[:, None], sample]) < cutoff).sum(axis=1,
+                                                                                                  dtype=np.int64)
+    accepted = sampled >= required  # the sample alone is enough.
+    full = np.flatnonzero(~accepted & (sampled >= sample_ratio * num_sampled))
+    scores = sampled[full] + (_popcount64(matrix[i[full, None], rest] ^ matrix[j[full, None], rest]) < cutoff).sum(
+        axis=1, dtype=np.int64)
+    matched = full[scores >= required]
+    accepted[matched] = True
+    stats["accepted_early"] += int(accepted.sum()) - len(matched)
+    stats["rejected_sample"] += len(i) - int(accepted.sum()) - (len(full) - len(matched))
+    stats["accepted_full"] += len(matched)
+    stats["rejected_full"] += len(full) - len(matched)
+    stats["tiles_compared"] += len(i) * num_sampled + len(full) * len(rest)
+    return np.stack([i[accepted], j[accepted]], axis=1)
+
+
+def _sorted_edges(edges: list):  # concatenates blocks of edges, sorted by i then j whichever order they came in.
+    if not edges:
+        return np.empty((0, 2), dtype=np.int64)
+    edges = np.concatenate(edges)
+    return edges[np.lexsort((edges[:, 1], edges[:, 0]))]
+
+
+_SHARED_MATRIX = None  # (shared memory, uint64 matrix view) a comparing process has attached to, kept across tasks.
+
+
+def compare_blocks(shm_name: str, shape: tuple, blocks: list, block_size: int, cutoff: int, required: int,
+                   cascade=None, with_averages=False):
+    """
+    Compares blocks of pairs of a hash matrix in shared memory in a comparing process, see similarity_edges_parallel().
+
+    :param shm_name: Name of the SharedMemory block holding the uint64 matrix.
+    :param shape: Shape of the matrix.
+    :param blocks: List of (row start, column start) blocks.
+    :param cascade: Optional (average_radius, sample_size, sample_ratio) tuple.
+    :param with_averages: The first column of the matrix is the average hashes, for the cascade.
+    :return: Returns a tuple of (list of (matches, 2) edge arrays, number of blocks compared, Counter of cascade stats).
+    """
+
+    global _SHARED_MATRIX
+    if _SHARED_MATRIX is None or _SHARED_MATRIX[0].name != shm_name:
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _SHARED_MATRIX = (shm, np.ndarray(shape, dtype=np.uint64, buffer=shm.buf))
+    matrix, averages = _SHARED_MATRIX[1], None
+    if with_averages:
+        matrix, averages = matrix[:, 1:], matrix[:, 0]
+    stats = collections.Counter()
+    return [_block_edges(matrix, row_start, col_start, block_size, cutoff, required, cascade, averages, stats)
+            for row_start, col_start in blocks], len(blocks), stats
+
+
+def similarity_edges_parallel(matrix, num_proc: int, cutoff=0, success_ratio=0.3, block_size=None, pyqt_signals=None,
+                              instruments=None, blocks_per_task=None, cascade=None, averages=None, stats=None):
+    """
+    similarity_edges() spread over a pool of processes. The matrix is copied into shared memory once, the pair space is
+    tiled into the same blocks as similarity_edges(), and each task compares a run of blocks. Blocks are sorted back
+    into (i, j) order afterwards, so the edges are identical to similarity_edges() however the tasks finish.
+
+    :param matrix: uint64 matrix from pack_hashes().
+    :param num_proc: Number of comparing processes.
+    :param blocks_per_task: Blocks compared per task, defaults to about 8 tasks per process.
+    :param cascade: see similarity_edges(), as are averages and stats.
+    :return: Returns a (matches, 2) int64 numpy array of row pairs (i, j), i < j, sorted by i then j.
+    """
+
+    from multiprocessing import shared_memory  # only needed by the parallel comparison.
+
+    num_rows, tiles = matrix.shape
+    required = round(tiles * success_ratio)
+    block_size = block_size or _compare_block_size(tiles)
+    blocks = [(row_start, col_start) for row_start in range(0, num_rows, block_size)
+              for col_start in range(row_start, num_rows, block_size)]
+    if num_proc <= 1 or len(blocks) <= 1 or matrix.size == 0:
+        return similarity_edges(matrix, cutoff, success_ratio, block_size, pyqt_signals, cascade, averages, stats)
+
+    blocks_per_task = blocks_per_task or max(1, len(blocks) // (num_proc * 8))
+    with_averages = cascade is not None and averages is not None
+    shared = np.column_stack([averages, matrix]) if with_averages else matrix  # one block of shared memory for both.
+    shm = shared_memory.SharedMemory(create=True, size=shared.nbytes)
+    try:
+        np.ndarray(shared.shape, dtype=np.uint64, buffer=shm.buf)[:] = shared
+        tasks = [(shm.name, shared.shape, blocks[num:num + blocks_per_task], block_size, cutoff, required,
+                  _cascade_args(cascade), with_averages) for num in range(0, len(blocks), blocks_per_task)]
+        edges, done = [], 0
+        proc_manager = ProcessManager(pyqt_signals, instruments)
+        for task_edges, num_blocks, task_stats in proc_manager.imap(compare_blocks, tasks, min(num_proc, len(tasks))):
+            edges.extend(task_edges)
+            done += num_blocks
+            if stats is not None:
+                stats.update(task_stats)
+            if pyqt_signals is not None:
+                pyqt_signals["progress_bar"].emit(round(100 * done / len(blocks)))
+    finally:
+        shm.close()
+        shm.unlink()
+    return _sorted_edges(edges)
+
+
+def greedy_groups(names: list, edges) -> list:
+    """
+    Groups matching pairs the same way cross_compare_list() does: in order, each image that isn't in a group yet takes
+    every later image it matches that isn't in a group yet.
+
+    :param names: List of filenames, the row order of the edges.
+    :param edges: Sorted (i, j) pairs of matching rows, from similarity_edges().
+    :return: Returns a 2 element list of [duplicate items, grouped duplicate items]
+    """
+
+    dupe_items = []
+    g_dupe_items = []
+    grouped = np.zeros(len(names), dtype=bool)
+    if len(edges) == 0:
+        return [dupe_items, g_dupe_items]
+
+    starts = np.flatnonzero(np.diff(edges[:, 0], prepend=-1))
+    for start, stop in zip(starts, list(starts[1:]) + [len(edges)]):
+        item_1 = edges[start, 0]
+        if grouped[item_1]:
+            continue
+        matches = edges[start:stop, 1]
+        matches = matches[~grouped[matches]]
+        if len(matches) != 0:
+            grouped[item_1] = True
+            grouped[matches] = True
+            group = [names[item_1]] + [names[item_2] for item_2 in matches]
+            dupe_items.extend(group)
+            g_dupe_items.append(group)
+    return [dupe_items, g_dupe_items]
+
+
+class DisjointSet:
+    __slots__ = ("parent", "size")
+
+    def __init__(self, count: int):
+
+        """
+        A disjoint-set (union-find) forest over the integers 0 to count - 1, with union by size and path compression.
+
+        :param count: Number of elements.
+        """
+
+        self.parent = list(range(count))
+        self.size = [1] * count
+
+    def find(self, item: int) -> int:
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[item] != root:  # path compression, every node on the path points at the root.
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, item_1: int, item_2: int) -> int:
+        root_1, root_2 = self.find(item_1), self.find(item_2)
+        if root_1 == root_2:
+            return root_1
+        if self.size[root_1] < self.size[root_2]:
+            root_1, root_2 = root_2, root_1
+        self.parent[root_2] = root_1
+        self.size[root_1] += self.size[root_2]
+        return root_1
+
+    def components(self) -> list:
+        """
+        :return: Returns every set with more than one element, as sorted lists, ordered by their smallest element.
+        """
+
+        members = dict()
+        for item in range(len(self.parent)):  # ascending, so sets come out ordered by their smallest element.
+            members.setdefault(self.find(item), []).append(item)
+        return [group for group in members.values() if len(group) > 1]
+
+
+def _complete_clusters(component: list, neighbours: dict) -> list:
+    # in ascending order, each image joins the first cluster it matches every member of, or starts a new one.
+    clusters = []
+    for item in component:
+        for cluster in clusters:
+            if cluster.issubset(neighbours[item]):
+                cluster.add(item)
+                break
+        else:
+            clusters.append({item})
+    return [sorted(cluster) for cluster in clusters if len(cluster) > 1]
+
+
+def cluster_groups(names: list, edges, linkage="single") -> list:
+    """
+    Groups matching pairs into clusters with a disjoint-set forest. Unlike greedy_groups(), an image is never left out
+    of a group because an earlier group took one of its matches, and the groups only depend on the set of matches.
+
+    single linkage groups every chain of matches (A~B and B~C groups A, B and C, even if A≁C). complete linkage splits
+    each of those groups into strict clusters where every pair of images matches, taking images in row order.
+
+    :param names: List of filenames, the row order of the edges.
+    :param edges: (i, j) pairs of matching rows, e.g. from similarity_edges().
+    :param linkage: "single" or "complete".
+    :return: Returns a 2 element list of [duplicate items, grouped duplicate items], groups and their images in row
+             order.
+    """
+
+    if linkage not in ("single", "complete"):
+        raise ValueError(f"Unknown linkage: {linkage}")
+
+    forest = DisjointSet(len(names))
+    for item_1, item_2 in np.asarray(edges, dtype=np.int64).reshape(-1, 2).tolist():
+        forest.union(item_1, item_2)
+    groups = forest.components()
+
+    if linkage == "complete":
+        neighbours = collections.defaultdict(set)
+        for item_1, item_2 in np.asarray(edges, dtype=np.int64).reshape(-1, 2).tolist():
+            neighbours[item_1].add(item_2)
+            neighbours[item_2].add(item_1)
+        groups = sorted((cluster for group in groups for cluster in _complete_clusters(group, neighbours)),
+                        key=lambda cluster: cluster[0])
+
+    g_dupe_items = [[names[item] for item in group] for group in groups]
+    return [[name for group in g_dupe_items for name in group], g_dupe_items]
+
+
+GROUPINGS = ("greedy", "single", "complete")  # greedy matches cross_compare_list(), the others use cluster_groups().
+
+
+def cross_compare_matrix(image_struct: ImageStruct, cutoff=0, success_ratio=0.3, block_size=None,
+                         num_proc=None, grouping="greedy", cascade=None) -> list:
+    """
+    A vectorized replacement of cross_compare_list() with compare_hashes in similar mode (or with cascade, in cascade
+    mode), that gives the same groups with greedy grouping.
+
+    :param image_struct: Takes an ImageStruct object in
+    :param cutoff: A grid square matches if its hamming distance is below the cutoff.
+    :param success_ratio: Ratio of grid squares that must match for the images to match.
+    :param block_size: Number of rows (and columns) per block of pairs, see similarity_edges().
+    :param num_proc: Number of comparing processes, defaults to the ImageStruct's allowed_cpu_cores. With more than one,
+                     blocks are compared in parallel, see similarity_edges_parallel().
+    :param grouping: "greedy" (see greedy_groups()), or "single" or "complete" linkage (see cluster_groups()).
+    :param cascade: Optional dict of average_radius, sample_size and sample_ratio, prefilters the pairs coarse to fine
+                    (see compare_hashes() cascade mode), an empty dict takes the defaults.
+    :return: Returns a 2 element list of [duplicate items, grouped duplicate items]
+    """
+
+    if grouping not in GROUPINGS:
+        raise ValueError(f"Unknown grouping: {grouping}")
+
+    image_struct.pyqt_signal_dict["text_log"].emit("Cross checking for similar duplicates...")
+    with image_struct.instruments.stage("pack_hashes"):
+        names, matrix = pack_hashes(image_struct.image_data)
+        averages = pack_averages(image_struct.image_data) if cascade is not None else None
+    stats = collections.Counter()
+    with image_struct.instruments.stage("compare"):
+        edges = similarity_edges_parallel(matrix, num_proc or image_struct.allowed_cpu_cores, cutoff, success_ratio,
+                                          block_size, image_struct.pyqt_signal_dict, image_struct.instruments,
+                                          cascade=cascade, averages=averages, stats=stats)
+    if cascade is not None and len(names) != 0:
+        report = cascade_report(stats, matrix.shape[1])
+        for stage in CASCADE_STAGES + ("tiles_compared",):
+            image_struct.instruments.count(stage, report[stage])
+        image_struct.pyqt_signal_dict["text_log"].emit(f"Skipped {report['pruning_rate']:.1%} of grid square checks.")
+    with image_struct.instruments.stage("group"):
+        groups = greedy_groups(names, edges) if grouping == "greedy" else cluster_groups(names, edges, grouping)
+    image_struct.instruments.count("pairs_compared", len(names) * (len(names) - 1) // 2)
+    image_struct.instruments.count("pairs_matched", len(edges))
+    image_struct.pyqt_signal_dict["text_log"].emit("Done!")
+    return groups
+
+
+FRAME_CUTOFF = 10  # two frames match if the hamming distance of their frame hashes is below this.
+SEQUENCE_RATIO = 0.6  # min ratio of the frames of the shorter sequence that have to match in order.
+
+
+def _common_run_lengths(matches):
+    """
+    The longest in order run of matching frames (a longest common subsequence) of many pairs of sequences at once, by
+    dynamic programming over the frames, vectorized over the pairs.
+
+    :param matches: (pairs, frames, frames) bool array of which frames of the two sequences of each pair match.
+    :return: Returns an int32 numpy array of the run lengths.
+    """
+
+    # lengths[:, j] is the longest run of the frames so far and the first j frames of the other sequence.
+    lengths = np.zeros((len(matches), matches.shape[2] + 1), dtype=np.int32)
+    for row in range(matches.shape[1]):
+        previous = lengths.copy()
+        for j in range(1, matches.shape[2] + 1):
+            lengths[:, j] = np.where(matches[:, row, j - 1], previous[:, j - 1] + 1,
+                                     np.maximum(previous[:, j], lengths[:, j - 1]))
+    return lengths[:, -1]
+
+
+def sequence_similarity(frame_hashes_1: list, frame_hashes_2: list, cutoff=FRAME_CUTOFF) -> float:
+    """
+    Scores how much of one sequence of frame hashes shows up, in the same order, in another: the longest run of frames
+    of both that match each other in order (a longest common subsequence), over the length of the shorter sequence.
+    A copy of an animation scores 1, and so does a clip cut out of it, or one with frames dropped or repeated, as
+    long as its sampled frames line up with frames of the other (see frame_indices()).
+
+    :param frame_hashes_1: List of frame hashes (hex strings).
+    :param frame_hashes_2: List of frame hashes (hex strings).
+    :param cutoff: Two frames match if their hamming distance is below the cutoff.
+    :return: Returns a float from 0 to 1.
+    """
+
+    if len(frame_hashes_1) == 0 or len(frame_hashes_2) == 0:
+        return 0.0
+    matches = _popcount64(pack_hash_list(frame_hashes_1)[:, None] ^ pack_hash_list(frame_hashes_2)[None, :]) < cutoff
+    return int(_common_run_lengths(matches[None])[0]) / min(len(frame_hashes_1), len(frame_hashes_2))
+
+
+def frame_sequences(image_data: dict, min_frames=2) -> dict:
+    """
+    :param image_data: An image_data dict or ImageRecords object.
+    :param min_frames: Min number of frame hashes.
+    :return: Returns a dict of filename: frame hashes of the animations and videos with at least min_frames of them.
+    """
+
+    if isinstance(image_data, ImageRecords):  # straight from the column, without a view of every image.
+        frames = ((name, image_data.frames[row]) for name, row in image_data.rows.items())
+    else:
+        frames = ((name, image_data[name].get("frame_hashes")) for name in image_data)
+    return {name: hashes for name, hashes in frames if len(hashes or ()) >= min_frames}
+
+
+def sequence_edges(sequences: list, cutoff=FRAME_CUTOFF, sequence_ratio=SEQUENCE_RATIO):
+    """
+    Finds every pair of frame hash sequences whose sequence_similarity() is at least the sequence_ratio. Sequences are
+    packed into one padded matrix and compared a block of pairs at a time, and only pairs with enough frames that
+    match at all (an upper bound of the score) go through the longest common subsequence.
+
+    :param sequences: List of lists of frame hashes (hex strings).
+    :return: Returns a (matches, 2) int64 numpy array of pairs (i, j), i < j, sorted by i then j.
+    """
+
+    if len(sequences) < 2:
+        return np.empty((0, 2), dtype=np.int64)
+    lengths = np.array([len(frames) for frames in sequences])
+    matrix = np.zeros((len(sequences), max(lengths)), dtype=np.uint64)
+    for row, frames in enumerate(sequences):
+        matrix[row, :len(frames)] = pack_hash_list(frames)
+
+    width, rows = matrix.shape[1], np.arange(len(sequences))
+    block_rows = max(1, COMPARE_BLOCK_BYTES // (8 * width * width * len(sequences)))  # XOR'd frames of one block.
+    edges = []
+    for start in range(0, len(sequences), block_rows):
+        rows_i, rows_j = np.nonzero(rows[None, :] > rows[start:start + block_rows, None])
+        rows_i += start
+        matches = _popcount64(matrix[rows_i, :, None] ^ matrix[rows_j, None, :]) < cutoff
+        matches &= (np.arange(width) < lengths[rows_i, None])[:, :, None]  # padding never matches.
+        matches &= (np.arange(width) < lengths[rows_j, None])[:, None, :]
+        shorter = np.minimum(lengths[rows_i], lengths[rows_j])
+        bound = np.minimum(matches.any(axis=2).sum(axis=1), matches.any(axis=1).sum(axis=1))
+        possible = np.flatnonzero(bound >= sequence_ratio * shorter)
+        scores = _common_run_lengths(matches[possible]) / shorter[possible]
+        edges.append(np.stack([rows_i[possible], rows_j[possible]], axis=1)[scores >= sequence_ratio])
+    return np.concatenate(edges).astype(np.int64)
+
+
+def cross_compare_sequences(image_struct: ImageStruct, cutoff=FRAME_CUTOFF, sequence_ratio=SEQUENCE_RATIO,
+                            min_frames=2, grouping="single") -> list:
+    """
+    Finds the duplicate and clipped animations and videos of an ImageStruct object, by comparing the frame hashes of
+    every pair of them (see sequence_similarity()). Still images, and animations with fewer than min_frames frame
+    hashes, are left out.
+
+    :param image_struct: Takes an ImageStruct object in
+    :param cutoff: Two frames match if their hamming distance is below the cutoff.
+    :param sequence_ratio: Min score of a pair of sequences that match.
+    :param min_frames: Min number of frame hashes of a sequence that is compared.
+    :param grouping: "greedy" (see greedy_groups()), or "single" or "complete" linkage (see cluster_groups()).
+    :return: Returns a 2 element list of [duplicate items, grouped duplicate items]
+    """
+
+    if grouping not in GROUPINGS:
+        raise ValueError(f"Unknown grouping: {grouping}")
+
+    image_struct.pyqt_signal_dict["text_log"].emit("Cross checking animations and videos...")
+    sequences = frame_sequences(image_struct.image_data, min_frames)
+    names = list(sequences)
+    with image_struct.instruments.stage("compare_sequences"):
+        edges = sequence_edges(list(sequences.values()), cutoff, sequence_ratio)
+    with image_struct.instruments.stage("group"):
+        groups = greedy_groups(names, edges) if grouping == "greedy" else cluster_groups(names, edges, grouping)
+    image_struct.instruments.count("sequences_compared", len(names) * (len(names) - 1) // 2)
+    image_struct.instruments.count("sequences_matched", len(edges))
+    image_struct.pyqt_signal_dict["text_log"].emit("Done!")
+    return groups
+
+
+def file_digest(path: Path, chunk_size=1 << 20) -> str:
+    """
+    Returns the blake2b hex digest of a file's contents, read in chunks into one reused buffer.
+    """
+
+    digest = hashlib.blake2b()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as file:
+        for length in iter(lambda: file.readinto(buffer), 0):
+            digest.update(view[:length])  # hashlib releases the GIL for large updates, so threads digest in parallel.
+    return digest.hexdigest()
+
+
+def identical_files(directory: Path, file_list: list, max_workers=None):
+    """
+    Finds the sets of byte for byte identical files. Files are grouped by size first, and only files that share their
+    size with another file are read, with a streaming digest on a thread pool.
+
+    :param directory: The folder of the files.
+    :param file_list: List of filenames (or paths relative to the directory).
+    :param max_workers: Number of digesting threads, defaults to the ThreadPoolExecutor default.
+    :return: Returns a tuple of (list of sets of two or more identical files, as lists in file list order, dict of
+             filename: digest of every file that was read).
+    """
+
+    by_size = collections.defaultdict(list)
+    for filename in file_list:
+        by_size[os.stat(Path(directory, filename)).st_size].append(filename)
+    candidates = [filename for group in by_size.values() if len(group) > 1 for filename in group]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        digests = dict(zip(candidates, executor.map(lambda filename: file_digest(Path(directory, filename)),
+                                                    candidates)))
+
+    sets = dict()
+    for filename in file_list:
+        if filename in digests:
+            sets.setdefault(digests[filename], []).append(filename)
+    return [group for group in sets.values() if len(group) > 1], digests
+
+
+HASH_STORE_MAGIC = b"DILHASH1"
+
+
+def save_hash_store(path: Path, metadata: dict, image_data: dict):
+    """
+    Saves image data into a binary hash store: a json header with the metadata, filenames, file fingerprints and the
+    frame hashes of animations and videos, followed by a (images, 1 + grid squares) little endian uint64 array of the
+    average hash and grid square hashes, and an (images, 2) int64 array of the image sizes. The file is written to a
+    temporary file first, then renamed over the old one.
+
+    :param path: Path of the hash store file.
+    :param metadata: The metadata dict of an ImageStruct object.
+    :param image_data: The image_data (ImageRecords or dict) of an ImageStruct object.
+    :return: No return value
+    """
+
+    if not isinstance(image_data, ImageRecords):
+        image_data = ImageRecords.from_dict(image_data)
+    names, rows = list(image_data.rows), image_data.live_rows()
+    hashes, sizes = image_data.hashes[rows].astype("<u8"), image_data.sizes[rows].astype("<i8")
+
+    header = json.dumps({"metadata": metadata, "count": len(names), "tiles": hashes.shape[1] - 1, "filenames": names,
+                         "file_stats": [image_data.file_stats[row] for row in rows],
+                         "frame_hashes": {name: image_data.frames[row] for name, row in zip(names, rows.tolist())
+                                          if image_data.frames[row] is not None}}).encode("utf-8")
+    header += b" " * (-(len(header) + 16) % 8)  # keeps the arrays 8 byte aligned for memory mapping.
+
+    temp_path = Path(path).with_name(Path(path).name + ".tmp")
+    with open(temp_path, "wb") as store_file:
+        store_file.write(HASH_STORE_MAGIC + struct.pack("<Q", len(header)) + header)
+        store_file.write(hashes.tobytes())
+        store_file.write(sizes.tobytes())
+    if os.name == "nt":  # windows can't replace a file that is still memory mapped.
+        image_data._writable()
+    os.replace(temp_path, path)
+
+
+def load_hash_store(path: Path):
+    """
+    Loads a binary hash store saved with save_hash_store(). The hash arrays are memory mapped rather than read, so
+    loading doesn't copy them, and become the columns of an ImageRecords object.
+
+    :param path: Path of the hash store file.
+    :return: Returns a tuple of (metadata dict, ImageRecords object).
+    """
+
+    with open(path, "rb") as store_file:
+        if store_file.read(len(HASH_STORE_MAGIC)) != HASH_STORE_MAGIC:
+            raise OSError(f"{path} is not a hash store file.")
+        header_length = struct.unpack("<Q", store_file.read(8))[0]
+        header = json.loads(store_file.read(header_length).decode("utf-8"))
+
+    count, tiles = header["count"], header["tiles"]
+    offset = len(HASH_STORE_MAGIC) + 8 + header_length
+    if count == 0:
+        return header["metadata"], ImageRecords(tiles)
+    hashes = np.memmap(path, dtype="<u8", mode="r", offset=offset, shape=(count, 1 + tiles))
+    sizes = np.memmap(path, dtype="<i8", mode="r", offset=offset + hashes.nbytes, shape=(count, 2))
+    frames = header.get("frame_hashes", {})  # only animations and videos have them, stores made before have none.
+    return header["metadata"], ImageRecords.from_arrays(header["filenames"], hashes, sizes, header["file_stats"],
+                                                        [frames.get(name) for name in header["filenames"]])
+
+
+def check_data_exists(directory: Path):
+    return check_json_exists(directory) or Path(directory, "hash_data", "fp_hash_data.bin").is_file()
+
+
+def file_fingerprint(path: Path) -> dict:
+    """
+    Returns the size, modification time (in nanoseconds) and inode of a file, to tell if it changed since it was hashed.
+    """
+
+    stat = os.stat(path)
+    return {"st_size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "inode": stat.st_ino}
+
+
+def modified_before_saved(metadata: dict, mtime_ns: int) -> bool:
+    """
+    Tells if a file hashed before fingerprints were stored was last modified before its hashes were saved, by the
+    last_time_modified of the metadata. The time is rounded down to the second, so a file modified in that same second
+    counts as modified after.
+
+    :param metadata: The metadata dict of an ImageStruct object.
+    :param mtime_ns: The modification time of the file, in nanoseconds.
+    :return: True if the hashes are newer than the file, False if they aren't, or if the metadata has no time.
+    """
+
+    try:
+        saved = datetime.datetime.strptime(metadata["last_time_modified"], "%d/%m/%Y %H:%M:%S")
+    except (KeyError, TypeError, ValueError):
+        return False
+    return mtime_ns < int(saved.timestamp()) * 10 ** 9
+
+
+def stored_digest(image_struct: ImageStruct, filename: str) -> str:
+    """
+    Returns the content digest of an image, the one stored in its file_stat if the file hasn't changed since, otherwise
+    read from the file.
+    """
+
+    file_stat = image_struct.image_data[filename].get("file_stat") or dict()
+    if "digest" in file_stat:
+        fingerprint = file_fingerprint(Path(image_struct.directory, filename))
+        if all(file_stat[key] == fingerprint[key] for key in ("st_size", "mtime_ns", "inode")):
+            return file_stat["digest"]
+    return file_digest(Path(image_struct.directory, filename))
+
+
+def group_identical(image_struct: ImageStruct, by_digest=False) -> list:
+    """
+    Groups identical images in O(n) by bucketing them by average_hash, gives the same groups as cross_compare_list()
+    with compare_hashes in identical mode.
+
+    :param image_struct: Takes an ImageStruct object in
+    :param by_digest: Also requires the file contents to be byte for byte identical.
+    :return: Returns a 2 element list of [duplicate items, grouped duplicate items]
+    """
+
+    image_struct.pyqt_signal_dict["text_log"].emit("Cross checking for identical duplicates...")
+    buckets = dict()  # insertion ordered, so the groups come out in the same order as cross_compare_list.
+    for filename in image_struct.image_data:
+        buckets.setdefault(image_struct.image_data[filename]["average_hash"], []).append(filename)
+
+    g_dupe_items = [group for group in buckets.values() if len(group) > 1]
+    if by_digest:  # only files that share an average_hash can be identical, and only their digests are needed.
+        sub_buckets = dict()
+        for num, group in enumerate(g_dupe_items, start=1):
+            for filename in group:
+                sub_buckets.setdefault((num, stored_digest(image_struct, filename)), []).append(filename)
+            image_struct.pyqt_signal_dict["progress_bar"].emit(round(100 * num / len(g_dupe_items)))
+        g_dupe_items = [group for group in sub_buckets.values() if len(group) > 1]
+    dupe_items = [filename for group in g_dupe_items for filename in group]
+    image_struct.pyqt_signal_dict["text_log"].emit("Done!")
+    return [dupe_items, g_dupe_items]
+
+
+def _run_starts(values):  # indices where each run of equal values in a sorted array starts.
+    return np.flatnonzero(np.concatenate([[True], values[1:] != values[:-1]])) if len(values) else \
+        np.empty(0, dtype=np.int64)
+
+
+def _sorted_unique(values):  # np.unique() of an int64 array, sorting instead of hashing (faster for large arrays).
+    values = np.sort(values)
+    return values[_run_starts(values)]
+
+
+class HashIndex:
+    def __init__(self, tiles: int, cutoff=0, success_ratio=0.3, bands=None, max_positions=None, average_radius=None,
+                 min_hits=None, max_bucket=None):
+
+        """
+        A multi-index hashing index over the grid square hashes of an image_data dict, returns candidate pairs of images
+        that are likely to match in compare_hashes() similar mode, without comparing every pair.
+
+        Each 64 bit hash is split into a few wide bands that are looked up exactly, so two unrelated grid squares only
+        share a band about once in 800,000 (3 bands of 21 bits). Two grid squares closer than the cutoff share a band
+        whenever the bits they differ in all fall in the other bands, which the close grid squares of near duplicates
+        mostly do, so the pairs with at least min_hits grid squares that share a band are the candidates (a quarter of
+        the grid squares required to match by default). It's a filter, not an exact search: a pair that only just
+        matches (barely enough grid squares, each only just below the cutoff) can be missed, dupe_image_bench.py reports
+        the recall. With a cutoff of at most bands, a close grid square always shares a band. Band values shared by more
+        than max_bucket images (flat or common grid squares) are skipped, they hit many pairs and tell them apart
+        poorly. average_radius also drops candidates whose average_hash is further apart than the radius, max_positions
+        indexes fewer grid squares (a smaller index, but less hits).
+
+        :param tiles: Number of grid squares per image, grid_density ** 2.
+        :param cutoff: The cutoff of compare_hashes().
+        :param success_ratio: The success ratio of compare_hashes().
+        :param bands: Number of bands each 64 bit hash is split into, more (narrower) bands hit more of the close grid
+                      squares, but also more of the unrelated ones.
+        :param max_positions: Limits the number of indexed grid squares.
+        :param average_radius: Optional max hamming distance between the average_hash of candidates.
+        :param min_hits: Grid squares that must share a band, defaults to INDEX_HIT_RATIO of the grid squares required
+                         to match.
+        :param max_bucket: Band values shared by more images than this are skipped.
+        """
+
+        self.tiles, self.cutoff, self.success_ratio = tiles, cutoff, success_ratio
+        self.average_radius = average_radius
+        required = round(tiles * success_ratio)
+        self.match_all = required <= 0 or cutoff > 64  # every pair matches, nothing to index.
+        self.match_none = not self.match_all and cutoff <= 0
+        num_positions = 0 if self.match_all or self.match_none else tiles
+        if max_positions is not None:
+            num_positions = min(num_positions, max_positions)
+        self.positions = list(range(num_positions))
+        min_hits = min_hits or max(2, math.ceil(required * INDEX_HIT_RATIO))
+        self.min_hits = max(1, min(min_hits, required - (tiles - num_positions)))
+        self.max_bucket = max_bucket or INDEX_MAX_BUCKET
+        self.bands = max(1, min(bands or INDEX_BANDS, 64))
+
+        widths = [64 // self.bands + (band < 64 % self.bands) for band in range(self.bands)]
+        self.band_shifts = [64 - sum(widths[:band + 1]) for band in range(self.bands)]
+        self.band_masks = [(1 << width) - 1 for width in widths]
+        # tables hold band << width | band value, so all the bands of a grid square share one sorted table.
+        self.band_prefixes = [np.uint64(band << widths[0]) if band else np.uint64(0) for band in range(self.bands)]
+        self.table_dtype = np.uint32 if widths[0] + (self.bands - 1).bit_length() <= 32 else np.uint64
+
+        self.names, self.rows = [], {}
+        self.keys = np.empty((0, 1 + num_positions), dtype=np.uint64)  # average_hash, then the indexed grid squares.
+        self.alive = np.empty(0, dtype=bool)
+        self._tables, self._indexed = {}, 0  # sorted band tables of rows [0, _indexed)
+        self._pending_tables, self._pending_dirty = {}, False  # sorted band tables of the rows added since.
+
+    def _band_values(self, values):  # (values, bands) band values of each value, as in the tables.
+        return np.stack([((values >> np.uint64(self.band_shifts[band])) & np.uint64(self.band_masks[band])) |
+                         self.band_prefixes[band] for band in range(self.bands)], axis=1).astype(self.table_dtype)
+
+    def _build_tables(self, start: int, stop: int) -> dict:
+        tables = {}
+        for column in range(1, self.keys.shape[1]):
+            values = self._band_values(self.keys[start:stop, column]).T.ravel()  # band by band, rows in order.
+            rows = np.tile(np.arange(start, stop, dtype=np.int32), self.bands)
+            order = np.argsort(values, kind="stable")
+            tables[column] = (values[order], rows[order])
+        return tables
+
+    def _entry_keys(self, image_data: dict):
+        names, matrix = pack_hashes(image_data)
+        keys = np.empty((len(names), 1 + len(self.positions)), dtype=np.uint64)
+        keys[:, 0] = [int(image_data[name]["average_hash"], 16) for name in names]
+        keys[:, 1:] = matrix[:, self.positions]
+        return names, keys
+
+    def add(self, image_data: dict):
+        """
+        Adds (or replaces) the images of an image_data dict to the index.
+
+        :param image_data: An image_data dict, or a subset of one.
+        :return: No return value
+        """
+
+        if len(image_data) == 0:
+            return
+        self.remove([name for name in image_data if name in self.rows])
+        names, keys = self._entry_keys(image_data)
+        for num, name in enumerate(names, start=len(self.names)):
+            self.rows[name] = num
+        self.names.extend(names)
+        self.keys = np.concatenate([self.keys, keys])
+        self.alive = np.concatenate([self.alive, np.ones(len(names), dtype=bool)])
+        self._pending_dirty = True
+        if len(self.names) - self._indexed > max(1024, self._indexed // 8):  # merge the pending rows, amortised O(1)
+            self._tables, self._indexed = self._build_tables(0, len(self.names)), len(self.names)
+            self._pending_tables = {}
+
+    def remove(self, names: list):
+        for name in names:
+            self.alive[self.rows.pop(name)] = False
+
+    def update(self, image_data: dict):
+        """
+        Brings the index in line with an image_data dict, only adding the new images and removing the deleted ones.
+        """
+
+        self.remove([name for name in self.rows if name not in image_data])
+        self.add({name: image_data[name] for name in image_data if name not in self.rows})
+
+    def _column_hits(self, values, column: int):  # sorted query * rows + row keys of the rows sharing a band.
+        probes = self._band_values(values).ravel()
+        hits = []
+        for tables in (self._tables, self._pending_tables):
+            if column not in tables:
+                continue
+            table_values, rows = tables[column]
+            lower = np.searchsorted(table_values, probes, side="left")
+            counts = np.searchsorted(table_values, probes, side="right") - lower
+            probed = np.flatnonzero((counts > 0) & (counts <= self.max_bucket))  # almost every probe misses.
+            lower, counts = lower[probed], counts[probed]
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            found = rows[np.repeat(lower, counts) + offsets].astype(np.int64)
+            hits.append(np.repeat(probed // self.bands, counts) * len(self.names) + found)
+        hits = np.concatenate(hits) if hits else np.empty(0, dtype=np.int64)
+        return _sorted_unique(hits[self.alive[hits % len(self.names)]])  # a grid square counts once.
+
+    def _column_pairs(self, column: int):  # sorted i * rows + j keys of the pairs of rows sharing a band, i < j.
+        values, rows = self._tables[column]
+        live = self.alive[rows]
+        values, rows = values[live], rows[live]
+        starts = _run_starts(values)
+        sizes = np.diff(np.append(starts, len(values)))
+        kept = np.flatnonzero((sizes >= 2) & (sizes <= self.max_bucket))
+        # every row of a bucket pairs with the rows after it, rows are in ascending order within a bucket.
+        group = np.repeat(kept, sizes[kept])
+        first = starts[group] + (np.arange(len(group)) - np.repeat(np.cumsum(sizes[kept]) - sizes[kept], sizes[kept]))
+        later = starts[group] + sizes[group] - 1 - first
+        offsets = np.arange(later.sum()) - np.repeat(np.cumsum(later) - later, later)
+        first = np.repeat(first, later)
+        pairs = rows[first].astype(np.int64) * len(self.names) + rows[first + 1 + offsets]
+        return _sorted_unique(pairs)  # a grid square counts once, whatever band is shared.
+
+    def _merge_hits(self, pair_keys, pair_hits, pending: list, remaining: int):  # sums hits by pair, sparse.
+        new_keys = np.sort(np.concatenate(pending))
+        starts = _run_starts(new_keys)
+        # both runs are sorted, so the stable sort (timsort) only merges them.
+        order = np.argsort(np.concatenate([pair_keys, new_keys[starts]]), kind="stable")
+        keys = np.concatenate([pair_keys, new_keys[starts]])[order]
+        hits = np.concatenate([pair_hits, np.diff(np.append(starts, len(new_keys)))])[order]
+        starts = _run_starts(keys)
+        pair_keys, pair_hits = keys[starts], np.add.reduceat(hits, starts) if len(keys) else hits
+        possible = pair_hits + remaining >= self.min_hits  # drops the pairs that can't get enough hits anymore.
+        return pair_keys[possible], pair_hits[possible]
+
+    def _count_hits(self, column_keys) -> np.ndarray:  # keys hit in at least min_hits grid squares, from each column.
+        pair_keys, pair_hits = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        pending, pending_size = [], 0
+        num_columns = self.keys.shape[1] - 1
+        for column, keys in enumerate(column_keys, start=1):
+            pending.append(keys)
+            pending_size += len(keys)
+            if pending_size >= INDEX_MERGE_SIZE or column == num_columns:
+                pair_keys, pair_hits = self._merge_hits(pair_keys, pair_hits, pending, num_columns - column)
+                pending, pending_size = [], 0
+        return pair_keys
+
+    def _near_averages(self, average_1, average_2):
+        if self.average_radius is None:
+            return np.ones(len(average_1), dtype=bool)
+        return _popcount64(average_1 ^ average_2) <= self.average_radius
+
+    def _lookup(self, keys):  # returns (query row, index row) pairs with at least min_hits grid squares hit.
+        if self._pending_dirty:
+            self._pending_tables = self._build_tables(self._indexed, len(self.names))
+            self._pending_dirty = False
+        if len(self.names) == 0 or len(keys) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        pair_keys = self._count_hits(self._column_hits(keys[:, column], column)
+                                     for column in range(1, self.keys.shape[1]))
+        queries, found = np.divmod(pair_keys, len(self.names))
+        near = self._near_averages(keys[queries, 0], self.keys[found, 0])
+        return queries[near], found[near]
+
+    def candidates(self, image_data: dict) -> dict:
+        """
+        Looks up images that aren't necessarily in the index.
+
+        :param image_data: An image_data dict of the images to look up.
+        :return: Returns a dict of filename: list of candidate filenames in the index.
+        """
+
+        names, keys = self._entry_keys(image_data)
+        output = {name: [] for name in names}
+        if self.match_all:
+            alive = [self.names[row] for row in np.flatnonzero(self.alive)]
+            return {name: [other for other in alive if other != name] for name in names}
+        for query, row in zip(*self._lookup(keys)):
+            if self.names[row] != names[query]:
+                output[names[query]].append(self.names[row])
+        return output
+
+    def candidate_pairs(self) -> list:
+        """
+        Finds every candidate pair of images in the index, from the images that share band values, without a lookup
+        per image.
+
+        :return: Returns a list of (filename, filename) tuples, each pair once.
+        """
+
+        alive = np.flatnonzero(self.alive)
+        if self.match_all:
+            return [(self.names[i], self.names[j]) for num, i in enumerate(alive) for j in alive[num + 1:]]
+        if self._indexed < len(self.names):
+            self._tables, self._indexed = self._build_tables(0, len(self.names)), len(self.names)
+            self._pending_tables, self._pending_dirty = {}, False
+        if len(alive) < 2:
+            return []
+
+        pair_keys = self._count_hits(self._column_pairs(column) for column in range(1, self.keys.shape[1]))
+        first, second = np.divmod(pair_keys, len(self.names))
+        near = self._near_averages(self.keys[first, 0], self.keys[second, 0])
+        return [(self.names[i], self.names[j]) for i, j in zip(first[near].tolist(), second[near].tolist())]
+
+    def save(self, directory: Path):
+        """
+        Saves the index next to the json file, as hash_data/fp_hash_index.npz, replacing it atomically.
+        """
+
+        alive = np.flatnonzero(self.alive)
+        config = {"tiles": self.tiles, "cutoff": self.cutoff, "success_ratio": self.success_ratio,
+                  "bands": self.bands, "max_positions": len(self.positions), "average_radius": self.average_radius,
+                  "min_hits": self.min_hits, "max_bucket": self.max_bucket}
+        Path(directory, "hash_data").mkdir(exist_ok=True)
+        temp_path = Path(directory, "hash_data", "fp_hash_index.tmp.npz")
+        np.savez(temp_path, config=np.array(json.dumps(config)), names=np.array(self.names, dtype=str)[alive],
+                 keys=self.keys[alive])
+        os.replace(temp_path, Path(directory, "hash_data", "fp_hash_index.npz"))
+
+
+def load_index(directory: Path):
+    """
+    Loads a HashIndex saved with HashIndex.save().
+
+    :param directory: The image folder (that contains the hash_data folder).
+    :return: Returns a HashIndex object, or None if there is no saved index.
+    """
+
+    if not Path(directory, "hash_data", "fp_hash_index.npz").is_file():
+        return None
+    with np.load(Path(directory, "hash_data", "fp_hash_index.npz")) as saved:
+        index = HashIndex(**json.loads(str(saved["config"])))
+        index.names = [str(name) for name in saved["names"]]
+        index.keys = saved["keys"]
+    index.rows = {name: num for num, name in enumerate(index.names)}
+    index.alive = np.ones(len(index.names), dtype=bool)
+    index._tables, index._indexed = index._build_tables(0, len(index.names)), len(index.names)
+    return index
+
+
+def open_index(image_struct: ImageStruct, cutoff=0, success_ratio=0.3) -> HashIndex:
+    """
+    Loads the HashIndex saved in the ImageStruct's folder and brings it up to date with the image data: new images are
+    added, deleted ones removed and changed ones replaced, so a few new images cost a few lookups, not a rebuild. A new
+    index is built if there is none, or if it was made with other settings. It's saved again if it changed.
+
+    :param image_struct: An ImageStruct object with image data.
+    :param cutoff: The cutoff of compare_hashes().
+    :param success_ratio: The success ratio of compare_hashes().
+    :return: Returns a HashIndex object.
+    """
+
+    tiles = image_struct.metadata["grid_density"] ** 2
+    index = load_index(image_struct.directory)
+    changed = index is None or (index.tiles, index.cutoff, index.success_ratio) != (tiles, cutoff, success_ratio)
+    if changed:
+        index = HashIndex(tiles, cutoff, success_ratio)
+
+    image_data = image_struct.image_data
+    names, keys = index._entry_keys(image_data)
+    rows = np.array([index.rows.get(name, -1) for name in names], dtype=np.int64)
+    known = np.flatnonzero(rows >= 0)
+    stale = known[(index.keys[rows[known]] != keys[known]).any(axis=1)]  # rehashed since the index was saved.
+    removed = [name for name in index.rows if name not in image_data]
+    index.remove(removed)
+    index.add({names[num]: image_data[names[num]] for num in np.flatnonzero(rows < 0).tolist() + stale.tolist()})
+    if changed or removed or len(known) < len(names) or len(stale):
+        index.save(image_struct.directory)
+    return index
+
+
+FILE_OPS_JOURNAL = "fp_file_ops.journal"  # in the hash_data folder, only there while file operations are in progress.
+FILE_OPS_THREADS = 8  # renames done at once, mostly waiting on the filesystem (network drives).
+
+
+def plan_file_ops(image_struct: ImageStruct, moves: list, on_collision="suffix") -> list:
+    """
+    Plans a batch of renames/moves inside the ImageStruct's directory, before anything is touched. A target collides if
+    another move targets it too, or if a file that isn't moved away by the batch is already there. Chains and swaps
+    (a -> b while b -> c) are fine, see execute_file_ops(). Sources that don't exist (e.g. deleted since they were
+    hashed) are left out of the plan, and logged.
+
+    :param image_struct: An ImageStruct object.
+    :param moves: List of (source, target) paths relative to the directory (the image_data keys).
+    :param on_collision: "suffix" adds _1, _2... to the target's name, "skip" leaves the source where it is, and "error"
+                         raises a FileExistsError.
+    :return: Returns a list of operation dicts of source, temp (a temporary name next to the source) and target.
+    """
+
+    if on_collision not in ("suffix", "skip", "error"):
+        raise ValueError(f"Unknown collision policy: {on_collision}")
+
+    moves = list(dict((source, target) for source, target in moves if source != target).items())  # one per source.
+    missing = [source for source, _ in moves if not os.path.lexists(Path(image_struct.directory, source))]
+    if missing:
+        image_struct.pyqt_signal_dict["text_log"].emit(f"{len(missing)} files to move are gone, leaving them out: "
+                                                       + ", ".join(missing))
+        missing = set(missing)
+        moves = [(source, target) for source, target in moves if source not in missing]
+    skipped = set()
+    while True:  # a skipped move keeps its source occupied, which can make another move collide, so until it settles.
+        moving = {source for source, _ in moves if source not in skipped}
+        taken, operations, newly_skipped = set(), [], set()
+        for num, (source, target) in enumerate(moves):
+            if source in skipped:
+                continue
+            candidate, suffix = target, 0
+            while candidate in taken or (candidate not in moving and os.path.lexists(Path(image_struct.directory,
+                                                                                        candidate))):
+                if on_collision == "error":
+                    raise FileExistsError(f"Can't move {source} to {target}, the target is taken.")
+                if on_collision == "skip":
+                    candidate = None
+                    break
+                suffix += 1
+                stem, dot, extension = target.rpartition(".")
+                candidate = f"{stem}_{suffix}.{extension}" if dot else f"{target}_{suffix}"
+            if candidate is None:
+                newly_skipped.add(source)
+                continue
+            taken.add(candidate)
+            folder = source.rpartition("/")[0]
+            operations.append({"source": source, "temp": f"{folder + '/' if folder else ''}.dil_temp_{num}",
+                               "target": candidate})
+        if not newly_skipped:
+            return operations
+        skipped |= newly_skipped
+
+
+def _rename_all(directory: Path, pairs: list, max_workers: int, pyqt_signals: dict, progress_offset=0,
+                progress_total=None):  # renames (source, target) pairs on a thread pool.
+    # returns a tuple of (list of the pairs renamed, list of the errors of the others), every pair is tried.
+    done, errors = [], []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(os.rename, Path(directory, source), Path(directory, target)): (source, target)
+                   for source, target in pairs}
+        for num, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+            if future.exception() is not None:
+                errors.append(future.exception())
+            else:
+                done.append(futures[future])
+            if progress_total:
+                pyqt_signals["progress_bar"].emit(round(100 * (progress_offset + num) / progress_total))
+    return done, errors
+
+
+def _write_journal(path: Path, entry: dict):  # appends one line, on disk before the next step starts.
+    with open(path, "a") as journal_file:
+        journal_file.write(json.dumps(entry) + "\n")
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+
+
+def _rename_key(image_data, old_name, new_name):
+    if isinstance(image_data, ImageRecords):
+        image_data.rename(old_name, new_name)  # the row stays where it is.
+    else:
+        image_data[new_name] = image_data.pop(old_name)
+
+
+def _apply_file_ops(image_struct: ImageStruct, operations: list, drop: bool, reverse=False):
+    # renames (or with drop, deletes) the image_data keys of the moved files, in O(1) each. Like the files, keys go
+    # through their temporary names first, so a key that is also a target isn't overwritten before it is moved.
+    keys = [(operation["target"], operation["temp"], operation["source"]) if reverse else
+            (operation["source"], operation["temp"], operation["target"]) for operation in operations]
+    keys = [key for key in keys if key[0] in image_struct.image_data]
+    for old_name, temp_name, new_name in keys:
+        if drop:
+            del image_struct.image_data[old_name]
+        else:
+            _rename_key(image_struct.image_data, old_name, temp_name)
+    if not drop:
+        for old_name, temp_name, new_name in keys:
+            _rename_key(image_struct.image_data, temp_name, new_name)
+
+
+def _undo_renames(image_struct: ImageStruct, journal_path: Path, phases: list, max_workers: int, error: Exception):
+    # renames the pairs of each phase (latest phase first) back, then raises the error that stopped the batch. The
+    # journal is only removed if every file is back, otherwise recover_file_ops() can still finish the rollback.
+    image_struct.pyqt_signal_dict["text_log"].emit(f"File operations failed ({error}), undoing them...")
+    undo_errors = []
+    for pairs in phases:
+        undo_errors += _rename_all(image_struct.directory, [(target, source) for source, target in pairs],
+                                   max_workers, image_struct.pyqt_signal_dict)[1]
+    if not undo_errors:
+        journal_path.unlink()
+    raise error
+
+
+def execute_file_ops(image_struct: ImageStruct, operations: list, drop=False, max_workers=FILE_OPS_THREADS):
+    """
+    Executes planned file operations as one transaction: every source is renamed to its temporary name, then every
+    temporary name to its target (so targets that are also sources are free by then), each phase on a thread pool.
+    A journal in the hash_data folder records the plan and each finished phase, and the image data is updated and
+    saved once at the end, so an interrupted run can be finished or undone with recover_file_ops(). If a rename
+    fails, the renames already done are undone, and the error is raised with every file back at its source.
+
+    :param image_struct: An ImageStruct object, with its image data loaded.
+    :param operations: Operations from plan_file_ops().
+    :param drop: Removes the moved files from the image data (they were moved out of the image set), instead of
+                 renaming them.
+    :param max_workers: Number of renaming threads.
+    :return: No return value
+    """
+
+    if len(operations) == 0:
+        image_struct.save_data()
+        return
+    Path(image_struct.directory, "hash_data").mkdir(exist_ok=True)
+    journal_path = Path(image_struct.directory, "hash_data", FILE_OPS_JOURNAL)
+    _write_journal(journal_path, {"operations": operations, "drop": drop})
+
+    for folder in {operation["target"].rpartition("/")[0] for operation in operations} - {""}:
+        Path(image_struct.directory, folder).mkdir(parents=True, exist_ok=True)
+    done, errors = _rename_all(image_struct.directory,
+                               [(operation["source"], operation["temp"]) for operation in operations],
+                               max_workers, image_struct.pyqt_signal_dict, 0, 2 * len(operations))
+    if errors:
+        _undo_renames(image_struct, journal_path, [done], max_workers, errors[0])
+    _write_journal(journal_path, {"phase": "temp"})
+    done_targets, errors = _rename_all(image_struct.directory,
+                                       [(operation["temp"], operation["target"]) for operation in operations],
+                                       max_workers, image_struct.pyqt_signal_dict, len(operations),
+                                       2 * len(operations))
+    if errors:
+        _undo_renames(image_struct, journal_path, [done_targets, done], max_workers, errors[0])
+    _write_journal(journal_path, {"phase": "target"})
+
+    _apply_file_ops(image_struct, operations, drop)
+    image_struct.save_data()
+    _write_journal(journal_path, {"phase": "saved"})
+    journal_path.unlink()
+
+
+def recover_file_ops(image_struct: ImageStruct, rollback=False) -> bool:
+    """
+    Finishes (or with rollback, undoes) file operations that were interrupted, from the journal execute_file_ops()
+    left in the hash_data folder, and brings the saved image data in line with the files.
+
+    :param image_struct: An ImageStruct object.
+    :param rollback: Moves every file back to where it was before, instead of finishing the operations.
+    :return: Returns True if there was anything to recover.
+    """
+
+    journal_path = Path(image_struct.directory, "hash_data", FILE_OPS_JOURNAL)
+    if not journal_path.is_file():
+        return False
+    entries = []
+    with open(journal_path, "r") as journal_file:
+        for line in journal_file:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:  # a line torn by the interruption, nothing after it was done.
+                break
+    if len(entries) == 0:  # interrupted while writing the plan, before any file was touched.
+        journal_path.unlink()
+        return False
+    operations, drop = entries[0]["operations"], entries[0]["drop"]
+    temps_done = any(entry.get("phase") == "temp" for entry in entries[1:])
+    saved = any(entry.get("phase") == "saved" for entry in entries[1:])  # the image data has the new names.
+    directory = image_struct.directory
+    image_struct.pyqt_signal_dict["text_log"].emit(
+        f"{'Rolling back' if rollback else 'Finishing'} {len(operations)} interrupted file operations...")
+
+    # every file is at its source, its temporary name or its target. Targets are only written once every temporary
+    # name is, so without a finished temp phase, whatever isn't at a temporary name is still at its source. Files
+    # that aren't where they should be (deleted meanwhile) are left out, and logged.
+    at_temp, at_target, at_source, missing = [], [], [], []
+    for operation in operations:
+        if os.path.lexists(Path(directory, operation["temp"])):
+            at_temp.append(operation)
+        elif temps_done:
+            (at_target if os.path.lexists(Path(directory, operation["target"])) else missing).append(operation)
+        else:
+            (at_source if os.path.lexists(Path(directory, operation["source"])) else missing).append(operation)
+    if missing:
+        image_struct.pyqt_signal_dict["text_log"].emit(
+            f"{len(missing)} files of the interrupted operations are gone, leaving them out: "
+            + ", ".join(operation["source"] for operation in missing))
+
+    errors = []
+    if rollback:
+        errors += _rename_all(directory, [(operation["target"], operation["temp"]) for operation in at_target],
+                              FILE_OPS_THREADS, image_struct.pyqt_signal_dict)[1]
+        errors += _rename_all(directory,
+                              [(operation["temp"], operation["source"]) for operation in at_temp + at_target],
+                              FILE_OPS_THREADS, image_struct.pyqt_signal_dict)[1]
+    else:
+        for folder in {operation["target"].rpartition("/")[0] for operation in operations} - {""}:
+            Path(directory, folder).mkdir(parents=True, exist_ok=True)
+        errors += _rename_all(directory, [(operation["source"], operation["temp"]) for operation in at_source],
+                              FILE_OPS_THREADS, image_struct.pyqt_signal_dict)[1]
+        errors += _rename_all(directory,
+                              [(operation["temp"], operation["target"]) for operation in at_temp + at_source],
+                              FILE_OPS_THREADS, image_struct.pyqt_signal_dict)[1]
+    if errors:  # the journal stays, so recovering can be tried again once the cause is fixed.
+        raise errors[0]
+    operations = [operation for operation in operations if operation not in missing]
+
+    if image_struct.image_data is None:
+        image_struct.load_data()
+    if image_struct.image_data is not None and saved == rollback:
+        if not drop:  # files dropped before a rollback are hashed again as new files by update_data().
+            _apply_file_ops(image_struct, operations, drop, reverse=rollback)
+        elif not rollback:
+            _apply_file_ops(image_struct, operations, drop)
+        image_struct.save_data()
+    journal_path.unlink()
+    image_struct.pyqt_signal_dict["text_log"].emit("Done!")
+    return True
+
+
+def regroup_files(file_list: list, image_struct: ImageStruct,
+                  type_list: list, expression="%grp%-%grp_num%", on_collision="suffix"):
+    """
+
+    Renames the files of each group with a strfex expression, as one planned batch (see execute_file_ops()), then saves
+    the image data once.
+
+    :param file_list: Takes a list of files.
+    :param image_struct: Takes an ImageStruct object.
+    :param type_list: Takes a list of file types.
+    :param expression: A string formatted expression, or strfex. Check the strfex function for more info.
+    :param on_collision: What to do when a new name is taken, see plan_file_ops().
+    :return: No return value
+    """
+
+    moves = []
+    for i, file_list_2 in enumerate(file_list):
+        for i2, filename in enumerate(file_list_2):
+            file_type = f_type_return(filename, type_list)
+            if file_type in type_list:
+                moves.append((filename, strfex(expression, grp=i, grp_num=i2) + file_type))
+    try:
+        # finishes an interrupted run first, so the plan starts from the files as they are.
+        recover_file_ops(image_struct)
+        execute_file_ops(image_struct, plan_file_ops(image_struct, moves, on_collision))
+    except Exception as e:
+        image_struct.pyqt_signal_dict["text_log"].emit("regroup_files error: " + str(e))
+
+
+def product(x): return x[0] * x[1]  # can be tuple/list
+
+
+def move_files(new_folder: str, file_list: list, image_struct: ImageStruct, on_collision="suffix"):
+    """
+
+    Moves a list of files to a subdirectory in the current working directory, then returns the altered ImageStruct
+    object, without the moved files in the concerned image_data dict. The moves are one planned batch (see
+    execute_file_ops()), and the image data is saved once they are done.
+
+    :param new_folder: Name of the to-be-created subdirectory in the current working directory.
+    :param file_list: Takes a list of files to be moved.
+    :param image_struct: An ImageStruct object.
+    :param on_collision: What to do when a file of the same name was moved before, see plan_file_ops().
+    :return: Returns an ImageStruct object.
+    """
+
+    try:
+        recover_file_ops(image_struct)
+    except Exception as e:
+        image_struct.pyqt_signal_dict["text_log"].emit("move_files error: " + str(e))
+        return image_struct
+    image_struct.pyqt_signal_dict["text_log"].emit("Moving duplicates...")
+
+    moves = []
+    for grouped_files in file_list:
+        HQ_image = max(grouped_files, key=lambda file: product(image_struct.image_data[file]["size"]))
+        # the first of the highest resolution images is kept, all exact dupes are moved to another folder.
+        moves.extend((file, f"{new_folder}/{file}") for file in grouped_files if file != HQ_image)
+    try:
+        execute_file_ops(image_struct, plan_file_ops(image_struct, moves, on_collision), drop=True)
+        image_struct.pyqt_signal_dict["text_log"].emit("Done!")
+    except Exception as e:
+        image_struct.pyqt_signal_dict["text_log"].emit("move_files error: " + str(e))
+
+    return image_struct
+
+
+WATCH_INTERVAL = 1.0  # seconds between listings of a watched folder.
+WATCH_SETTLE = 1.0  # seconds a file is left unmodified before it's hashed, so half written files aren't.
+WATCH_FLUSH_INTERVAL = 60.0  # seconds between saves of the hashes of a watched folder, when they changed.
+
+
+def folder_notifier():  # inotify_simple (pip install inotify_simple), the optional change notifier, or None.
+    try:
+        import inotify_simple
+    except ImportError:
+        return None
+    return inotify_simple
+
+
+def _warm_worker(_):  # run once in every process of a new pool, so they are started before the first image arrives.
+    return os.getpid()
+
+
+class FolderWatcher:
+    def __init__(self, image_struct: ImageStruct, cutoff=12, success_ratio=0.3, grid_density=None, fast_decode=None,
+                 recursive=False, image_types=None, interval=WATCH_INTERVAL, settle=WATCH_SETTLE,
+                 flush_interval=WATCH_FLUSH_INTERVAL, notify=None):
+
+        """
+        Watches a folder for new and changed images, and finds the stored images each one matches (compare_hashes()
+        similar mode) within seconds of it arriving. What a run would set up and tear down is kept for as long as the
+        watcher runs: a warm pool of hashing processes (shared through ImageStruct.executor) and the packed image data,
+        so a new image only costs its own decode and one vectorized scan of the stored hashes. The hashes are saved
+        every flush_interval seconds if they changed, and when the watcher stops.
+
+        The folder is listed every interval seconds, or as soon as inotify reports a change (Linux, with inotify_simple
+        installed, and only for the top folder of a library). Removed images are dropped from the image data.
+
+        :param image_struct: An ImageStruct object of the watched folder.
+        :param cutoff: A grid square matches if its hamming distance is below the cutoff.
+        :param success_ratio: Ratio of grid squares that must match for the images to match.
+        :param grid_density: see ImageStruct.update_data().
+        :param fast_decode: see ImageStruct.update_data().
+        :param recursive: Watches the folder as a library, see ImageStruct.update_library().
+        :param image_types: List of file extensions, defaults to media_types().
+        :param interval: Max seconds between listings of the folder.
+        :param settle: Seconds a file has to be left unmodified before it is hashed.
+        :param flush_interval: Min seconds between saves of the hashes.
+        :param notify: Use inotify if it is available (None or True), or only list the folder every interval (False).
+        """
+
+        self.image_struct = image_struct
+        self.cutoff, self.success_ratio = cutoff, success_ratio
+        self.grid_density, self.fast_decode, self.recursive = grid_density, fast_decode, recursive
+        self.image_types = media_types() if image_types is None else image_types
+        self.interval, self.settle, self.flush_interval = interval, settle, flush_interval
+        self.notify = notify is not False and folder_notifier() is not None
+        self.executor, self.notifier = None, None
+        self.failed = dict()  # filename: fingerprint of the files that couldn't be hashed, until they change.
+        self.waiting = False  # files were left to settle by the last poll.
+        self.dirty, self.last_flush = False, time.monotonic()
+        self.stop_event = threading.Event()
+
+    def _listing(self) -> dict:  # filename: (size, mtime, inode) of every image in the folder.
+        if self.recursive:
+            return {name: _stat_key(os.stat(Path(self.image_struct.directory, name)))
+                    for name in scan_tree(self.image_struct.directory, self.image_types)}
+        return {entry.name: _stat_key(entry.stat(), entry.inode()) for entry in os.scandir(self.image_struct.directory)
+                if entry.is_file() and f_type_return(entry.name, self.image_types) in self.image_types}
+
+    def start(self):
+        """
+        Starts the process pool (and the notifier) and brings the saved hashes up to date with the folder. Called by
+        run().
+        """
+
+        image_struct = self.image_struct
+        num_proc = image_struct.allowed_cpu_cores
+        if num_proc > 1 and self.executor is None:
+            with image_struct.instruments.stage("start_pool"):
+                self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_proc)
+                list(self.executor.map(_warm_worker, range(num_proc)))
+            image_struct.executor = self.executor
+        if self.notify and self.notifier is None:
+            inotify_simple = folder_notifier()
+            self.notifier = inotify_simple.INotify()
+            flags = inotify_simple.flags
+            self.notifier.add_watch(str(image_struct.directory), flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE |
+                                    flags.DELETE | flags.MOVED_FROM | flags.ATTRIB)
+
+        try:
+            if self.recursive:
+                image_struct.update_library(self.grid_density, fast_decode=self.fast_decode,
+                                            image_types=self.image_types)
+            else:
+                image_struct.update_data(list_images(image_struct.directory, self.image_types), self.grid_density,
+                                         fast_decode=self.fast_decode)
+        except Exception as e:  # an unreadable file, the first poll hashes what is left one by one and skips it.
+            image_struct.pyqt_signal_dict["text_log"].emit(f"Could not hash every image at once: {e}")
+            if image_struct.image_data is None:
+                grid_density = self.grid_density or (image_struct.metadata or {}).get("grid_density", 10)
+                image_struct.generate_data([], grid_density, bool(self.fast_decode))
+        self.flush(force=True)
+        image_struct.pyqt_signal_dict["text_log"].emit(
+            f"Watching {image_struct.directory}, {len(image_struct.image_data)} images hashed.")
+
+    def poll(self) -> list:
+        """
+        Lists the folder once: hashes the settled new and changed images, matches them with the stored images and with
+        each other, and adds them to the image data. Removed images, and changed images that can't be hashed anymore,
+        are dropped.
+
+        :return: Returns a list of (filename, list of matching filenames) of the images hashed, in listing order.
+        """
+
+        image_struct, image_data = self.image_struct, self.image_struct.image_data
+        listing = self._listing()
+        removed = [name for name in image_data if name not in listing]
+        now, pending, self.waiting = time.time_ns(), [], False
+        for name, key in listing.items():
+            stored = image_data[name].get("file_stat") if name in image_data else None
+            if stored is None and name in image_data and modified_before_saved(image_struct.metadata, key[1]):
+                image_data[name]["file_stat"] = dict(zip(("st_size", "mtime_ns", "inode"), key))  # see update_data().
+                stored, self.dirty = image_data[name]["file_stat"], True
+            if (stored is not None and _stat_key(stored) == key) or self.failed.get(name) == key:
+                continue
+            if now - key[1] < self.settle * 1e9:
+                self.waiting = True  # still being written, or only just.
+                continue
+            pending.append(name)
+
+        for name in removed:
+            del image_data[name]
+        self.failed = {name: key for name, key in self.failed.items() if name in listing}
+        if removed:
+            self.dirty = True
+        if not pending:
+            return []
+
+        with image_struct.instruments.stage("watch_hash"):
+            new_data = self._hash(pending, listing)
+        for name in pending:
+            if name not in new_data and name in image_data:  # its old hashes no longer match the file.
+                del image_data[name]
+                self.dirty = True
+        if not new_data:
+            return []
+        with image_struct.instruments.stage("watch_match"):
+            results = self._match(new_data)
+        image_data.update(new_data)
+        self.dirty = True
+        image_struct.instruments.count("images_watched", len(new_data))
+        return results
+
+    def _hash(self, pending: list, listing: dict) -> dict:
+        image_struct = self.image_struct
+        grid_density = image_struct.metadata["grid_density"]
+        fast_decode = image_struct.metadata.get("fast_decode", False)
+        try:
+            return image_struct.hash_files(pending, grid_density, fast_decode)
+        except Exception:  # one unreadable file fails its whole batch, the others are hashed one by one.
+            new_data = dict()
+            for name in pending:
+                try:
+                    new_data.update(image_struct.generate_data_func(
+                        image_struct.directory, [name], grid_density, fast_decode=fast_decode,
+                        frame_sampling=image_struct.frame_sampling))
+                except Exception as e:
+                    self.failed[name] = listing[name]
+                    image_struct.pyqt_signal_dict["text_log"].emit(f"Could not hash {name}: {e}")
+            return new_data
+
+    def _match(self, new_data: dict) -> list:
+        records = self.image_struct.image_data
+        names, matrix = pack_hashes(new_data)
+        required = round(matrix.shape[1] * self.success_ratio)
+        matches = {name: [] for name in names}
+        for i, j in similarity_edges(matrix, self.cutoff, self.success_ratio).tolist():  # arrived together.
+            matches[names[i]].append(names[j])
+            matches[names[j]].append(names[i])
+
+        stored = records.hashes[:, 1:]
+        rows = [row for other, row in records.rows.items() if other not in new_data]  # not the old hashes of a change.
+        for num, name in enumerate(names):
+            matches[name] = [records.names[row] for row in match_rows(stored, matrix[num], self.cutoff, required, rows)
+                             ] + sorted(matches[name])
+        return [(name, matches[name]) for name in names]
+
+    def flush(self, force=False):
+        """
+        Saves the hashes if they changed since the last save (or if force is set).
+        """
+
+        if self.dirty or force:
+            self.image_struct.save_data()
+        self.dirty, self.last_flush = False, time.monotonic()
+
+    def _wait(self):
+        timeout = min(self.interval, self.settle) if self.waiting else self.interval
+        if self.notifier is not None:
+            self.notifier.read(timeout=round(timeout * 1000), read_delay=50)  # returns early on any change.
+        else:
+            self.stop_event.wait(timeout)
+
+    def run(self, max_polls=None):
+        """
+        Starts the watcher and polls the folder until stop() is called (from another thread, or a callback), or for
+        max_polls polls. The hashes are saved and the process pool shut down when it stops, however it stops.
+
+        :param max_polls: Optional max number of polls.
+        :return: Yields a tuple of (filename, list of matching filenames) for each new or changed image, as they are
+                 hashed.
+        """
+
+        try:
+            self.start()
+            polls = 0
+            while not self.stop_event.is_set() and (max_polls is None or polls < max_polls):
+                for filename, matches in self.poll():
+                    self.image_struct.pyqt_signal_dict["text_log"].emit(
+                        f"{filename}: {len(matches)} matches" + (": " + ", ".join(matches) if matches else ""))
+                    yield filename, matches
+                polls += 1
+                if self.dirty and time.monotonic() - self.last_flush >= self.flush_interval:
+                    self.flush()
+                if not self.stop_event.is_set() and (max_polls is None or polls < max_polls):
+                    self._wait()
+        finally:
+            self.close()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def close(self):
+        """
+        Saves the hashes if they changed, and shuts the process pool and the notifier down.
+        """
+
+        if self.image_struct.image_data is not None and self.dirty:
+            self.flush()
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = self.image_struct.executor = None
+        if self.notifier is not None:
+            self.notifier.close()
+            self.notifier = None
+
+
+def _stat_key(stat, inode=None) -> tuple:  # a fingerprint (see file_fingerprint()) as a tuple, from a stat or a dict.
+    if isinstance(stat, dict):
+        return stat["st_size"], stat["mtime_ns"], stat["inode"]
+    # the stat of a DirEntry has no inode on windows, DirEntry.inode() does.
+    return stat.st_size, stat.st_mtime_ns, stat.st_ino if inode is None else inode
 
 
 if __name__ == "__main__":
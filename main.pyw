@@ -24,6 +24,7 @@ class MainWindow(QMainWindow):
                         "progress_bar": QProgressBar(),
                         "checkbox_remove_json": QCheckBox("Remove previous json?"),
                         "checkbox_perfect_dupe": QCheckBox("Check for perfect dupes?"),
+                        "checkbox_library": QCheckBox("Scan every folder as one library?"),
                         "textbox_grid_density": QLineEdit(), "textbox_cutoff": QLineEdit(),
                         "textbox_strfex": QLineEdit(),
                         "text_combobox_cc": QLabel("Max CPU cores to be allowed?"),
@@ -37,14 +38,15 @@ class MainWindow(QMainWindow):
                       "text_log": (1, 3, 5, 1),
                       "button_confirm": (0, 3),
                       "checkbox_perfect_dupe": (5, 0, 1, 2), "checkbox_remove_json": (6, 0, 1, 2),
-                      "progress_bar": (7, 0, 1, 4)}
+                      "checkbox_library": (7, 0, 1, 2),
+                      "progress_bar": (8, 0, 1, 4)}
 
         self.allowed_cpu_cores = None
 
         self.thread, self.worker = None, None
         self.folder_name, self.folder_index, self.folder_file_len = None, None, None
         self.grid_density, self.cutoff, self.strfex = None, None, None
-        self.toggle_rj, self.toggle_pd = None, None
+        self.toggle_rj, self.toggle_pd, self.toggle_lib = None, None, None
         self.log = str()
 
         self.init_ui()
@@ -114,6 +116,7 @@ class MainWindow(QMainWindow):
 
         self.toggle_rj = self.widgets["checkbox_remove_json"].isChecked()
         self.toggle_pd = self.widgets["checkbox_perfect_dupe"].isChecked()
+        self.toggle_lib = self.widgets["checkbox_library"].isChecked()
 
         if self.grid_density > 20:
             self.log_print("Grid density is too high! Try a value of 20 or below.")
@@ -124,7 +127,7 @@ class MainWindow(QMainWindow):
         self.thread = QThread()
         self.worker = Worker(self.grid_density, self.cutoff, self.strfex,
                              self.toggle_rj, self.toggle_pd, self.folder_index,
-                             self.allowed_cpu_cores)
+                             self.allowed_cpu_cores, self.toggle_lib)
 
         self.worker.moveToThread(self.thread)
         self.thread.started.connect(self.worker.run)
@@ -141,7 +144,8 @@ class Worker(QObject):
     progress_update = pyqtSignal(int)
     log_update = pyqtSignal(str)
 
-    def __init__(self, grid_density, cutoff, strfex, toggle_rj, toggle_pd, folder_index, allowed_cpu_cores):
+    def __init__(self, grid_density, cutoff, strfex, toggle_rj, toggle_pd, folder_index, allowed_cpu_cores,
+                 toggle_lib=False):
         super().__init__()
 
         self.grid_density = grid_density
@@ -151,13 +155,19 @@ class Worker(QObject):
         self.toggle_pd = toggle_pd
         self.folder_index = folder_index
         self.allowed_cpu_cores = allowed_cpu_cores
+        self.toggle_lib = toggle_lib
 
     def run(self):
 
         pyqt_signal_dict = {"progress_bar": self.progress_update,
                             "text_log": self.log_update}
 
-        image_types = [".png", ".jpeg", ".jpg"]
+        image_types = dil.media_types()  # GIFs, APNGs and WebPs too, and videos if PyAV is installed.
+
+        if self.toggle_lib:
+            self.run_library(pyqt_signal_dict, image_types)
+            return
+
         folders = [_.name for _ in Path.cwd().glob("*") if _.is_dir()]
         image_folder = Path(Path.cwd(), folders[self.folder_index])
         image_files = [_ for _ in image_folder.glob("*") if dil.f_type_return(_, image_types) in image_types]
@@ -169,30 +179,30 @@ class Worker(QObject):
         image_struct = dil.ImageStruct(directory=image_folder, allowed_cpu_cores=self.allowed_cpu_cores,
                                        pyqt_signals=pyqt_signal_dict)
 
-        if not dil.check_json_exists(image_folder):
+        if not dil.check_data_exists(image_folder):
             dil.rename_to_num(image_folder, image_files, "_", image_types)
             image_files = [_.name for _ in image_folder.glob("*") if dil.f_type_return(_, image_types) in image_types]
             image_struct.generate_data(grid_density=self.grid_density, file_list=image_files)
         else:
             if self.toggle_rj:
                 dil.rename_to_num(image_folder, image_files, "_", image_types)
-                Path(image_folder, "hash_data", "fp_hash_data.json").unlink()  # removing/unlinking the json file
+                for hash_file in ("fp_hash_data.json", "fp_hash_data.bin"):  # removing/unlinking the saved hashes
+                    if Path(image_folder, "hash_data", hash_file).is_file():
+                        Path(image_folder, "hash_data", hash_file).unlink()
                 image_files = [_.name for _ in image_folder.glob("*") if
                                dil.f_type_return(_, image_types) in image_types]
                 image_struct.generate_data(grid_density=self.grid_density, file_list=image_files)
             else:
-                image_struct.load_data()
+                image_struct.update_data(file_list=[_.name for _ in image_files], grid_density=self.grid_density)
+                # only hashes the new and changed files, and drops the removed ones.
 
         if self.toggle_pd:
-            remove_list = dil.cross_compare_list(image_struct,
-                                                 dil.compare_hashes, mode="identical")
-            # will default to similar, i.e. cutoff 0. this is to remove identical duplicate
-            image_struct = dil.move_files("moved_images", remove_list[1], image_struct)
-            image_struct.save_data()
+            remove_list = dil.group_identical(image_struct)
+            # buckets by average_hash, this is to remove identical duplicates
+            image_struct = dil.move_files("moved_images", remove_list[1], image_struct)  # saves the hashes once done.
 
         try:
-            dupe_list = dil.cross_compare_list(image_struct,
-                                               dil.compare_hashes, cutoff=self.cutoff, mode="similar")
+            dupe_list = dil.cross_compare_matrix(image_struct, cutoff=self.cutoff)
             # this is to group similar images
         except:
             traceback.print_exc()
@@ -204,9 +214,59 @@ class Worker(QObject):
             dil.regroup_files(dupe_list[1], image_struct, type_list=image_types,
                               expression=self.strfex)
 
+        self.log_sequence_groups(image_struct)
         self.log_update.emit("Finished!")
         self.finished.emit()
 
+    def run_library(self, pyqt_signal_dict, image_types):
+        # every image folder under the current working directory in one store, keyed by relative path, seeded from the
+        # folders' own hashes. Files are left where they are (apart from moving perfect dupes), groups are only listed.
+        # The files next to the program aren't in an image folder, and hidden folders (.git...) aren't scanned.
+
+        image_struct = dil.ImageStruct(directory=Path.cwd(), allowed_cpu_cores=self.allowed_cpu_cores,
+                                       pyqt_signals=pyqt_signal_dict)
+        if self.toggle_rj:
+            for hash_file in ("fp_hash_data.json", "fp_hash_data.bin"):
+                if Path(Path.cwd(), "hash_data", hash_file).is_file():
+                    Path(Path.cwd(), "hash_data", hash_file).unlink()
+        if len(image_struct.update_library(grid_density=self.grid_density, image_types=image_types,
+                                                 root_files=False)) == 0:
+            self.log_update.emit("No images in this library!")
+            self.finished.emit()
+            return
+        image_struct.save_data()
+
+        if self.toggle_pd:
+            remove_list = dil.group_identical(image_struct)
+            image_struct = dil.move_files("moved_images", remove_list[1], image_struct)  # saves the hashes once done.
+
+        try:
+            dupe_list = dil.cross_compare_matrix(image_struct, cutoff=self.cutoff)
+        except:
+            traceback.print_exc()
+            dupe_list = [[], []]
+
+        if len(dupe_list[1]) == 0:
+            self.log_update.emit("No similar duplicates!")
+        for num, group in enumerate(dupe_list[1]):
+            self.log_update.emit(f"Group {num}: " + ", ".join(group))
+
+        self.log_sequence_groups(image_struct)
+        self.log_update.emit("Finished!")
+        self.finished.emit()
+
+    def log_sequence_groups(self, image_struct):
+        # animations and videos that are copies or clips of each other, by their frames. Only listed, not regrouped.
+        if not dil.frame_sequences(image_struct.image_data):
+            return
+        try:
+            sequence_list = dil.cross_compare_sequences(image_struct)
+        except:
+            traceback.print_exc()
+            return
+        for num, group in enumerate(sequence_list[1]):
+            self.log_update.emit(f"Animation group {num}: " + ", ".join(group))
+
 
 def main():
     app = QApplication(sys.argv)
@@ -0,0 +1,29 @@
+import pytest
+
+import dupe_image_lib as dil
+from tests.helpers import noise_image
+
+
+@pytest.fixture
+def image_folder(tmp_path):
+    """
+    A folder of six different PNGs, 000.png to 005.png.
+    """
+
+    for seed in range(6):
+        noise_image(seed).save(tmp_path / f"{seed:03d}.png")
+    return tmp_path
+
+
+@pytest.fixture
+def hashed_struct(image_folder):
+    """
+    A single process ImageStruct of image_folder, hashed and saved, that keeps its log in a list.
+    """
+
+    log = []
+    image_struct = dil.ImageStruct(image_folder, 1, pyqt_signals=dil.make_signals(log=log.append))
+    image_struct.log = log
+    image_struct.generate_data(dil.list_images(image_folder), grid_density=4)
+    image_struct.save_data()
+    return image_struct
@@ -0,0 +1,46 @@
+import numpy as np
+from PIL import Image
+
+
+def noise_image(seed: int, size=(240, 240), cells=12, mode="RGB") -> Image.Image:
+    """
+    A smooth random image (bicubic upscaled noise), different for every seed and stable across runs.
+    """
+
+    rng = np.random.default_rng(seed)
+    small = Image.fromarray(rng.integers(0, 256, (cells, cells, 3), dtype=np.uint8))
+    return small.resize(size, Image.BICUBIC).convert(mode)
+
+
+def random_hashes(rng, shape) -> np.ndarray:  # uniform over all 64 bits.
+    return rng.integers(0, 2 ** 64, size=shape, dtype=np.uint64, endpoint=False)
+
+
+def flip_bits(rng, values: np.ndarray, max_bits: int) -> np.ndarray:
+    """
+    Flips up to max_bits random bits of each value, for near duplicate hashes.
+    """
+
+    output = values.copy()
+    for index in np.ndindex(values.shape):
+        for bit in rng.choice(64, size=rng.integers(0, max_bits + 1), replace=False):
+            output[index] ^= np.uint64(1) << np.uint64(bit)
+    return output
+
+
+def near_duplicate_data(rng, num_images: int, num_near: int, cutoff: int, tiles=64, success_ratio=0.3) -> dict:
+    """
+    An image_data dict of random hashes, where the last num_near images are near duplicates of the first ones: a close
+    average hash, and around the required number of grid squares within the cutoff, so some pairs only just match
+    (or just miss). Image num and num_images - 1 - num are a near duplicate pair.
+    """
+
+    hashes = random_hashes(rng, (num_images, 1 + tiles))
+    required = round(tiles * success_ratio)
+    for num in range(num_near):
+        row = num_images - 1 - num
+        close = rng.choice(tiles, size=min(tiles, required - 2 + num % 5), replace=False) + 1
+        hashes[row, close] = flip_bits(rng, hashes[num, close], max(0, cutoff - 1))
+        hashes[row, 0] = flip_bits(rng, hashes[num, :1], 8)[0]
+    return {f"{num:04}.png": {"filename": f"{num:04}.png", "size": (320, 240), "average_hash": f"{hashes[num, 0]:016x}",
+                              "hash_list": [f"{value:016x}" for value in hashes[num, 1:]]} for num in range(num_images)}
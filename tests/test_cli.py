@@ -0,0 +1,39 @@
+import json
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+import dupe_image_lib as dil
+
+RUN_CLI = """
+import sys
+sys.modules["PyQt5"] = None  # any import of PyQt5 fails.
+import dupe_image_cli
+dupe_image_cli.main(sys.argv[1:])
+assert not [name for name, module in sys.modules.items() if name.startswith("PyQt5") and module is not None]
+"""
+
+
+def run_cli(*args) -> str:
+    result = subprocess.run([sys.executable, "-c", RUN_CLI, *map(str, args)], cwd=Path(__file__).parents[1],
+                            capture_output=True, text=True, timeout=300)
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+
+def test_hash_dedupe_and_export_without_pyqt(image_folder, tmp_path_factory):
+    shutil.copyfile(image_folder / "002.png", image_folder / "010.png")
+    output = tmp_path_factory.mktemp("output") / "groups.json"
+
+    run_cli("hash", image_folder, "--grid-density", "4", "--cores", "2")
+    assert (image_folder / "hash_data" / "fp_hash_data.bin").is_file()
+
+    run_cli("dedupe", image_folder, "--output", output)
+    assert json.loads(output.read_text())["groups"] == [["002.png", "010.png"]]
+    assert json.loads(run_cli("dedupe", image_folder, "--by-digest"))["groups"] == [["002.png", "010.png"]]
+
+    run_cli("export", image_folder, "--format", "json")
+    saved = json.loads((image_folder / "hash_data" / "fp_hash_data.json").read_text())
+    assert saved["metadata"]["grid_density"] == 4
+    assert sorted(saved["image_data"]) == dil.list_images(image_folder)
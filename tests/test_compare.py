@@ -0,0 +1,90 @@
+import collections
+import shutil
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import dupe_image_lib as dil
+from tests.helpers import near_duplicate_data
+
+
+def hashed_struct_of(image_data: dict, records=False) -> dil.ImageStruct:
+    image_struct = dil.ImageStruct(".", 1, pyqt_signals=dil.make_signals())
+    image_struct.image_data = dil.ImageRecords.from_dict(image_data) if records else image_data
+    return image_struct
+
+
+@pytest.mark.parametrize("cascade", [{}, {"average_radius": 20, "sample_size": 16, "sample_ratio": 0.2},
+                                     {"average_radius": 64, "sample_size": 0}])
+def test_cascade_matrix_matches_cascade_mode(cascade):
+    image_data = near_duplicate_data(np.random.default_rng(5), 160, 40, 12)
+    legacy = dil.cross_compare_list(hashed_struct_of(image_data, records=True), dil.compare_hashes, cutoff=12,
+                                    success_ratio=0.3, mode="cascade", **cascade)
+    stats = collections.Counter()
+    names, matrix = dil.pack_hashes(image_data)
+    edges = dil.similarity_edges(matrix, 12, 0.3, cascade=cascade, averages=dil.pack_averages(image_data), stats=stats)
+    assert dil.greedy_groups(names, edges) == legacy
+    assert len(legacy[1]) >= 20
+    assert stats["pairs"] == 160 * 159 // 2
+    assert stats["accepted_early"] + stats["accepted_full"] == len(edges)
+    assert sum(stats[stage] for stage in dil.CASCADE_STAGES) == stats["pairs"]
+
+    image_struct = hashed_struct_of(image_data, records=True)
+    assert dil.cross_compare_matrix(image_struct, 12, 0.3, num_proc=2, block_size=32, cascade=cascade) == legacy
+
+
+def test_greedy_groups_match_similar_mode():
+    image_data = near_duplicate_data(np.random.default_rng(7), 150, 40, 12)
+    legacy = dil.cross_compare_list(hashed_struct_of(image_data, records=True), dil.compare_hashes, cutoff=12,
+                                    success_ratio=0.3, mode="similar")
+    names, matrix = dil.pack_hashes(image_data)
+    assert dil.greedy_groups(names, dil.similarity_edges(matrix, 12, 0.3)) == legacy
+    assert len(legacy[1]) >= 20
+    assert dil.cross_compare_matrix(hashed_struct_of(image_data, records=True), 12, 0.3) == legacy
+
+
+def test_cluster_groups():
+    names = ["a", "b", "c", "d", "e", "f"]
+    edges = np.array([[0, 1], [0, 4], [1, 2], [1, 4], [3, 5]])  # a~b~c is a chain, a, b and e all match.
+    assert dil.greedy_groups(names, edges)[1] == [["a", "b", "e"], ["d", "f"]]
+    assert dil.cluster_groups(names, edges, "single") == [["a", "b", "c", "e", "d", "f"],
+                                                           [["a", "b", "c", "e"], ["d", "f"]]]
+    assert dil.cluster_groups(names, edges, "complete")[1] == [["a", "b", "e"], ["d", "f"]]  # c only matches b.
+    assert dil.cluster_groups(names, edges[::-1], "single") == dil.cluster_groups(names, edges, "single")
+    with pytest.raises(ValueError):
+        dil.cluster_groups(names, edges, "average")
+
+
+@pytest.mark.parametrize("block_size", [16, 50])
+def test_parallel_edges_match_serial(block_size):
+    image_data = near_duplicate_data(np.random.default_rng(8), 200, 50, 12)
+    names, matrix = dil.pack_hashes(image_data)
+    serial = dil.similarity_edges(matrix, 12, 0.3, block_size=block_size)
+    parallel = dil.similarity_edges_parallel(matrix, 2, 12, 0.3, block_size=block_size, blocks_per_task=1)
+    assert len(serial) >= 25
+    assert np.array_equal(parallel, serial)
+
+
+def test_cascade_without_average_radius_matches_similar():
+    image_data = near_duplicate_data(np.random.default_rng(6), 120, 30, 12)
+    names, matrix = dil.pack_hashes(image_data)
+    cascade = {"average_radius": 64, "sample_ratio": 0}
+    averages = dil.pack_averages(image_data)
+    assert np.array_equal(dil.similarity_edges(matrix, 12, 0.3, cascade=cascade, averages=averages),
+                          dil.similarity_edges(matrix, 12, 0.3))
+
+
+def test_group_identical(image_folder):
+    shutil.copyfile(image_folder / "003.png", image_folder / "010.png")
+    shutil.copyfile(image_folder / "001.png", image_folder / "011.png")
+    with Image.open(image_folder / "001.png") as image:
+        image.save(image_folder / "012.png", compress_level=1)  # the same pixels, other bytes.
+    image_struct = dil.ImageStruct(image_folder, 1, pyqt_signals=dil.make_signals())
+    image_struct.generate_data(dil.list_images(image_folder), grid_density=4)
+
+    groups = [["001.png", "011.png", "012.png"], ["003.png", "010.png"]]  # in image_data order, within and across.
+    assert dil.group_identical(image_struct) == [[name for group in groups for name in group], groups]
+    legacy = dil.cross_compare_list(image_struct, dil.compare_hashes, mode="identical")
+    assert dil.group_identical(image_struct) == legacy
+    assert dil.group_identical(image_struct, by_digest=True)[1] == [["001.png", "011.png"], ["003.png", "010.png"]]
@@ -0,0 +1,104 @@
+from pathlib import Path
+
+import pytest
+
+import dupe_image_lib as dil
+
+
+class Interrupted(Exception):
+    pass
+
+
+def leftovers(directory: Path) -> list:  # temporary names and the journal, nothing of a finished batch.
+    temps = [path.name for path in directory.rglob(".dil_temp_*")]
+    return temps + [path.name for path in directory.glob(f"hash_data/{dil.FILE_OPS_JOURNAL}")]
+
+
+def test_move_skips_deleted_source(hashed_struct):
+    directory = hashed_struct.directory
+    Path(directory, "001.png").unlink()
+
+    dil.move_files("moved_images", [["000.png", "001.png", "002.png"]], hashed_struct)
+
+    assert Path(directory, "moved_images", "002.png").is_file()
+    assert leftovers(directory) == []
+    assert "002.png" not in hashed_struct.image_data
+    assert not any("error" in line for line in hashed_struct.log)
+
+    dil.regroup_files([["003.png", "004.png"]], hashed_struct, dil.IMAGE_TYPES, expression="%grp%-%grp_num%")
+    assert Path(directory, "000-000.png").is_file() and Path(directory, "000-001.png").is_file()
+    assert not any("error" in line for line in hashed_struct.log)
+
+
+def test_failed_rename_is_undone(hashed_struct, monkeypatch):
+    directory = hashed_struct.directory
+    rename = dil.os.rename
+
+    def failing_rename(source, target):
+        if Path(target).name == "b.png":
+            raise PermissionError(f"can't write {target}")
+        rename(source, target)
+
+    monkeypatch.setattr(dil.os, "rename", failing_rename)
+    operations = dil.plan_file_ops(hashed_struct, [("000.png", "a.png"), ("001.png", "b.png"), ("002.png", "c.png")])
+    with pytest.raises(PermissionError):
+        dil.execute_file_ops(hashed_struct, operations)
+
+    assert sorted(path.name for path in directory.glob("*.png")) == [f"{num:03d}.png" for num in range(6)]
+    assert leftovers(directory) == []
+    assert sorted(hashed_struct.image_data) == [f"{num:03d}.png" for num in range(6)]
+
+
+def interrupt_batch(image_struct, monkeypatch, moves):
+    # fails the rename to b.png, and stops before anything is undone, like a crash in the middle of the target phase.
+    rename = dil.os.rename
+
+    def failing_rename(source, target):
+        if Path(target).name == "b.png":
+            raise OSError("disk gone")
+        rename(source, target)
+
+    def crash(*args):
+        raise Interrupted
+
+    monkeypatch.setattr(dil.os, "rename", failing_rename)
+    monkeypatch.setattr(dil, "_undo_renames", crash)
+    with pytest.raises(Interrupted):
+        dil.execute_file_ops(image_struct, dil.plan_file_ops(image_struct, moves))
+    monkeypatch.undo()
+
+
+@pytest.mark.parametrize("rollback", [False, True])
+def test_interrupted_batch_recovers(hashed_struct, monkeypatch, rollback):
+    directory = hashed_struct.directory
+    moves = [("000.png", "a.png"), ("001.png", "b.png"), ("002.png", "000.png")]  # a chain, 000.png is reused.
+    interrupt_batch(hashed_struct, monkeypatch, moves)
+    assert Path(directory, "hash_data", dil.FILE_OPS_JOURNAL).is_file()
+
+    reloaded = dil.ImageStruct(directory, 1)
+    assert dil.recover_file_ops(reloaded, rollback=rollback)
+
+    expected = ["000.png", "001.png", "002.png"] if rollback else ["000.png", "a.png", "b.png"]
+    assert sorted(path.name for path in directory.glob("*.png")) == sorted(expected + ["003.png", "004.png", "005.png"])
+    assert leftovers(directory) == []
+    reloaded.load_data()
+    assert sorted(reloaded.image_data) == sorted(expected + ["003.png", "004.png", "005.png"])
+    if not rollback:  # the hashes moved with the files.
+        assert reloaded.image_data["000.png"]["average_hash"] == hashed_struct.image_data["002.png"]["average_hash"]
+
+
+def test_recover_skips_missing_files(hashed_struct, monkeypatch):
+    directory = hashed_struct.directory
+    interrupt_batch(hashed_struct, monkeypatch, [("000.png", "a.png"), ("001.png", "b.png")])
+    for temp in directory.glob(".dil_temp_*"):
+        temp.unlink()  # the file that didn't make it to its target is deleted before recovering.
+
+    log = []
+    reloaded = dil.ImageStruct(directory, 1, pyqt_signals=dil.make_signals(log=log.append))
+    assert dil.recover_file_ops(reloaded)
+    assert leftovers(directory) == []
+    assert any("gone" in line for line in log)
+
+    reloaded.load_data()
+    dil.move_files("moved_images", [["a.png", "003.png"]], reloaded)
+    assert not any("error" in line for line in log)
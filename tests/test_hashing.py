@@ -0,0 +1,93 @@
+import concurrent.futures
+import shutil
+import time
+
+import imagehash
+import pytest
+from PIL import Image
+
+import dupe_image_lib as dil
+from tests.helpers import noise_image
+
+
+@pytest.mark.parametrize("size, mode, grid_density", [((240, 240), "RGB", 4), ((333, 201), "RGBA", 10),
+                                                     ((1000, 37), "L", 10), ((97, 512), "P", 7)])
+def test_grid_hashes_match_imagehash(size, mode, grid_density):
+    image = noise_image(7, size=size, mode="RGB" if mode == "P" else mode)
+    image = image.convert(mode)
+    x, y = image.size
+    step_x, step_y = x / grid_density, y / grid_density
+    expected = [imagehash.average_hash(image.crop((x_grid * step_x, y_grid * step_y,
+                                                   (x_grid + 1) * step_x, (y_grid + 1) * step_y)))
+                for x_grid in range(grid_density) for y_grid in range(grid_density)]
+
+    average, hash_list = dil.grid_hashes(image, grid_density)
+    assert str(average) == str(imagehash.average_hash(image))
+    assert [str(value) for value in hash_list] == [str(value) for value in expected]
+
+
+@pytest.mark.parametrize("mode, suffix", [("P", ".gif"), ("1", ".png"), ("LA", ".png")])
+def test_open_reduced_modes(tmp_path, mode, suffix):
+    path = tmp_path / f"large{suffix}"
+    noise_image(3, size=(1300, 1300), mode="RGBA" if mode == "LA" else "RGB").convert(mode).save(path)
+
+    with Image.open(path) as image:
+        assert image.mode == mode
+        reduced = dil.open_reduced(image, 10)
+        assert reduced.size == (325, 325)
+        fast = dil.grid_hashes(reduced, 10)
+    with Image.open(path) as image:
+        full = dil.grid_hashes(image, 10)
+    assert max(a - b for a, b in zip(full[1], fast[1])) <= 12
+
+
+def test_fast_decode_large_gif(tmp_path):
+    noise_image(4, size=(1300, 1300)).convert("P").save(tmp_path / "large.gif")
+    image_struct = dil.ImageStruct(tmp_path, 1, pyqt_signals=dil.make_signals())
+    image_struct.generate_data(["large.gif"], grid_density=10, fast_decode=True)
+    assert len(image_struct.image_data["large.gif"]["hash_list"]) == 100
+
+
+def delayed(num: int, delay: float) -> int:  # a picklable task for the pool, the slow ones finish last.
+    time.sleep(delay)
+    return num
+
+
+@pytest.mark.parametrize("with_executor", [False, True])
+def test_imap_orders(with_executor):
+    batches = [(num, 0.5 if num == 0 else 0.01) for num in range(12)]
+    proc_manager = dil.ProcessManager(dil.make_signals())
+    with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
+        executor = executor if with_executor else None
+        assert list(proc_manager.imap(delayed, batches, 2, window=3, executor=executor, ordered=True)) == \
+               list(range(12))
+        finished = list(proc_manager.imap(delayed, batches, 2, window=3, executor=executor))
+        assert sorted(finished) == list(range(12)) and finished[0] != 0  # the slow batch doesn't hold the others up.
+        if with_executor:
+            assert executor.submit(delayed, 12, 0).result() == 12  # left running.
+
+
+@pytest.mark.parametrize("cores", [1, 2])
+def test_identical_files_are_hashed_once(image_folder, cores):
+    for source, copy in (("001.png", "010.png"), ("001.png", "011.png"), ("003.png", "012.png")):
+        shutil.copyfile(image_folder / source, image_folder / copy)
+    with Image.open(image_folder / "004.png") as image:
+        image.save(image_folder / "013.png", compress_level=1)  # the same pixels, other bytes, so it's decoded.
+    instruments = dil.Instruments()
+    image_struct = dil.ImageStruct(image_folder, cores, pyqt_signals=dil.make_signals(), instruments=instruments)
+    image_struct.generate_data(dil.list_images(image_folder), grid_density=4)
+
+    assert instruments.counters["images_copied"] == 3
+    assert instruments.counters["images_decoded"] == 7
+    assert image_struct.identical_sets == [["001.png", "010.png", "011.png"], ["003.png", "012.png"]]
+    assert list(image_struct.image_data) == dil.list_images(image_folder)
+    for source, copy in (("001.png", "010.png"), ("001.png", "011.png"), ("003.png", "012.png")):
+        entry, source_entry = image_struct.image_data[copy], image_struct.image_data[source]
+        assert list(entry["hash_list"]) == list(source_entry["hash_list"])
+        assert entry["average_hash"] == source_entry["average_hash"] and entry["size"] == source_entry["size"]
+        assert entry["file_stat"]["inode"] == (image_folder / copy).stat().st_ino  # its own fingerprint.
+        assert entry["file_stat"]["digest"] == source_entry["file_stat"]["digest"]
+
+    every_file = dil.ImageStruct(image_folder, cores, pyqt_signals=dil.make_signals(), instruments=dil.Instruments())
+    every_file.hash_files(dil.list_images(image_folder), 4, skip_identical=False)
+    assert every_file.instruments.counters["images_decoded"] == 10
@@ -0,0 +1,106 @@
+import shutil
+
+import numpy as np
+import pytest
+
+import dupe_image_lib as dil
+from tests.helpers import near_duplicate_data
+
+
+TILES = 64
+
+
+def make_image_data(rng, num_images: int, num_near: int, cutoff: int) -> dict:
+    return near_duplicate_data(rng, num_images, num_near, cutoff, TILES)
+
+
+def edge_pairs(image_data: dict, cutoff: int, success_ratio=0.3) -> set:
+    names, matrix = dil.pack_hashes(image_data)
+    return {(names[i], names[j]) for i, j in dil.similarity_edges(matrix, cutoff, success_ratio)}
+
+
+@pytest.mark.parametrize("cutoff", [3, 8, 12])
+@pytest.mark.parametrize("bands", [None, 4])
+def test_candidate_pairs_recall(cutoff, bands):
+    rng = np.random.default_rng(cutoff)
+    image_data = make_image_data(rng, 300, 40, cutoff)
+    edges = edge_pairs(image_data, cutoff)
+    index = dil.HashIndex(TILES, cutoff, 0.3, bands=bands)
+    index.add(image_data)
+    pairs = {tuple(sorted(pair)) for pair in index.candidate_pairs()}
+    near = {(f"{num:04}.png", f"{299 - num:04}.png") for num in range(40)}
+    assert len(edges) >= 20
+    assert len(edges & pairs) >= 0.9 * len(edges)
+    if cutoff <= index.bands:  # a close grid square always shares a band.
+        assert edges <= pairs
+    assert pairs - edges <= near  # only near misses, random pairs almost never share enough bands.
+    assert sorted(index.candidates(image_data)["0000.png"]) == sorted(j for i, j in pairs if i == "0000.png")
+
+
+def test_common_band_values_are_skipped():
+    rng = np.random.default_rng(3)
+    image_data = make_image_data(rng, 200, 30, 12)
+    flat = sorted(image_data)[30:110]
+    for name in flat:  # 80 unrelated images with the same flat grid squares, matching each other.
+        image_data[name]["hash_list"][:TILES // 2] = ["0" * 16] * (TILES // 2)
+    edges = edge_pairs(image_data, 12)
+    near = {(f"{num:04}.png", f"{199 - num:04}.png") for num in range(30)}
+
+    index = dil.HashIndex(TILES, 12, 0.3, max_bucket=64)
+    index.add(image_data)
+    pairs = {tuple(sorted(pair)) for pair in index.candidate_pairs()}
+    assert not {(i, j) for i, j in pairs if i in flat and j in flat}
+    assert len(edges & near & pairs) >= 0.9 * len(edges & near)
+
+    index = dil.HashIndex(TILES, 12, 0.3, max_bucket=len(flat))
+    index.add(image_data)
+    assert edges <= {tuple(sorted(pair)) for pair in index.candidate_pairs()}
+
+
+def test_candidates_of_new_images():
+    rng = np.random.default_rng(1)
+    image_data = make_image_data(rng, 300, 40, 12)
+    edges = edge_pairs(image_data, 12)
+    names = sorted(image_data)
+    index = dil.HashIndex(TILES, 12, 0.3)
+    index.add({name: image_data[name] for name in names[:200]})
+    index.add({name: image_data[name] for name in names[200:250]})  # stays in the pending tables.
+    index.remove(names[:10])
+    queries = {name: image_data[name] for name in names[250:]}
+    found = {(name, other) for name, others in index.candidates(queries).items() for other in others}
+    expected = {(j, i) for i, j in edges if j in queries and i in names[10:250]}
+    assert len(expected) >= 5
+    assert len(expected & found) >= 0.9 * len(expected)
+    assert not {other for name, other in found if other in names[:10]}
+
+
+def test_max_positions_and_save_load(tmp_path):
+    rng = np.random.default_rng(2)
+    image_data = make_image_data(rng, 200, 30, 12)
+    edges = edge_pairs(image_data, 12)
+    index = dil.HashIndex(TILES, 12, 0.3, max_positions=TILES - round(TILES * 0.3) + 1)
+    index.add(image_data)
+    assert len(edges & {tuple(sorted(pair)) for pair in index.candidate_pairs()}) >= 0.9 * len(edges)
+
+    index.save(tmp_path)
+    loaded = dil.load_index(tmp_path)
+    assert sorted(map(sorted, loaded.candidate_pairs())) == sorted(map(sorted, index.candidate_pairs()))
+
+
+def test_open_index_keeps_the_saved_index_up_to_date(hashed_struct):
+    saved = hashed_struct.directory / "hash_data" / "fp_hash_index.npz"
+    index = dil.open_index(hashed_struct, 12, 0.3)
+    assert set(index.rows) == set(hashed_struct.image_data)
+    assert saved.is_file()
+
+    shutil.copy(hashed_struct.directory / "001.png", hashed_struct.directory / "copy.png")
+    (hashed_struct.directory / "002.png").unlink()
+    hashed_struct.update_data(dil.list_images(hashed_struct.directory))
+    index = dil.open_index(hashed_struct, 12, 0.3)
+    assert set(index.rows) == set(hashed_struct.image_data)
+    assert "001.png" in index.candidates({"copy.png": hashed_struct.image_data["copy.png"]})["copy.png"]
+
+    modified = saved.stat().st_mtime_ns
+    assert set(dil.open_index(hashed_struct, 12, 0.3).rows) == set(hashed_struct.image_data)
+    assert saved.stat().st_mtime_ns == modified  # nothing changed, not saved again.
+    assert dil.open_index(hashed_struct, 10, 0.3).cutoff == 10
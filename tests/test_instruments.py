@@ -0,0 +1,42 @@
+import json
+
+import pytest
+
+import dupe_image_lib as dil
+
+
+@pytest.mark.parametrize("cores", [1, 2])
+def test_report_counts_and_times_the_stages(image_folder, tmp_path_factory, cores):
+    instruments = dil.Instruments()
+    image_struct = dil.ImageStruct(image_folder, cores, pyqt_signals=dil.make_signals(), instruments=instruments)
+    image_struct.generate_data(dil.list_images(image_folder), grid_density=4)
+    image_struct.save_data()
+    dil.cross_compare_matrix(image_struct, cutoff=12)
+
+    report = instruments.report()
+    assert report["counters"]["images_decoded"] == 6  # merged from the hashing processes with 2 cores.
+    assert report["counters"]["bytes_read"] == sum(path.stat().st_size for path in image_folder.glob("*.png"))
+    assert report["counters"]["pairs_compared"] == 15
+    for name in ("decode", "hash_tiles", "identical_files", "save_binary", "pack_hashes", "compare", "group"):
+        assert report["timers"][name] >= 0 and report["calls"][name] >= 1
+    assert report["calls"]["decode"] == 6 and report["calls"]["save_binary"] == 1
+    if cores > 1:
+        assert report["calls"]["pool_wait"] >= 1
+        assert sum(worker["batches"] for worker in report["workers"].values()) == 6  # one image per batch.
+    else:
+        assert report["workers"] == {}
+
+    path = tmp_path_factory.mktemp("report") / "report.json"
+    instruments.save(path)
+    assert json.loads(path.read_text()) == report
+
+
+def test_null_instruments_are_a_no_op(hashed_struct):
+    null = dil.NullInstruments()
+    assert not null.enabled and isinstance(hashed_struct.instruments, dil.NullInstruments)
+    assert null.stage("decode") is null.stage("compare")  # nothing is allocated per stage.
+    with null.stage("decode"):
+        null.count("images_decoded", 6)
+        null.merge({"counters": {"images_decoded": 6}, "pid": 1, "busy_seconds": 1.0})
+    assert not hasattr(null, "counters") and not hasattr(null, "__dict__")
+    assert dil.cross_compare_matrix(hashed_struct, cutoff=12) == [[], []]
@@ -0,0 +1,54 @@
+import pytest
+
+import dupe_image_cli
+import dupe_image_lib as dil
+from tests.helpers import noise_image
+
+
+def test_scan_tree_skips_caches_and_hidden_folders(tmp_path):
+    for relative in ("top.png", "a/000.png", "a/b/001.jpg", "a/notes.txt", "a/hash_data/002.png",
+                     "a/.thumbnails/003.png", ".git/004.png", "moved_images/005.png"):
+        (tmp_path / relative).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / relative).write_bytes(b"")
+
+    assert dil.scan_tree(tmp_path) == ["a/000.png", "a/b/001.jpg", "top.png"]
+    assert dil.scan_tree(tmp_path, root_files=False) == ["a/000.png", "a/b/001.jpg"]
+
+
+def test_update_library_seeds_from_folder_caches(tmp_path):
+    library = tmp_path
+    (library / "hashed").mkdir()
+    for seed in range(6):
+        noise_image(seed).save(library / "hashed" / f"{seed:03d}.png")
+    hashed_struct = dil.ImageStruct(library / "hashed", 1)
+    hashed_struct.generate_data(dil.list_images(library / "hashed"), grid_density=4)
+    hashed_struct.save_data()
+    (library / "new").mkdir()
+    noise_image(20).save(library / "new" / "000.png")
+    noise_image(21).save(library / "new" / "001.png")
+    noise_image(22).save(library / "hashed" / "001.png")  # changed since it was hashed.
+
+    instruments = dil.Instruments()
+    library_struct = dil.ImageStruct(library, 1, instruments=instruments)
+    file_list = library_struct.update_library(grid_density=4)
+
+    assert file_list == [f"hashed/{num:03d}.png" for num in range(6)] + ["new/000.png", "new/001.png"]
+    assert list(library_struct.image_data) == file_list
+    assert instruments.counters["images_seeded"] == 6
+    assert instruments.counters["images_decoded"] == 3  # the two new images and the changed one.
+    for num in (0, 2, 3, 4, 5):
+        assert list(library_struct.image_data[f"hashed/{num:03d}.png"]["hash_list"]) == \
+               list(hashed_struct.image_data[f"{num:03d}.png"]["hash_list"])
+    assert list(library_struct.image_data["hashed/001.png"]["hash_list"]) != \
+           list(hashed_struct.image_data["001.png"]["hash_list"])
+
+    other_density = dil.ImageStruct(library, 1, instruments=dil.Instruments())
+    other_density.update_library(grid_density=5)  # the folder's hashes are of another grid, nothing is seeded.
+    assert other_density.instruments.counters["images_seeded"] == 0
+
+
+def test_regroup_is_refused_for_libraries(tmp_path, capsys):
+    with pytest.raises(SystemExit):
+        dupe_image_cli.parse_args(["group", str(tmp_path), "--recursive", "--regroup", "%grp%-%grp_num%"])
+    assert "--regroup" in capsys.readouterr().err
+    assert dupe_image_cli.parse_args(["group", str(tmp_path), "--regroup", "%grp%-%grp_num%"]).regroup
@@ -0,0 +1,32 @@
+import pytest
+
+import dupe_image_lib as dil
+from tests.helpers import noise_image
+
+
+@pytest.fixture
+def incoming(tmp_path_factory):
+    """
+    A folder of incoming images: a resized copy of 002.png, an image that isn't stored, and a new image named like a
+    stored one.
+    """
+
+    folder = tmp_path_factory.mktemp("incoming")
+    noise_image(2, size=(300, 300)).save(folder / "near.png")
+    noise_image(50).save(folder / "novel.png")
+    noise_image(4).save(folder / "001.png")
+    return sorted(folder.iterdir())
+
+
+@pytest.mark.parametrize("cores", [1, 2])
+def test_query_matches_against_stored_images(hashed_struct, incoming, cores):
+    hashed_struct.allowed_cpu_cores = cores
+    results = {path.name: matches for path, _, matches in hashed_struct.query(incoming, cutoff=12)}
+    assert results == {"near.png": ["002.png"], "novel.png": [], "001.png": ["004.png"]}
+    assert set(hashed_struct.image_data) == {f"{seed:03d}.png" for seed in range(6)}  # nothing is added.
+
+
+def test_query_with_index(hashed_struct, incoming):
+    index = dil.open_index(hashed_struct, 12, 0.3)
+    results = {path.name: matches for path, _, matches in hashed_struct.query(incoming, cutoff=12, index=index)}
+    assert results == {"near.png": ["002.png"], "novel.png": [], "001.png": ["004.png"]}
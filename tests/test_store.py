@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+import dupe_image_lib as dil
+from tests.helpers import near_duplicate_data
+
+
+def make_image_data(seed: int) -> dict:
+    image_data = near_duplicate_data(np.random.default_rng(seed), 20, 5, 12, tiles=16)
+    image_data["0003.png"]["frame_hashes"] = ["0123456789abcdef", "fedcba9876543210"]
+    image_data["0004.png"]["file_stat"] = {"st_size": 1234, "mtime_ns": 5678, "inode": 9}
+    return image_data
+
+
+def test_save_and_load_hash_store(tmp_path):
+    image_data = make_image_data(0)
+    dil.save_hash_store(tmp_path / "store.bin", {"grid_density": 4}, image_data)
+    metadata, records = dil.load_hash_store(tmp_path / "store.bin")
+
+    assert metadata == {"grid_density": 4}
+    assert isinstance(records.hashes, np.memmap) and isinstance(records.sizes, np.memmap)
+    assert list(records) == list(image_data)
+    names, matrix = dil.pack_hashes(image_data)
+    assert np.array_equal(dil.pack_hashes(records)[1], matrix)
+    assert records["0003.png"]["frame_hashes"] == ["0123456789abcdef", "fedcba9876543210"]
+    assert records["0004.png"]["file_stat"] == {"st_size": 1234, "mtime_ns": 5678, "inode": 9}
+    assert records["0005.png"].get("frame_hashes") is None
+    assert tuple(records["0005.png"]["size"]) == (320, 240)
+    assert not (tmp_path / "store.bin.tmp").exists()
+
+
+def test_interrupted_save_keeps_the_old_store(tmp_path, monkeypatch):
+    dil.save_hash_store(tmp_path / "store.bin", {"grid_density": 4}, make_image_data(0))
+    _, old = dil.load_hash_store(tmp_path / "store.bin")
+    old_hashes = np.array(old.hashes)
+
+    def crash(*args):
+        raise OSError("interrupted")
+
+    with monkeypatch.context() as patch:  # dies after writing the new store, before it replaces the old one.
+        patch.setattr(dil.os, "replace", crash)
+        with pytest.raises(OSError):
+            dil.save_hash_store(tmp_path / "store.bin", {"grid_density": 4}, make_image_data(1))
+    (tmp_path / "store.bin.tmp").write_bytes(b"DILHASH1 half written")  # or died while writing it.
+
+    _, records = dil.load_hash_store(tmp_path / "store.bin")
+    assert np.array_equal(records.hashes, old_hashes)
+
+    dil.save_hash_store(tmp_path / "store.bin", {"grid_density": 4}, make_image_data(1))
+    _, records = dil.load_hash_store(tmp_path / "store.bin")
+    assert np.array_equal(dil.pack_hashes(records)[1], dil.pack_hashes(make_image_data(1))[1])
+
+
+def test_image_struct_binary_round_trip(hashed_struct):
+    hashed_struct.save_data("binary")
+    loaded = dil.ImageStruct(hashed_struct.directory, 1, pyqt_signals=dil.make_signals())
+    loaded.load_data("binary")
+    assert isinstance(loaded.image_data.hashes, np.memmap)
+    assert np.array_equal(dil.pack_hashes(loaded.image_data)[1], dil.pack_hashes(hashed_struct.image_data)[1])
+    assert loaded.metadata["grid_density"] == 4
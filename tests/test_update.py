@@ -0,0 +1,40 @@
+import datetime
+import os
+import time
+
+import dupe_image_lib as dil
+
+
+def make_legacy(image_struct, modified: str):
+    """
+    Drops the fingerprints of the hashes, as if they were made before fingerprints were stored, saved an hour ago.
+    Every file is older than that except modified, which was changed since.
+    """
+
+    saved = time.time() - 3600
+    image_struct.metadata["last_time_modified"] = datetime.datetime.fromtimestamp(saved).strftime("%d/%m/%Y %H:%M:%S")
+    for name in image_struct.image_data:
+        image_struct.image_data.file_stats[image_struct.image_data.rows[name]] = None
+        mtime = time.time() - 10 if name == modified else saved - 60
+        os.utime(image_struct.directory / name, (mtime, mtime))
+
+
+def test_update_data_adopts_only_older_files(hashed_struct):
+    make_legacy(hashed_struct, "002.png")
+    hashed_struct.update_data(dil.list_images(hashed_struct.directory))
+    assert "Updating hashes: 0 new, 1 changed, 0 removed." in hashed_struct.log
+    for name in hashed_struct.image_data:
+        assert hashed_struct.image_data[name]["file_stat"] == dil.file_fingerprint(hashed_struct.directory / name)
+
+
+def test_watcher_poll_adopts_only_older_files(hashed_struct):
+    watcher = dil.FolderWatcher(hashed_struct, settle=0, notify=False)
+    watcher.start()
+    try:
+        make_legacy(hashed_struct, "004.png")
+        assert watcher.poll() == [("004.png", [])]
+        assert watcher.poll() == []
+        for name in hashed_struct.image_data:
+            assert hashed_struct.image_data[name]["file_stat"] == dil.file_fingerprint(hashed_struct.directory / name)
+    finally:
+        watcher.close()
@@ -0,0 +1,47 @@
+import pytest
+
+import dupe_image_lib as dil
+from tests.helpers import noise_image
+
+av = pytest.importorskip("av")
+
+
+def write_clip(path, seeds: list, fps=10, keyframe_interval=2):
+    """
+    Writes a tiny MPEG-4 clip with a noise_image frame for every seed, and a keyframe every keyframe_interval frames.
+    """
+
+    with av.open(str(path), "w") as container:
+        stream = container.add_stream("mpeg4", rate=fps)
+        stream.width, stream.height, stream.pix_fmt = 64, 64, "yuv420p"
+        stream.codec_context.gop_size = keyframe_interval
+        for seed in seeds:
+            for packet in stream.encode(av.VideoFrame.from_image(noise_image(seed, size=(64, 64)))):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+
+
+@pytest.mark.parametrize("policy", ["uniform", "first", "stride"])
+def test_video_frames(tmp_path, policy):
+    write_clip(tmp_path / "clip.mp4", list(range(12)))
+    frames = list(dil.video_frames(tmp_path / "clip.mp4", max_frames=4, policy=policy, stride=2))
+    assert 2 <= len(frames) <= 4
+    assert all(frame.size == (64, 64) for frame in frames)
+
+
+def test_hash_video_and_sequences(tmp_path):
+    write_clip(tmp_path / "clip.mp4", list(range(12)))
+    write_clip(tmp_path / "copy.mp4", list(range(12)))
+    write_clip(tmp_path / "other.mp4", list(range(100, 112)))
+    noise_image(0).save(tmp_path / "still.png")
+
+    entry = dil.hash_video(tmp_path / "clip.mp4", 4, {"max_frames": 6})
+    assert entry["size"] == (64, 64)
+    assert len(entry["hash_list"]) == 16
+    assert 2 <= len(entry["frame_hashes"]) <= 6
+
+    image_struct = dil.ImageStruct(tmp_path, 1, pyqt_signals=dil.make_signals())
+    image_struct.generate_data(dil.list_images(tmp_path, dil.media_types(video=True)), grid_density=4)
+    assert set(dil.frame_sequences(image_struct.image_data)) == {"clip.mp4", "copy.mp4", "other.mp4"}
+    assert dil.cross_compare_sequences(image_struct)[1] == [["clip.mp4", "copy.mp4"]]
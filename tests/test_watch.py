@@ -0,0 +1,38 @@
+import dupe_image_lib as dil
+from tests.helpers import noise_image
+
+
+def test_watcher_matches_arrivals_drops_removals_and_skips_broken_files(hashed_struct):
+    watcher = dil.FolderWatcher(hashed_struct, cutoff=12, settle=0, notify=False)
+    watcher.start()
+    try:
+        assert watcher.poll() == []
+        noise_image(1, size=(300, 300)).save(hashed_struct.directory / "copy.png")
+        noise_image(9).save(hashed_struct.directory / "new.png")
+        assert sorted(watcher.poll()) == [("copy.png", ["001.png"]), ("new.png", [])]  # in listing order.
+        assert {"copy.png", "new.png"} <= set(hashed_struct.image_data)
+
+        (hashed_struct.directory / "002.png").unlink()
+        assert watcher.poll() == []
+        assert "002.png" not in hashed_struct.image_data
+
+        (hashed_struct.directory / "broken.png").write_bytes(b"not an image")
+        assert watcher.poll() == []
+        assert "broken.png" in watcher.failed
+        assert "broken.png" not in hashed_struct.image_data
+        assert any(line.startswith("Could not hash broken.png") for line in hashed_struct.log)
+        assert watcher.poll() == []  # not retried until it changes.
+
+        (hashed_struct.directory / "003.png").write_bytes(b"broken since")
+        assert watcher.poll() == []
+        assert "003.png" in watcher.failed
+        assert "003.png" not in hashed_struct.image_data  # its old hashes would match what it was.
+
+        noise_image(3).save(hashed_struct.directory / "again.png")
+        assert watcher.poll() == [("again.png", [])]
+    finally:
+        watcher.close()
+
+    loaded = dil.ImageStruct(hashed_struct.directory, 1, pyqt_signals=dil.make_signals())
+    loaded.load_data()
+    assert set(loaded.image_data) == {"000.png", "001.png", "004.png", "005.png", "again.png", "copy.png", "new.png"}